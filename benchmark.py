@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""
+This program measures the performance of fileinfo.py, so that changes
+can be compared against a known baseline.
+
+It generates a synthetic directory tree from a random seed, so that the
+same tree can be created again on another day or another machine. The
+shape of the tree is configurable:
+
+    * the number of files
+    * the distribution of file sizes (fixed, uniform, or log-normal)
+    * the fraction of files that are hard links to earlier files
+    * the characters used in file names
+    * the number of subdirectories in each directory, and the depth
+
+fileinfo.py is then run against the tree for each combination of CPU
+count and mode requested, and the results are written as JSON:
+
+    * files / second
+    * MB / second (of file contents)
+    * bytes of output per file
+    * peak resident set size (RSS) of fileinfo.py and its processes
+
+Note that the tree will usually be in the operating system cache after
+it has been generated, so the results show the best case for reading.
+"""
+
+import os
+import os.path
+import sys
+import time
+import json
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+# characters to choose from when making file names
+name_charsets = {
+    'ascii': 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-.',
+    'latin1': u'abcdefghijklmnopqrstuvwxyzàéîõüßæø',
+    'unicode': u'abcxyzαβπжя中文日本☃',
+    # characters that have to be escaped in the output
+    'escaped': u'abcxyz\\\u0001\u001f\u007f\u0085 ￾',
+}
+
+# extra fileinfo.py arguments for each mode
+modes = {
+    'default': [ ],
+    'progress': [ '--progress' ],
+    'threads': [ '--engine', 'threads' ],
+    'processes': [ '--engine', 'processes' ],
+    'auto-engine': [ '--engine', 'auto' ],
+    'kernel': [ '--kernel-hash' ],
+}
+
+# all generated files are made from this much random data, repeated
+BLOCK_SIZE = 65536
+
+def file_size(rng, size_dist, size, max_size):
+    """Pick the size of a file
+
+    :param rng: a random.Random object
+    :param size_dist: 'fixed', 'uniform', or 'lognormal'
+    :param size: the size of a fixed file, or the median otherwise
+    :param max_size: the largest size allowed
+    """
+    if size_dist == 'fixed':
+        n = size
+    elif size_dist == 'uniform':
+        n = rng.randint(0, 2 * size)
+    elif size_dist == 'lognormal':
+        # a sigma of 2 gives a long tail of large files, as is typical
+        # of real file systems
+        n = int(rng.lognormvariate(0, 2) * size)
+    else:
+        raise ValueError("unknown size distribution '%s'" % size_dist)
+    return min(n, max_size)
+
+def file_name(rng, charset, length):
+    """Make a random file name
+
+    :param rng: a random.Random object
+    :param charset: the characters to use
+    :param length: the number of characters
+    """
+    return u''.join([ rng.choice(charset) for n in range(length) ])
+
+def make_dirs(top, fanout, depth):
+    """Create the directories of the tree
+
+    :param top: the directory to create them in
+    :param fanout: the number of subdirectories in each directory
+    :param depth: the number of levels below the top
+
+    Returns a list of all directories, including the top.
+    """
+    dirs = [ top ]
+    level = [ top ]
+    for n in range(depth):
+        next_level = [ ]
+        for parent in level:
+            for i in range(fanout):
+                path = os.path.join(parent, "d%d" % i)
+                os.mkdir(path)
+                next_level.append(path)
+        dirs.extend(next_level)
+        level = next_level
+    return dirs
+
+def make_tree(top, num_files, size_dist='lognormal', size=4096,
+              max_size=64*1024*1024, link_ratio=0.0, charset='ascii',
+              fanout=4, depth=2, seed=0):
+    """Generate a synthetic directory tree
+
+    :param top: an existing, empty directory to create the tree in
+    :param num_files: the number of files to create
+    :param size_dist: the distribution of file sizes (see file_size())
+    :param size: the size or median size of files
+    :param max_size: the largest file to create
+    :param link_ratio: the fraction of files which are hard links
+    :param charset: the name of the character set for file names
+    :param fanout: the number of subdirectories in each directory
+    :param depth: the number of levels of subdirectories
+    :param seed: the random seed, so the tree can be reproduced
+
+    Files are spread evenly over all of the directories. Returns a
+    dictionary describing the tree, including the total number of
+    bytes in (distinct) files.
+    """
+    rng = random.Random(seed)
+    chars = name_charsets[charset]
+    block = bytes(bytearray([ rng.randint(0, 255)
+                              for n in range(BLOCK_SIZE) ]))
+    dirs = make_dirs(top, fanout, depth)
+    created = [ ]
+    total_bytes = 0
+    num_links = 0
+    for n in range(num_files):
+        parent = dirs[n % len(dirs)]
+        # prefix the name with the number, so names never collide
+        name = u"%d_%s" % (n, file_name(rng, chars, rng.randint(1, 24)))
+        path = os.path.join(parent, name)
+        if created and (rng.random() < link_ratio):
+            os.link(rng.choice(created), path)
+            num_links = num_links + 1
+            continue
+        n_bytes = file_size(rng, size_dist, size, max_size)
+        f = open(path, 'wb')
+        remaining = n_bytes
+        while remaining > 0:
+            f.write(block[:min(remaining, BLOCK_SIZE)])
+            remaining = remaining - BLOCK_SIZE
+        f.close()
+        created.append(path)
+        total_bytes = total_bytes + n_bytes
+    return { 'files': num_files,
+             'directories': len(dirs),
+             'hard_links': num_links,
+             'bytes': total_bytes,
+             'size_dist': size_dist,
+             'size': size,
+             'max_size': max_size,
+             'link_ratio': link_ratio,
+             'charset': charset,
+             'fanout': fanout,
+             'depth': depth,
+             'seed': seed, }
+
+def run_fileinfo(fileinfo_path, tree, ncpus, extra_args):
+    """Run fileinfo.py once and measure it
+
+    :param fileinfo_path: the location of fileinfo.py
+    :param tree: the directory to run against
+    :param ncpus: the number of cores to use
+    :param extra_args: a list of additional arguments
+
+    Returns a tuple of (run time in seconds, bytes of output, peak RSS
+    in KiB). The peak RSS is None if it cannot be measured here.
+    """
+    (fd, outname) = tempfile.mkstemp(prefix='fileinfo_bench_')
+    os.close(fd)
+    devnull = open(os.devnull, 'w')
+    try:
+        cmd = [ sys.executable, fileinfo_path, '-n', str(ncpus),
+                '-o', outname ] + extra_args + [ tree ]
+        start_time = time.time()
+        proc = subprocess.Popen(cmd, stderr=devnull)
+        if hasattr(os, 'wait4'):
+            (pid, status, usage) = os.wait4(proc.pid, 0)
+            run_time = time.time() - start_time
+            # ru_maxrss is in KiB on Linux, but bytes on Mac OS X
+            peak_rss = usage.ru_maxrss
+            if platform.system() == 'Darwin':
+                peak_rss = peak_rss // 1024
+            returncode = status
+        else:
+            returncode = proc.wait()
+            run_time = time.time() - start_time
+            peak_rss = None
+        if returncode != 0:
+            raise RuntimeError("'%s' failed" % ' '.join(cmd))
+        output_bytes = os.path.getsize(outname)
+    finally:
+        devnull.close()
+        os.remove(outname)
+    return (run_time, output_bytes, peak_rss)
+
+def benchmark(fileinfo_path, tree, tree_info, ncpus_list, mode_list, repeat):
+    """Run fileinfo.py for each CPU count and mode
+
+    :param fileinfo_path: the location of fileinfo.py
+    :param tree: the directory to run against
+    :param tree_info: the description of the tree from make_tree()
+    :param ncpus_list: a list of CPU counts to try
+    :param mode_list: a list of mode names (see modes)
+    :param repeat: the number of times to run each case
+
+    The fastest of the repeated runs is reported for each case.
+    """
+    results = [ ]
+    for mode in mode_list:
+        for ncpus in ncpus_list:
+            runs = [ run_fileinfo(fileinfo_path, tree, ncpus, modes[mode])
+                     for n in range(repeat) ]
+            (run_time, output_bytes, peak_rss) = min(runs,
+                                                     key=lambda run: run[0])
+            # the peak RSS cannot be measured everywhere
+            peaks = [ run[2] for run in runs if run[2] is not None ]
+            if peaks:
+                peak_rss = max(peaks)
+            else:
+                peak_rss = None
+            result = { 'mode': mode,
+                       'ncpus': ncpus,
+                       'run_time': run_time,
+                       'output_bytes_per_file':
+                           output_bytes / float(tree_info['files']),
+                       'peak_rss_kib': peak_rss, }
+            if run_time > 0:
+                result['files_per_second'] = tree_info['files'] / run_time
+                result['mb_per_second'] = \
+                    tree_info['bytes'] / run_time / 1000000
+            results.append(result)
+            sys.stderr.write("%s, %d %s: %.2f seconds\n" %
+                             (mode, ncpus,
+                              (ncpus == 1) and "cpu" or "cpus", run_time))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the performance of fileinfo.py on a synthetic directory tree.')
+    parser.add_argument('-f', '--files', type=int, default=10000,
+                        help='number of files to create (default 10000)')
+    parser.add_argument('--size-dist', choices=('fixed', 'uniform', 'lognormal'),
+                        default='lognormal',
+                        help='distribution of file sizes (default lognormal)')
+    parser.add_argument('--size', type=int, default=4096,
+                        help='size, or median size, of files in bytes (default 4096)')
+    parser.add_argument('--max-size', type=int, default=64*1024*1024,
+                        help='largest file to create in bytes (default 64 MiB)')
+    parser.add_argument('--link-ratio', type=float, default=0.0,
+                        help='fraction of files that are hard links (default 0)')
+    parser.add_argument('--charset', choices=sorted(name_charsets.keys()),
+                        default='ascii',
+                        help='characters to use in file names (default ascii)')
+    parser.add_argument('--fanout', type=int, default=4,
+                        help='subdirectories in each directory (default 4)')
+    parser.add_argument('--depth', type=int, default=2,
+                        help='levels of subdirectories (default 2)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed used to generate the tree (default 0)')
+    parser.add_argument('-n', '--ncpus', type=str, default='1,2,4',
+                        help='comma-separated list of core counts to try (default 1,2,4)')
+    parser.add_argument('-m', '--modes', type=str, default='default',
+                        help='comma-separated list of modes to try, from: %s (default "default")' % ', '.join(sorted(modes.keys())))
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='number of runs of each case, of which the fastest is reported (default 3)')
+    parser.add_argument('-d', '--dir', type=str,
+                        help='directory to create the tree in (defaults to a temporary directory, removed afterwards)')
+    parser.add_argument('-o', '--outfile', type=str,
+                        help='file to write results to (defaults to STDOUT)')
+    args = parser.parse_args()
+
+    ncpus_list = [ int(n) for n in args.ncpus.split(',') ]
+    mode_list = args.modes.split(',')
+    for mode in mode_list:
+        if mode not in modes:
+            parser.error("unknown mode '%s'" % mode)
+
+    fileinfo_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'fileinfo.py')
+    if args.dir:
+        tree = args.dir
+        os.mkdir(tree)
+        remove_tree = False
+    else:
+        tree = tempfile.mkdtemp(prefix='fileinfo_bench_')
+        remove_tree = True
+    try:
+        sys.stderr.write("Generating tree in %s...\n" % tree)
+        tree_info = make_tree(tree, args.files, args.size_dist, args.size,
+                              args.max_size, args.link_ratio, args.charset,
+                              args.fanout, args.depth, args.seed)
+        results = benchmark(fileinfo_path, tree, tree_info,
+                            ncpus_list, mode_list, args.repeat)
+    finally:
+        if remove_tree:
+            shutil.rmtree(tree)
+
+    report = { 'tree': tree_info,
+               'python': sys.version.split()[0],
+               'python_implementation': platform.python_implementation(),
+               'system': platform.system(),
+               'cpu_count': os.sysconf('SC_NPROCESSORS_ONLN')
+                            if hasattr(os, 'sysconf') else None,
+               'results': results, }
+    if args.outfile:
+        outfile = open(args.outfile, 'w')
+    else:
+        outfile = sys.stdout
+    json.dump(report, outfile, indent=1, sort_keys=True)
+    outfile.write("\n")
+
+if __name__ == "__main__":
+    main()
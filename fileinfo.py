@@ -14,6 +14,12 @@ Files start with a line indicating the version:
 
     %fileinfo 0.4
 
+If only some files were reported, the include and exclude rules used
+(in the .gitignore syntax) follow the version, one per line:
+
+    %exclude *.o
+    %include important.o
+
 A change of directory may be indicated by either a '!' (exclamation
 point) or a ':' (colon). An exclamation point indicates a directory on
 a Unix-like file system, and a colon indicates a directory on a
@@ -25,6 +31,18 @@ ignore the low bit of reported times:
     !example
     :example
 
+When the --one-file-system and --mount-markers options are used, a
+directory that is the mount point of another file system is marked
+with a '-' (minus sign), since its contents are not reported:
+
+    -example/mnt
+
+When the output is split into shards with the --shard option, each
+unit of work starts with an '&' (ampersand) and the unit number. These
+lines are removed when the shards are merged:
+
+    &3
+
 Most information is meta-data about files. For example:
 
     m100644
@@ -49,6 +67,7 @@ The file information is:
     C - time of last status change
     A - time of last access
     # - SHA224 hash of the file, base64-encoded (regular files only)
+    ~ - sampled fingerprint of the file, instead of the hash (see below)
 
 When all meta information for a file is complete, we have either:
 
@@ -95,6 +114,19 @@ an error calculating the hash value for a file (for example if the
 file is not readable by the user running the program) then the hash
 value is omitted for that particular file.
 
+For a quick check of very large trees, the --sample option outputs a
+fingerprint of each regular file in place of the hash, using a tilde,
+'~'. The fingerprint is the SHA224 hash of the size of the file (in
+decimal, followed by a newline) and some blocks of the file: the first
+block, the last block, and the rest spread evenly between them. A file
+no larger than all of the blocks together is hashed completely. The
+size and number of blocks are given in a header line:
+
+    %sample 65536 8
+
+The fingerprint will catch most changes, but not all, so a matching
+fingerprint means the file is probably unchanged.
+
 Finally, an "inode cache" is used. For files that have already had
 information output in the form of an inode, only the inode number and
 the name of the file is output - the other details are identical to
@@ -169,6 +201,13 @@ only checks that information.
 # Decision:
 #     Use multiprocessing, but special-case 1-CPU to maximize 
 #     single-core performance.
+# Update:
+#     hashlib and file reads release the GIL, so threads can hash in
+#     parallel on CPython, and avoid pickling every file between
+#     processes. The --engine option selects threads instead, or
+#     "auto" to choose (see choose_engine()), but processes stay the
+#     default until there are measurements on machines with several
+#     cores showing where threads are faster.
 
 # Other considerations:
 # * Use of hex or other more compact system for writing numbers was 
@@ -191,6 +230,15 @@ import argparse
 import errno
 import signal
 import platform
+import threading
+import json
+import math
+import re
+import socket
+import struct
+import collections
+import heapq
+import select
 
 try:
     # Jython doesn't have __builtins__, but we can import __builtin__
@@ -204,10 +252,20 @@ try:
     use_threads = False
 except ImportError:
     # Jython has no multiprocessing module, so we must use threads
-    import Queue
-    import threading
     use_threads = True
 
+try:
+    import Queue
+except ImportError:
+    # Python 3 renamed the Queue module
+    import queue as Queue
+
+try:
+    import ctypes
+except ImportError:
+    # Jython has no ctypes, so we cannot use inotify for --watch
+    ctypes = None
+
 # TODO: finish docstrings
 # TODO: finish tests
 # TODO: system-level tests (lettuce?)
@@ -217,21 +275,9 @@ except ImportError:
 # TODO: localization?
 # TODO: paths relative vs. absolute?
 # XXX: file info for non-directories... (on command line)
-# TODO: update progress when large files being processed
 # TODO: Additional code to shorten time (Am... maybe for 0.4)
 # XXX: stat() value change between lstat() and open()
-# TODO: recover from errors in multiprocessing units, for example:
-#    Traceback (most recent call last):
-#      File "app_main.py", line 72, in run_toplevel
-#      File "fileinfo.py", line 908, in <module>
-#        main()
-#      File "fileinfo.py", line 840, in main
-#        this_dir = chdir_info(root)
-#      File "fileinfo.py", line 412, in __init__
-#        if is_fatfs_file(dir_name):
-#      File "fileinfo.py", line 390, in is_fatfs_file
-#        fcntl.ioctl(fd, FAT_IOCTL_GET_ATTRIBUTES, "\x00")
-#    IOError: [Errno 11] Resource temporarily unavailable
+# TODO: recover from errors in multiprocessing units
 # TODO: change name of sub-processes to indicate operation
 # TODO: status reports from sub-processes?
 # TODO: speed performance on single-core operation
@@ -239,7 +285,6 @@ except ImportError:
 # TODO: set onerror in os.walk()
 # TODO: errors with lstat() calls
 # TODO: output user name as well as number?
-# TODO: auto-determine number of cores to run
 # TODO: checksum for file itself, maybe also byte & file counts for
 #       contents & file?
 # TODO: extended attributes
@@ -289,6 +334,20 @@ def escape_filename(filename):
             escaped_chars.append("\\U%08x" % n)
     return ''.join(escaped_chars)
 
+def unescape_filename(escaped):
+    r"""Undo escape_filename()
+
+    :param escaped: a string with an escaped file name
+
+    Returns a string with the \xXX, \uXXXX, and \UXXXXXXXX escapes
+    converted back to the characters they stand for.
+    """
+    if '\\' not in escaped:
+        return escaped
+    to_char = getattr(__builtin__, 'unichr', chr)
+    return re.sub(r'\\(x[0-9a-f]{2}|u[0-9a-f]{4}|U[0-9a-f]{8})',
+                  lambda m: to_char(int(m.group(1)[1:], 16)), escaped)
+
 def stat_has_time_ns():
     """Determine whether the stat() function provides nanosecond resolution.
     Usually Python 3 can provide nanosecond resolution, and Python 2 not.
@@ -440,7 +499,89 @@ else:
         just assume that it is not and hope for the best.
         """
         return False
-    
+
+# Checking each directory with an ioctl() costs an open(), the ioctl()
+# itself, and a close() for every directory visited, and the ioctl()
+# occasionally fails with EAGAIN. Since every directory on a given
+# device lives on the same file system, we determine the answer once
+# per st_dev and remember it for the rest of the run.
+#
+# On Linux we can get the file system type of every mounted device from
+# /proc/self/mountinfo, so we only fall back to the ioctl() for devices
+# we can't find there.
+
+# file system types that report timestamps with 2-second accuracy
+FATFS_TYPES = ('msdos', 'vfat', 'umsdos', 'fat')
+
+def read_mount_types(mountinfo):
+    """Read the file system type of each mounted device
+
+    :param mountinfo: a file-like object in the /proc/self/mountinfo format
+
+    Returns a dictionary mapping (major, minor) device numbers to the
+    name of the file system type. Lines we do not understand are
+    silently ignored.
+    """
+    mount_types = { }
+    for line in mountinfo:
+        fields = line.split()
+        # the optional fields are terminated by a single hyphen, and
+        # the file system type follows that
+        try:
+            fs_type = fields[fields.index('-', 6) + 1]
+            (major, minor) = fields[2].split(':')
+            mount_types[(int(major), int(minor))] = fs_type
+        except (ValueError, IndexError):
+            continue
+    return mount_types
+
+# mount table, loaded the first time we need it
+mount_types = None
+# cached result of FAT detection, indexed by st_dev
+fatfs_devices = { }
+
+def mount_fs_type(st_dev):
+    """Look up the file system type of a device in the mount table
+
+    :param st_dev: the device number, as returned by stat()
+
+    Returns None if the type cannot be determined.
+    """
+    global mount_types
+    if mount_types is None:
+        try:
+            mountinfo = open('/proc/self/mountinfo', 'r')
+            try:
+                mount_types = read_mount_types(mountinfo)
+            finally:
+                mountinfo.close()
+        except (IOError, OSError):
+            mount_types = { }
+    if not hasattr(os, 'major'):
+        return None
+    return mount_types.get((os.major(st_dev), os.minor(st_dev)))
+
+def is_fatfs_dir(dir_name, st_dev=None):
+    """Determine if the given directory is on a FAT file system
+
+    :param dir_name: the name of a directory
+    :param st_dev: the device of the directory, if already known
+
+    The result is cached per device, so the mount table or the ioctl()
+    is only consulted the first time we see a device.
+    """
+    if st_dev is None:
+        st_dev = os.stat(dir_name).st_dev
+    if st_dev in fatfs_devices:
+        return fatfs_devices[st_dev]
+    fs_type = mount_fs_type(st_dev)
+    if fs_type is None:
+        result = is_fatfs_file(dir_name)
+    else:
+        result = fs_type in FATFS_TYPES
+    fatfs_devices[st_dev] = result
+    return result
+
 # To support multiple cores, we have a number of worker threads handling
 # hash generation.
 #
@@ -482,16 +623,17 @@ class chdir_info:
     """chdir_info is used to signal a new directory for reporting 
     file information, any metadata output after this originates from 
     the directory specified"""
-    def __init__(self, dir_name):
+    def __init__(self, dir_name, st_dev=None):
         """initialize the directory name
 
         :param dir_name: the name of the directory
+        :param st_dev: the device of the directory, if already known
 
         The constructor determines whether or not the specified
         directory is a FAT-style directory.
         """
         self.dir_name = dir_name
-        if is_fatfs_file(dir_name):
+        if is_fatfs_dir(dir_name, st_dev):
             self.cmd = ':'
         else:
             self.cmd = '!'
@@ -513,6 +655,52 @@ class chdir_info:
                   escape_filename(os.path.normpath(self.dir_name)) + "\n")
         return prev_stat
 
+class skipped_mount_info:
+    """skipped_mount_info is used to record that a directory was not
+    reported because it is the mount point of another file system"""
+    def __init__(self, dir_name):
+        """initialize the directory name
+
+        :param dir_name: the name of the directory
+        """
+        self.dir_name = dir_name
+    def output(self, out, err, prev_stat):
+        """output the marker for the skipped directory
+
+        :param out: a file-like object for normal output
+        :param err: a file-like object for errors (NOT USED)
+        :param prev_stat: the last stat object output
+
+        The marker is a minus sign, '-', followed by the directory.
+        Nothing about the contents is output, so we return the
+        prev_stat variable for use in future calls.
+        """
+        out.write("-" + escape_filename(os.path.normpath(self.dir_name)) +
+                  "\n")
+        return prev_stat
+
+class unit_info:
+    """unit_info is used to mark the start of a unit of work in a shard
+    (see shard_subtrees()), so the shards can be merged in order"""
+    def __init__(self, unit):
+        """initialize the unit
+
+        :param unit: the number of the unit
+        """
+        self.unit = unit
+    def output(self, out, err, prev_stat):
+        """output the marker for the unit
+
+        :param out: a file-like object for normal output
+        :param err: a file-like object for errors (NOT USED)
+        :param prev_stat: the last stat object output
+
+        The marker is an ampersand, '&', followed by the number of the
+        unit. We return the prev_stat variable for use in future calls.
+        """
+        out.write("&%d\n" % self.unit)
+        return prev_stat
+
 class cached_info:
     """cached_info is a special class used when we want to output 
     metadata for an inode that we have earlier output"""
@@ -541,20 +729,28 @@ class file_info:
     support functions set values. The output() function has the main
     logic which implements the efficient metadata output for the
     program."""
-    def __init__(self, file_name, full_path, stat):
+    def __init__(self, file_name, full_path, stat, sample=None):
         """initialize the file information
 
         :param file_name: the name of the file
         :param full_path: the full path to the file (used for hashing)
         :param stat: the value returned by os.lstat() for the file
+        :param sample: a tuple of (block size, number of blocks) to
+                       calculate a sampled fingerprint rather than a hash
 
         The hash and any hash error are both set to None.
         """
         self.file_name = file_name
         self.full_path = full_path
         self.stat = stat
+        self.sample = sample
         self.encoded_hash = None
         self.hashing_error = None
+        # the extents of the file, if they are shared (see
+        # shared_extent_key()), and whether to reuse the hash of an
+        # earlier file with the same extents
+        self.extent_key = None
+        self.reuse_hash = False
     def set_hash(self, encoded_hash):
         """set the hash for the file
 
@@ -565,16 +761,37 @@ class file_info:
 
         :param exception: exception causing hashing error """
         self.hashing_error = exception
-    def output(self, out, err, prev_stat):
-        """output information about the file
-
-        :param out: a file-like object for normal output
-        :param err: a file-like object for errors (NOT USED)
-        :param prev_stat: the last stat object output
-
-        This function outputs information about the file. It is heavily
-        dependent on the previous file information output, since in
-        order to minimize the data output repeated metadata is omitted.
+    def share_hash(self, shared_hashes, bytes_read=None, byte_limit=None):
+        """reuse or remember the hash of a file with shared extents
+
+        :param shared_hashes: a dictionary of the hashes of files already
+                              output, by their extent key
+        :param bytes_read: an optional counter to add the bytes read to,
+                           if the file has to be hashed after all
+        :param byte_limit: an optional token_bucket limiting the rate at
+                           which bytes are read
+
+        This must be called for each file in the order they are output,
+        so that a clone is output after the file whose hash it reuses.
+        If that file could not be hashed, then the clone is hashed
+        itself (see get_checksum()).
+        """
+        if self.extent_key is None:
+            return
+        if self.reuse_hash:
+            if self.extent_key in shared_hashes:
+                self.set_hash(shared_hashes[self.extent_key])
+            else:
+                self.reuse_hash = False
+                get_checksum(self, bytes_read, byte_limit)
+                if self.encoded_hash is not None:
+                    shared_hashes[self.extent_key] = self.encoded_hash
+        elif self.encoded_hash is not None:
+            shared_hashes[self.extent_key] = self.encoded_hash
+    def report_error(self, err):
+        """output the hashing error, if there is one
+
+        :param err: a file-like object for errors
         """
         if self.hashing_error:
             if hasattr(self.hashing_error, 'errno') and \
@@ -585,6 +802,20 @@ class file_info:
             else:
                 err.write("Error with '" + self.file_name + "': " + 
                           str(self.hashing_error) + "\n")
+    def output(self, out, err, prev_stat):
+        """output information about the file
+
+        :param out: a file-like object for normal output
+        :param err: a file-like object for errors, or None if any
+                    error has already been reported
+        :param prev_stat: the last stat object output
+
+        This function outputs information about the file. It is heavily
+        dependent on the previous file information output, since in
+        order to minimize the data output repeated metadata is omitted.
+        """
+        if err is not None:
+            self.report_error(err)
 
         # most metadata is output if it is different from that
         # of the previous file... most of these are identical for 
@@ -633,20 +864,672 @@ class file_info:
             out.write("f%d\n" % self.stat.st_flags)
 
         # only regular files have a hash
-        if self.encoded_hash is not None:
+        if self.encoded_hash is None:
+            pass
+        elif self.sample is None:
             out.write("#" + self.encoded_hash + "\n")
+        else:
+            out.write("~" + self.encoded_hash + "\n")
 
         # finally, write out the file name itself
         out.write(">" + escape_filename(self.file_name) + "\n")
         return self.stat
 
-def serializer(q_serializer, num_checksum, outfile):
+# The information about a file can also be handled as a dictionary
+# mapping each field letter to the value as a string, for example when
+# it is read back from a file. These fields are omitted if they are the
+# same as for the previous file (see file_info.output()).
+DELTA_FIELDS = 'minugsCA'
+# all of the field letters, in the order they are output
+FIELD_LETTERS = 'minugsCMArf~#'
+
+def decode_fields(fields, prev_fields):
+    """Return the complete information about a file from its output
+
+    :param fields: a dictionary of the fields output for the file
+    :param prev_fields: the complete fields of the previous file, or None
+    """
+    full = dict(fields)
+    if prev_fields is not None:
+        for letter in DELTA_FIELDS:
+            if (letter not in full) and (letter in prev_fields):
+                full[letter] = prev_fields[letter]
+    if ('M' not in full) and ('C' in full):
+        full['M'] = full['C']
+    return full
+
+def encode_fields(out, fields, prev_fields):
+    """Output the complete information about a file, omitting what is
+    the same as the previous file, exactly as file_info.output() does
+
+    :param out: a file-like object for output
+    :param fields: the complete fields of the file (see decode_fields())
+    :param prev_fields: the complete fields of the previous file, or None
+    """
+    if prev_fields is None:
+        prev_fields = { }
+    for letter in FIELD_LETTERS:
+        if letter not in fields:
+            continue
+        value = fields[letter]
+        if letter in DELTA_FIELDS:
+            if value == prev_fields.get(letter):
+                continue
+        elif letter == 'M':
+            if value == fields.get('C'):
+                continue
+        out.write(letter + value + "\n")
+
+# With --digests, each directory also gets a digest of its information
+# and of everything below it, so that two snapshots can be compared a
+# subtree at a time: where the digests are the same, nothing below has
+# changed. The line with the digest is a star, '*', followed by the
+# digest, a space, and the directory, and is output once the directory
+# and everything below it have been output (so after the directories
+# below it). The "%digests" header line records that the snapshot has
+# them.
+#
+# The digest is the SHA224 hash, base64-encoded like the hash of a
+# file, of:
+#
+# * the command of the directory line ('!' or ':') on a line
+# * each entry, with all of its fields as if it were the first file
+#   output, except for the access time (or the inode number and the '@'
+#   line for a cached inode)
+# * each mount point not descended into, with its '-' line
+# * the digest line of each directory below it, as it is output but
+#   with the path relative to the directory
+#
+# so it does not depend on the files before the directory, or on where
+# the tree is. The access times are left out because reading a tree
+# changes them (on a "relatime" mount, a directory's access time is
+# updated when it is read if it is more than a day old), so the digests
+# of a tree that has not changed would not stay the same.
+DIGESTS_HEADER = '%digests\n'
+
+def subdirectory_path(dir_name, parent):
+    """Return the path of a directory relative to a directory above it,
+    or None if it is not below it
+
+    :param dir_name: the name of the directory, as output
+    :param parent: the name of the directory it may be below, as output
+    """
+    if parent == '.':
+        # os.path.normpath() leaves out the "./" before the others
+        if (dir_name in ('.', '..')) or dir_name.startswith('/') or \
+           dir_name.startswith('../'):
+            return None
+        return dir_name
+    if not parent.endswith('/'):
+        parent = parent + '/'
+    if dir_name.startswith(parent) and (len(dir_name) > len(parent)):
+        return dir_name[len(parent):]
+    return None
+
+class directory_digests:
+    """directory_digests calculates the digest of each directory of a
+    snapshot as it is output, and outputs the digest lines."""
+    def __init__(self, out):
+        """initialize the digests
+
+        :param out: a file-like object to write the digest lines to
+        """
+        self.out = out
+        # the directories not yet complete, outermost first, as lists of
+        # [ name, hash ]
+        self.open_dirs = [ ]
+    def write(self, s):
+        """add lines to the digest of the current directory
+
+        This lets the digests be used as the file-like object that an
+        entry is output to. Lines with the access time of a file are
+        left out, since reading a directory can change its access time.
+        """
+        h = self.open_dirs[-1][1]
+        for line in s.splitlines(True):
+            if not line.startswith('A'):
+                h.update(line.encode('utf-8'))
+    def _close(self):
+        (dir_name, h) = self.open_dirs.pop()
+        digest = base64.b64encode(h.digest()).decode()
+        self.out.write("*" + digest + " " + dir_name + "\n")
+        if self.open_dirs:
+            self.write("*" + digest + " " +
+                       subdirectory_path(dir_name, self.open_dirs[-1][0]) +
+                       "\n")
+    def directory(self, cmd, dir_name):
+        """start a directory, before its line is output
+
+        :param cmd: the command of the directory line, '!' or ':'
+        :param dir_name: the escaped name of the directory
+
+        The digest of each directory that is complete, because this one
+        is not below it, is output first.
+        """
+        while self.open_dirs and \
+              (subdirectory_path(dir_name, self.open_dirs[-1][0]) is None):
+            self._close()
+        self.open_dirs.append([ dir_name, hashlib.sha224() ])
+        self.write(cmd + "\n")
+    def skipped_mount(self, dir_name):
+        """add a mount point that was not descended into
+
+        :param dir_name: the escaped name of the mount point
+        """
+        relative = subdirectory_path(dir_name, self.open_dirs[-1][0])
+        self.write("-" + (relative or dir_name) + "\n")
+    def add(self, info):
+        """add an info object, before it is output
+
+        :param info: a chdir_info, skipped_mount_info, file_info or
+                     cached_info object (anything else is not part of
+                     the digests)
+        """
+        if isinstance(info, chdir_info):
+            self.directory(info.cmd,
+                           escape_filename(os.path.normpath(info.dir_name)))
+        elif isinstance(info, skipped_mount_info):
+            self.skipped_mount(
+                escape_filename(os.path.normpath(info.dir_name)))
+        elif isinstance(info, (file_info, cached_info)):
+            info.output(self, None, None)
+    def finish(self):
+        """output the digests of the directories still open, at the end
+        of the snapshot"""
+        while self.open_dirs:
+            self._close()
+
+# When profiling, each thread or process records the time it spends in
+# each stage of processing, as well as how full its queues are. At the
+# end of the run the results are sent back to the main thread and
+# combined into a single report, so that we can see whether we are
+# limited by walking directories, hashing, or writing output.
+#
+# Stages whose name ends in "_get" or "_put" are time spent waiting on
+# a queue, and count as idle time for the task.
+
+# use the most precise timer available
+profile_timer = getattr(time, 'perf_counter', time.time)
+
+def latency_bucket(elapsed):
+    """Return the histogram bucket for a latency
+
+    :param elapsed: the latency, in seconds
+
+    Buckets are powers of two, in microseconds, and each holds the
+    latencies up to that value.
+    """
+    usec = elapsed * 1000000
+    if usec <= 1:
+        return 1
+    return 2 ** math.frexp(usec)[1]
+
+def queue_depth(q):
+    """Return the number of items in a queue, or None if we can't tell
+
+    :param q: a Queue.Queue or multiprocessing.Queue
+
+    multiprocessing.Queue.qsize() is not implemented on all systems
+    (for example Mac OS X).
+    """
+    try:
+        return q.qsize()
+    except NotImplementedError:
+        return None
+
+class profile_stats:
+    """profile_stats records the time spent in each stage of processing
+    by a single thread or process, for the --profile report"""
+    def __init__(self, name):
+        """initialize the statistics
+
+        :param name: the name of the thread or process
+        """
+        self.name = name
+        self.stages = { }
+        self.queues = { }
+        self.start_time = profile_timer()
+    def record(self, stage, elapsed):
+        """record the time taken by one operation
+
+        :param stage: the name of the stage
+        :param elapsed: the time taken, in seconds
+        """
+        info = self.stages.get(stage)
+        if info is None:
+            info = { 'count': 0, 'time': 0.0, 'max': 0.0, 'histogram': { } }
+            self.stages[stage] = info
+        info['count'] += 1
+        info['time'] += elapsed
+        if elapsed > info['max']:
+            info['max'] = elapsed
+        bucket = latency_bucket(elapsed)
+        info['histogram'][bucket] = info['histogram'].get(bucket, 0) + 1
+    def sample_queue(self, name, depth):
+        """record the number of items waiting in a queue
+
+        :param name: the name of the queue
+        :param depth: the number of items, or None if unknown
+        """
+        if depth is None:
+            return
+        info = self.queues.get(name)
+        if info is None:
+            info = { 'samples': 0, 'total': 0, 'max': 0 }
+            self.queues[name] = info
+        info['samples'] += 1
+        info['total'] += depth
+        if depth > info['max']:
+            info['max'] = depth
+    def data(self):
+        """return the statistics as a dictionary, suitable for sending
+        over a queue and for converting to JSON"""
+        return { 'name': self.name,
+                 'run_time': profile_timer() - self.start_time,
+                 'stages': self.stages,
+                 'queues': self.queues, }
+
+def profile_report(profiles):
+    """combine the statistics from all threads and processes
+
+    :param profiles: a list of dictionaries from profile_stats.data()
+
+    Returns a dictionary with the totals for each stage and queue, as
+    well as the busy and idle time of each thread or process.
+    """
+    stages = { }
+    queues = { }
+    tasks = [ ]
+    for profile in profiles:
+        idle = 0.0
+        for (stage, info) in profile['stages'].items():
+            total = stages.setdefault(stage, { 'count': 0, 'time': 0.0,
+                                               'max': 0.0, 'histogram': { } })
+            total['count'] += info['count']
+            total['time'] += info['time']
+            total['max'] = max(total['max'], info['max'])
+            for (bucket, count) in info['histogram'].items():
+                total['histogram'][bucket] = \
+                    total['histogram'].get(bucket, 0) + count
+            if stage.endswith('_get') or stage.endswith('_put'):
+                idle += info['time']
+        for (name, info) in profile['queues'].items():
+            total = queues.setdefault(name, { 'samples': 0, 'total': 0,
+                                              'max': 0 })
+            total['samples'] += info['samples']
+            total['total'] += info['total']
+            total['max'] = max(total['max'], info['max'])
+        run_time = profile['run_time']
+        busy = max(run_time - idle, 0.0)
+        if run_time > 0:
+            busy_ratio = busy / run_time
+        else:
+            busy_ratio = 0.0
+        tasks.append({ 'name': profile['name'], 'run_time': run_time,
+                       'busy': busy, 'idle': idle,
+                       'busy_ratio': busy_ratio, })
+    for info in stages.values():
+        info['mean'] = info['time'] / info['count']
+    for info in queues.values():
+        info['mean'] = info['total'] / info['samples']
+    return { 'fileinfo_version': FILEINFO_VERSION,
+             'stages': stages,
+             'queues': queues,
+             'tasks': tasks, }
+
+# A long run can record its progress in a checkpoint file, so that if
+# it is interrupted it can be resumed rather than started again. The
+# checkpoint is taken after the output for a directory is complete, and
+# records:
+#
+# * the directory, as the index of the top directory on the command
+#   line and the names of the directories below it
+# * the inodes already output that have hard links, the only ones
+#   that can be seen again (the inode cache)
+# * the last stat output, since the next file is output relative to it
+# * the size of the output file at that point
+#
+# Since directories are walked in sorted order, everything up to that
+# directory can be skipped on resume without reading it again, except
+# for the directories containing it.
+
+# the stat fields needed to output a file relative to a previous one
+CHECKPOINT_STAT_FIELDS = ('st_mode', 'st_ino', 'st_nlink', 'st_uid', 'st_gid',
+                          'st_size', 'st_atime', 'st_ctime', 'st_mtime',
+                          'st_atime_ns', 'st_ctime_ns', 'st_mtime_ns',
+                          'st_rdev', 'st_flags')
+
+class saved_stat:
+    """saved_stat holds the fields of a stat result that was restored
+    from a checkpoint"""
+    def __init__(self, fields):
+        """initialize the stat
+
+        :param fields: a dictionary of field names and values
+        """
+        for (name, value) in fields.items():
+            setattr(self, str(name), value)
+
+def stat_to_dict(st):
+    """Return the fields of a stat result needed for output as a dictionary
+
+    :param st: the value returned by os.lstat(), or None
+    """
+    if st is None:
+        return None
+    fields = { }
+    for name in CHECKPOINT_STAT_FIELDS:
+        if hasattr(st, name):
+            fields[name] = getattr(st, name)
+    return fields
+
+def write_checkpoint(checkpoint_name, state):
+    """Write a checkpoint file
+
+    :param checkpoint_name: the name of the checkpoint file
+    :param state: a dictionary with the checkpoint contents
+
+    The checkpoint is written to a temporary file which is renamed,
+    so that we never leave a partially written checkpoint.
+    """
+    tmp_name = checkpoint_name + ".tmp"
+    f = open(tmp_name, 'w')
+    try:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(tmp_name, checkpoint_name)
+
+def read_checkpoint(checkpoint_name):
+    """Read a checkpoint file, returning the state as a dictionary
+
+    :param checkpoint_name: the name of the checkpoint file
+    """
+    f = open(checkpoint_name, 'r')
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+class checkpoint_info:
+    """checkpoint_info is used to record a checkpoint once all of the
+    output before it has been written"""
+    def __init__(self, checkpoint_name, state):
+        """initialize the checkpoint
+
+        :param checkpoint_name: the name of the checkpoint file
+        :param state: a dictionary with the walk position and inode cache
+        """
+        self.checkpoint_name = checkpoint_name
+        self.state = state
+    def output(self, out, err, prev_stat):
+        """write the checkpoint file
+
+        :param out: a WriterWithSize for a real file
+        :param err: a file-like object for errors (NOT USED)
+        :param prev_stat: the last stat object output
+
+        The output is flushed to disk first, so the checkpoint never
+        refers to output that may be lost.
+        """
+        out.flush()
+        fd = out.f.fileno()
+        os.fsync(fd)
+        state = dict(self.state)
+        state['offset'] = os.lseek(fd, 0, os.SEEK_CUR)
+        state['last_stat'] = stat_to_dict(prev_stat)
+        write_checkpoint(self.checkpoint_name, state)
+        return prev_stat
+
+def relative_components(top, dir_name):
+    """Return the names of the directories from top down to dir_name
+
+    :param top: a directory given on the command line
+    :param dir_name: a directory below it, as returned by os.walk()
+    """
+    rel = os.path.relpath(dir_name, top)
+    if rel == os.curdir:
+        return [ ]
+    return rel.split(os.sep)
+
+# A snapshot can be split into shards, each written by a separate run
+# (perhaps on separate machines), and then merged by merge_shards.py
+# into exactly what a single run would have written. The work is split
+# into units: the entries of each top directory is one unit, and the
+# tree below each of its subdirectories another. The units are numbered
+# in the order a single run outputs them, and given to the shards in
+# turn. Each unit starts with a marker line, so they can be merged.
+
+def shard_owns(unit, shard):
+    """Determine whether a unit of work belongs to a shard
+
+    :param unit: the number of the unit
+    :param shard: the shard, as a tuple of (index, count)
+    """
+    (index, count) = shard
+    return (unit % count) == index
+
+def shard_subtrees(dirs, root_unit, shard):
+    """Number the subtrees of a top directory, and keep our shard's
+
+    :param dirs: the subdirectories of the top directory, which are
+                 pruned to those in the shard
+    :param root_unit: the number of the unit of the top directory
+    :param shard: the shard, as a tuple of (index, count)
+
+    Returns a tuple of (dictionary of the unit of each subdirectory
+    kept, number of the next unit after these).
+    """
+    units = { }
+    for (n, name) in enumerate(dirs):
+        if shard_owns(root_unit + 1 + n, shard):
+            units[name] = root_unit + 1 + n
+    next_unit = root_unit + 1 + len(dirs)
+    dirs[:] = [ name for name in dirs if name in units ]
+    return (units, next_unit)
+
+def already_output(components, dirs, resume_path):
+    """Determine whether a directory was output before a checkpoint
+
+    :param components: the directory, from relative_components()
+    :param dirs: the subdirectories, which may be pruned
+    :param resume_path: the directory of the checkpoint
+
+    The directory of the checkpoint and the directories containing it
+    have already been output. For the containing directories, we also
+    remove the subdirectories which sort before the one we are heading
+    to from dirs, since they were output too.
+    """
+    if components != resume_path[:len(components)]:
+        return False
+    if len(components) < len(resume_path):
+        next_name = resume_path[len(components)]
+        dirs[:] = [ name for name in dirs if name >= next_name ]
+    return True
+
+# Include and exclude rules use the same syntax as .gitignore files:
+#
+# * A pattern without a slash matches a file or directory name at any
+#   level, and a pattern with a slash matches the path relative to the
+#   directory being reported (a leading slash is ignored)
+# * A pattern ending in a slash only matches directories
+# * "*" and "?" match anything but a slash, "[...]" matches one of a
+#   set of characters, and "**" matches across directories
+# * The last rule that matches a name decides whether it is included
+#
+# Excluded directories are not descended into at all, so a file in an
+# excluded directory cannot be included again (as with git).
+
+def rule_regex(pattern):
+    """Translate a gitignore-style pattern into a regular expression
+
+    :param pattern: the pattern, for example "*.o" or "/build/"
+
+    Returns a tuple of (regular expression string, directories only).
+    The regular expression matches a path relative to the top
+    directory, with "/" separating the names.
+    """
+    dirs_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+    regex = [ ]
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            regex.append('(?:.*/)?')
+            i = i + 3
+        elif pattern.startswith('**', i):
+            regex.append('.*')
+            i = i + 2
+        elif c == '*':
+            regex.append('[^/]*')
+            i = i + 1
+        elif c == '?':
+            regex.append('[^/]')
+            i = i + 1
+        elif c == '[':
+            # a "]" right after the "[" (or "[!") is part of the set
+            start = i + 1
+            if pattern.startswith('!', start):
+                start = start + 1
+            end = pattern.find(']', start + 1)
+            if end < 0:
+                regex.append(re.escape(c))
+                i = i + 1
+            else:
+                chars = pattern[i+1:end].replace('\\', '\\\\')
+                if chars.startswith('!'):
+                    chars = '^' + chars[1:]
+                regex.append('[' + chars + ']')
+                i = end + 1
+        elif (c == '\\') and (i + 1 < len(pattern)):
+            regex.append(re.escape(pattern[i+1]))
+            i = i + 2
+        else:
+            regex.append(re.escape(c))
+            i = i + 1
+    if not anchored:
+        regex.insert(0, '(?:.*/)?')
+    return (''.join(regex), dirs_only)
+
+def read_rules_file(rules_file_name):
+    """Read include and exclude rules from a file like .gitignore
+
+    :param rules_file_name: the name of the file
+
+    Each line is a pattern to exclude, or to include if it starts with
+    "!". Blank lines and lines starting with "#" are ignored, and a
+    backslash at the start allows a pattern to start with "!" or "#".
+    Returns a list of (action, pattern) tuples.
+    """
+    rules = [ ]
+    for line in read_file(rules_file_name).splitlines():
+        if (line.strip() == '') or line.startswith('#'):
+            continue
+        if line.startswith('!'):
+            rules.append(('include', line[1:]))
+        elif line.startswith('\\'):
+            rules.append(('exclude', line[1:]))
+        else:
+            rules.append(('exclude', line))
+    return rules
+
+# the most rules combined into one regular expression (see path_rules)
+RULES_PER_REGEX = 90
+
+class path_rules:
+    """path_rules decides which files and directories are reported,
+    using include and exclude rules compiled once at the start.
+
+    The rules for directories and for other files are each combined
+    into a few regular expressions, with the last rule first so that
+    the first alternative to match is the rule that decides.
+    """
+    def __init__(self, rules):
+        """compile the rules
+
+        :param rules: a list of (action, pattern) tuples, where the
+                      action is "include" or "exclude"
+        """
+        self.rules = [ (action, pattern) for (action, pattern) in rules ]
+        dir_regexes = [ ]
+        dir_actions = [ ]
+        file_regexes = [ ]
+        file_actions = [ ]
+        for (action, pattern) in reversed(self.rules):
+            (regex, dirs_only) = rule_regex(pattern)
+            dir_regexes.append(regex)
+            dir_actions.append(action == 'include')
+            if not dirs_only:
+                file_regexes.append(regex)
+                file_actions.append(action == 'include')
+        self.dir_matcher = self._compile(dir_regexes, dir_actions)
+        self.file_matcher = self._compile(file_regexes, file_actions)
+    def _compile(self, regexes, actions):
+        # each alternative is the only capturing group in its pattern,
+        # so the index of the last group matched identifies the rule;
+        # Python before 3.5 allows at most 100 groups in a pattern, so
+        # the rules are split into several patterns, tried in order
+        chunks = [ ]
+        for start in range(0, len(regexes), RULES_PER_REGEX):
+            regex = '|'.join([ '(%s)' % r for r in
+                               regexes[start:start + RULES_PER_REGEX] ])
+            chunks.append((re.compile('(?:%s)\\Z' % regex, re.DOTALL),
+                           actions[start:start + RULES_PER_REGEX]))
+        return chunks
+    def included(self, rel_path, is_dir):
+        """determine whether a file or directory is reported
+
+        :param rel_path: the path relative to the top directory, using
+                         "/" to separate names
+        :param is_dir: True if the path is a directory
+        """
+        if is_dir:
+            matcher = self.dir_matcher
+        else:
+            matcher = self.file_matcher
+        for (regex, actions) in matcher:
+            m = regex.match(rel_path)
+            if m is not None:
+                return actions[m.lastindex - 1]
+        return True
+    def filter(self, components, names, is_dir):
+        """return the names in a directory that are reported
+
+        :param components: the directory, from relative_components()
+        :param names: the names of files or subdirectories in it
+        :param is_dir: True if the names are subdirectories
+        """
+        prefix = ''.join([ c + '/' for c in components ])
+        return [ name for name in names
+                 if self.included(prefix + name, is_dir) ]
+    def header_lines(self):
+        """return the lines recording the rules in the output header"""
+        return [ '%%%s %s\n' % (action, escape_filename(pattern))
+                 for (action, pattern) in self.rules ]
+
+def serializer(q_serializer, num_checksum, outfile, q_profile=None,
+               last_stat=None, digests=False, bytes_read=None,
+               byte_limit=None):
     """insure results from all threads/processes get output in the correct order
 
     :param q_serializer: a Queue (Queue.Queue for threads,
                          multiprocessing.Queue for multiple processes)
     :param num_checksum: the total number of checksum tasks running (at least 1)
     :param outfile: a WriterWithSize for the file to write output to
+    :param q_profile: a Queue to send profile statistics to, if profiling
+    :param last_stat: the last stat output, if resuming from a checkpoint
+    :param digests: True to output the digest of each directory (see
+                    directory_digests)
+    :param bytes_read: the counter of bytes hashed, shared with the
+                       checksum tasks
+    :param byte_limit: an optional token_bucket limiting the rate at
+                       which bytes are read (shared with the checksum
+                       tasks)
 
     This is expected to be run as a thread / multiprocess.
 
@@ -666,10 +1549,27 @@ def serializer(q_serializer, num_checksum, outfile):
     finished_checksum_count = 0
     next_number = 0
     result_buffer = { }
+    # hashes of files with shared extents (see shared_extent_key())
+    shared_hashes = { }
+    if digests:
+        dir_digests = directory_digests(outfile)
+    else:
+        dir_digests = None
+
+    if q_profile is None:
+        profile = None
+    else:
+        profile = profile_stats('serializer')
 
-    last_stat = None
     while True:
-        info = q_serializer.get()
+        if profile is None:
+            info = q_serializer.get()
+        else:
+            profile.sample_queue('serializer', queue_depth(q_serializer))
+            profile.sample_queue('result_buffer', len(result_buffer))
+            start = profile_timer()
+            info = q_serializer.get()
+            profile.record('serializer_get', profile_timer() - start)
 
         # When a checksum generator finishes, it passes None on 
         # to the serializer.
@@ -693,24 +1593,335 @@ def serializer(q_serializer, num_checksum, outfile):
             # pull the information out of the buffer
             result = result_buffer[next_number]
             del result_buffer[next_number]
-            last_stat = result.output(outfile, sys.stderr, last_stat)
+            if isinstance(result, file_info):
+                # a clone whose hash cannot be reused is hashed here
+                result.share_hash(shared_hashes, bytes_read, byte_limit)
+            if dir_digests is not None:
+                dir_digests.add(result)
+            if profile is None:
+                last_stat = result.output(outfile, sys.stderr, last_stat)
+            else:
+                start = profile_timer()
+                last_stat = result.output(outfile, sys.stderr, last_stat)
+                profile.record('output', profile_timer() - start)
             next_number = next_number + 1
 
+    if dir_digests is not None:
+        dir_digests.finish()
     # we need to explicitly flush before exit due to multiprocessing usage
     outfile.flush()
 
+    if profile is not None:
+        q_profile.put(profile.data())
+
     # send the size of data if we recorded it
     q_serializer.put(outfile.size)
 
-def get_checksum(chksum_file):
+# default size and number of the blocks hashed by --sample
+SAMPLE_SIZE = 65536
+SAMPLE_COUNT = 8
+
+def sample_ranges(size, sample):
+    """Return the parts of a file that are hashed for a fingerprint
+
+    :param size: the size of the file
+    :param sample: a tuple of (block size, number of blocks)
+
+    Returns a list of (offset, length) tuples. The blocks are evenly
+    spaced, with the first at the start of the file and the last at
+    the end, unless the file is small enough to hash completely.
+    """
+    (block_size, count) = sample
+    if size <= block_size * count:
+        return [ (0, size) ]
+    last = size - block_size
+    return [ (last * n // (count - 1), block_size) for n in range(count) ]
+
+def sample_arg(value):
+    """convert a --sample-count or --sample-size argument"""
+    n = int(value)
+    if n < 2:
+        raise ValueError("%d is too small" % n)
+    return n
+
+# zeros to hash for the holes in sparse files, rather than reading them
+ZERO_BLOCK = bytes(bytearray(65536))
+
+def is_sparse(st):
+    """Determine whether a file may have holes, from its stat
+
+    :param st: the value returned by os.lstat() for the file
+
+    A file with fewer blocks allocated than it needs for its size has
+    holes (or is compressed by the file system). st_blocks is always in
+    512-byte units.
+    """
+    if not hasattr(os, 'SEEK_DATA'):
+        return False
+    return getattr(st, 'st_blocks', None) is not None and \
+           (st.st_blocks * 512 < st.st_size)
+
+def data_extents(fd, size):
+    """Return the parts of a file that have data, skipping any holes
+
+    :param fd: a file descriptor of the file
+    :param size: the size of the file
+
+    Returns a list of (offset, length) tuples, or None if the file
+    system (or this version of Python) cannot tell us where the holes
+    are. Holes read as zeros.
+    """
+    seek_data = getattr(os, 'SEEK_DATA', None)
+    seek_hole = getattr(os, 'SEEK_HOLE', None)
+    if (seek_data is None) or (seek_hole is None):
+        return None
+    extents = [ ]
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                data = os.lseek(fd, offset, seek_data)
+            except OSError as e:
+                # there is no more data, just a hole to the end
+                if e.errno == errno.ENXIO:
+                    break
+                raise
+            if data >= size:
+                break
+            hole = min(os.lseek(fd, data, seek_hole), size)
+            extents.append((data, hole - data))
+            offset = hole
+    except OSError:
+        return None
+    return extents
+
+def hash_zeros(h, length, bytes_read=None):
+    """add zeros to a hash, as for the holes of a sparse file
+
+    :param h: a hashlib object
+    :param length: the number of zero bytes
+    :param bytes_read: an optional counter to add the bytes to
+    """
+    remaining = length
+    while remaining >= len(ZERO_BLOCK):
+        h.update(ZERO_BLOCK)
+        remaining = remaining - len(ZERO_BLOCK)
+    if remaining > 0:
+        h.update(ZERO_BLOCK[:remaining])
+    add_bytes_read(bytes_read, length)
+
+# the bytes read from a file are added to the shared count this many at
+# a time, since with processes each addition takes a lock shared
+# between processes
+BYTES_READ_BATCH = 4 * 1024 * 1024
+
+def add_bytes_read(bytes_read, count):
+    """add to the count of bytes hashed
+
+    :param bytes_read: a LocalCounter or multiprocessing.Value, or None
+    :param count: the number of bytes to add
+    """
+    if (bytes_read is not None) and (count > 0):
+        with bytes_read.get_lock():
+            bytes_read.value += count
+
+# On Linux, the kernel can calculate the hash itself (with an AF_ALG
+# socket), and os.sendfile() can send it the file contents, so the
+# data never needs to be copied into Python and then into hashlib.
+# This is only used if asked for with --kernel-hash, and if it is not
+# available for any reason we use hashlib.
+
+# True to hash in the kernel where possible (see set_kernel_hash())
+kernel_hash = False
+# socket bound to the kernel sha224, or False if there is none
+kernel_hash_socket = None
+# files smaller than this are not worth the extra system calls
+KERNEL_HASH_MIN = 65536
+# the most that Linux sends in one call to sendfile()
+SENDFILE_MAX = 0x7ffff000
+
+def set_kernel_hash(enabled):
+    """choose whether to hash files in the kernel
+
+    :param enabled: True to hash in the kernel when it is available
+
+    Returns True if the kernel can hash files here.
+    """
+    global kernel_hash
+    kernel_hash = enabled
+    return kernel_hasher() is not None
+
+def kernel_hasher():
+    """return a socket bound to the kernel sha224, or None
+
+    The socket is created the first time, and then shared by all of the
+    threads in the process. Each file is hashed with its own socket,
+    accepted from this one.
+    """
+    global kernel_hash_socket
+    if kernel_hash_socket is None:
+        try:
+            s = socket.socket(socket.AF_ALG, socket.SOCK_SEQPACKET)
+            try:
+                s.bind(('hash', 'sha224'))
+            except:
+                s.close()
+                raise
+            kernel_hash_socket = s
+        except (AttributeError, socket.error, OSError):
+            # no AF_ALG (old Python, or not Linux), or no sha224
+            kernel_hash_socket = False
+    return kernel_hash_socket or None
+
+def kernel_digest(fd, size):
+    """calculate the SHA224 digest of a file in the kernel
+
+    :param fd: a file descriptor of the file
+    :param size: the size of the file
+
+    Returns the digest, or None if the kernel could not hash the file
+    (in which case it should be read and hashed as usual). Files larger
+    than SENDFILE_MAX cannot be hashed in the kernel.
+    """
+    hasher = kernel_hasher()
+    if (hasher is None) or (not hasattr(os, 'sendfile')) or \
+       (size > SENDFILE_MAX):
+        return None
+    try:
+        op = hasher.accept()[0]
+        try:
+            # the hash is finished at the end of each call, so the
+            # whole file must be sent at once
+            if os.sendfile(op.fileno(), fd, 0, size) != size:
+                return None
+            return op.recv(hashlib.sha224().digest_size)
+        finally:
+            op.close()
+    except (socket.error, OSError):
+        return None
+
+# On file systems with copy-on-write clones ("reflinks"), such as btrfs
+# and XFS, a copied file may share all of its data with the original,
+# so it is certain to have the same contents. With --shared-extents we
+# get the physical location of each part of a large file with the
+# FIEMAP ioctl(), and a file with only shared parts, in exactly the
+# same places as an earlier file of the same size, gets the hash of
+# that file without being read.
+#
+# Locations are only compared within a device, since two file systems
+# can use the same locations for different data. (Each btrfs subvolume
+# has its own device number, so clones are not found across them.)
+
+# This is defined in <linux/fs.h>, and negative for pypy as above
+FS_IOC_FIEMAP = -1071618549   # 0xC020660B
+# struct fiemap and struct fiemap_extent from <linux/fiemap.h>
+FIEMAP_HEADER = struct.Struct('=QQLLLL')
+FIEMAP_EXTENT = struct.Struct('=QQQQQLLLL')
+FIEMAP_MAX_OFFSET = 0xffffffffffffffff
+# write out the file's dirty data first, so that an extent that is no
+# longer shared is not reported as it was
+FIEMAP_FLAG_SYNC = 0x0001
+FIEMAP_EXTENT_LAST = 0x0001
+FIEMAP_EXTENT_SHARED = 0x2000
+# extents whose location is not known, or not only theirs
+FIEMAP_EXTENT_NOT_UNIQUE = 0x0002 | 0x0004 | 0x0008 | 0x0100 | 0x0200 | 0x0400
+# the number of extents asked for in each ioctl()
+FIEMAP_BATCH = 256
+# smaller files are usually not worth the extra system calls
+SHARED_EXTENT_MIN = 65536
+
+def file_extents(fd):
+    """return the extents of a file (Linux-only)
+
+    :param fd: a file descriptor of the file
+
+    Returns a list of (logical offset, physical offset, length, flags)
+    tuples, or None if the file system cannot report them.
+    """
+    if platform.system() != 'Linux':
+        return None
+    extents = [ ]
+    start = 0
+    while True:
+        buf = bytearray(FIEMAP_HEADER.size +
+                        FIEMAP_BATCH * FIEMAP_EXTENT.size)
+        FIEMAP_HEADER.pack_into(buf, 0, start, FIEMAP_MAX_OFFSET - start,
+                                FIEMAP_FLAG_SYNC, 0, FIEMAP_BATCH, 0)
+        try:
+            fcntl.ioctl(fd, FS_IOC_FIEMAP, buf, True)
+        except (IOError, OSError):
+            return None
+        mapped = FIEMAP_HEADER.unpack_from(buf, 0)[3]
+        if mapped == 0:
+            return extents
+        for n in range(mapped):
+            fields = FIEMAP_EXTENT.unpack_from(buf, FIEMAP_HEADER.size +
+                                                    n * FIEMAP_EXTENT.size)
+            (logical, physical, length, flags) = (fields[0], fields[1],
+                                                  fields[2], fields[5])
+            extents.append((logical, physical, length, flags))
+            if flags & FIEMAP_EXTENT_LAST:
+                return extents
+        start = logical + length
+
+def shared_extent_key(full_path, st):
+    """return a key identifying the data of a file with shared extents
+
+    :param full_path: the path to the file
+    :param st: the value returned by os.lstat() for the file
+
+    Two files with the same key have the same contents. The key is the
+    device, size, and a digest of the extents, or None if the file
+    does not consist only of extents shared with other files.
+    """
+    if st.st_size < SHARED_EXTENT_MIN:
+        return None
+    try:
+        fd = os.open(full_path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        extents = file_extents(fd)
+    finally:
+        os.close(fd)
+    if not extents:
+        return None
+    h = hashlib.sha224()
+    for (logical, physical, length, flags) in extents:
+        if (not (flags & FIEMAP_EXTENT_SHARED)) or \
+           (flags & FIEMAP_EXTENT_NOT_UNIQUE):
+            return None
+        h.update(("%d %d %d\n" % (logical, physical, length)).encode())
+    return (st.st_dev, st.st_size, h.digest())
+
+def get_checksum(chksum_file, bytes_read=None, byte_limit=None):
     """calculate a SHA224 hash as a checksum for the given file_info object
 
     :param chksum_file: a file_info object
+    :param bytes_read: an optional counter (LocalCounter or
+                       multiprocessing.Value) to add the bytes read to
+    :param byte_limit: an optional token_bucket limiting the rate at
+                       which bytes are read
 
     The file named by the file_info object is opened, read, and a
     SHA224 hash generated for the file contents. The result is stored
     in the object, and the ojbect itself is returned.
+
+    The counter is updated every BYTES_READ_BATCH bytes, so that
+    progress can be reported while large files are being hashed.
+
+    If the file_info object has sample parameters, then a sampled
+    fingerprint is calculated instead (see sample_ranges()).
+
+    Only the data of sparse files is read, and the holes are hashed as
+    the zeros they would read as, so the hash is the same but the time
+    taken depends on the amount of data rather than the size.
+
+    If kernel hashing is on, then the kernel hashes other large files
+    (see kernel_digest()), unless the rate of reading is limited.
     """
+    # the bytes read that are not yet added to bytes_read
+    counted = 0
     try:
         h = hashlib.sha224()
         # open with O_NOATIME so calculating checksum doesn't
@@ -726,56 +1937,376 @@ def get_checksum(chksum_file):
             if e.errno != errno.EPERM: raise
             fd = os.open(chksum_file.full_path, os.O_RDONLY)
         f = os.fdopen(fd, 'rb')
-        while True:
-            s = f.read(getattr(chksum_file.stat, 'st_blksize', 8192))
-            if len(s) == 0: break
-            h.update(s)
+        holes = False
+        if chksum_file.sample is None:
+            ranges = None
+            size = chksum_file.stat.st_size
+            if is_sparse(chksum_file.stat):
+                ranges = data_extents(fd, size)
+                holes = ranges is not None
+            # the kernel reads the whole file at once, so it is not used
+            # while the rate of reading is limited
+            if (ranges is None) and kernel_hash and \
+               (size >= KERNEL_HASH_MIN) and \
+               ((byte_limit is None) or (byte_limit.rate() <= 0)):
+                digest = kernel_digest(fd, size)
+                if digest is not None:
+                    f.close()
+                    # the file is only charged to the limit once it has
+                    # been hashed, since otherwise it is read below (in
+                    # case a limit was set since)
+                    if byte_limit is not None:
+                        byte_limit.take(size)
+                    add_bytes_read(bytes_read, size)
+                    chksum_file.set_hash(base64.b64encode(digest).decode())
+                    return chksum_file
+            if ranges is None:
+                ranges = [ (0, None) ]
+        else:
+            size = chksum_file.stat.st_size
+            h.update(("%d\n" % size).encode())
+            ranges = sample_ranges(size, chksum_file.sample)
+        block_size = getattr(chksum_file.stat, 'st_blksize', 8192)
+        pos = 0
+        for (offset, length) in ranges:
+            if holes:
+                hash_zeros(h, offset - pos)
+                counted = counted + offset - pos
+            f.seek(offset)
+            pos = offset
+            while length != 0:
+                if length is None:
+                    s = f.read(block_size)
+                else:
+                    s = f.read(min(length, block_size))
+                    length = length - len(s)
+                if len(s) == 0: break
+                if byte_limit is not None:
+                    byte_limit.take(len(s))
+                h.update(s)
+                pos = pos + len(s)
+                counted = counted + len(s)
+                if counted >= BYTES_READ_BATCH:
+                    add_bytes_read(bytes_read, counted)
+                    counted = 0
+        if holes:
+            hash_zeros(h, size - pos)
+            counted = counted + size - pos
         f.close()
         chksum_file.set_hash(base64.b64encode(h.digest()).decode())
     except Exception as e:
         chksum_file.set_hashing_error(e)
+    add_bytes_read(bytes_read, counted)
     return chksum_file
             
-def checksum_generator(q_in, q_out):
+def wait_until_active(active, index):
+    """wait until a hashing task is allowed to work
+
+    :param active: a counter with the number of tasks that may work,
+                   or None if all of them may
+    :param index: the number of this task, starting at 0
+    """
+    if active is None:
+        return
+    while active.value <= index:
+        time.sleep(AUTO_IDLE_SLEEP)
+
+def checksum_generator(q_in, q_out, bytes_read=None, q_profile=None,
+                       name='checksum', active=None, index=0, kernel=False,
+                       byte_limit=None):
     """generate checksums for files
 
     :param q_in: a Queue (Queue.Queue for threads,
                           multiprocessing.Queue for multiple processes)
     :param q_out: a Queue (Queue.Queue for threads,
                            multiprocessing.Queue for multiple processes)
+    :param bytes_read: an optional counter of bytes hashed (LocalCounter
+                       for threads, multiprocessing.Value for multiple
+                       processes)
+    :param q_profile: a Queue to send profile statistics to, if profiling
+    :param name: the name of this task in the profile report
+    :param active: a counter with the number of tasks that may work, if
+                   the number is being tuned automatically (see
+                   pool_tuner())
+    :param index: the number of this task, starting at 0
+    :param kernel: True to hash in the kernel where possible (see
+                   set_kernel_hash())
+    :param byte_limit: an optional token_bucket limiting the rate at
+                       which bytes are read (shared by all of the tasks)
 
     Collects info objects from the q_in queue, calculates the checksum
     for them, and sends them to the q_out queue. Each info object
     arrives and is sent in a tuple of (order, info_file) (although this
     function sends the order value, it does not otherwise use it).
     """
+    # processes are not always forked, so set this here too
+    if kernel:
+        set_kernel_hash(kernel)
+    if q_profile is None:
+        while True:
+            wait_until_active(active, index)
+            info = q_in.get()
+            if info is None:
+                q_out.put(None)
+                return
+            (number, chksum_file) = info
+            q_out.put((number, get_checksum(chksum_file, bytes_read,
+                                            byte_limit)))
+
+    # the same loop, with each step timed
+    profile = profile_stats(name)
     while True:
+        start = profile_timer()
+        wait_until_active(active, index)
         info = q_in.get()
+        profile.record('checksum_get', profile_timer() - start)
         if info is None:
+            q_profile.put(profile.data())
             q_out.put(None)
             return
         (number, chksum_file) = info
-        q_out.put((number, get_checksum(chksum_file)))
+        start = profile_timer()
+        get_checksum(chksum_file, bytes_read, byte_limit)
+        profile.record('checksum', profile_timer() - start)
+        q_out.put((number, chksum_file))
+
+# When the number of cores is "auto", we start the maximum number of
+# hashing tasks that we might want, but only let a few of them work at
+# first. A tuner thread in the main process watches how fast bytes are
+# being hashed, and adds or removes one working task at a time,
+# reversing direction whenever the rate drops (hill-climbing). This
+# finds a good level of concurrency whether we are limited by CPU,
+# by a hard disk that slows down with many readers, or by an SSD that
+# speeds up with them.
+
+# seconds between adjustments of the number of working tasks
+AUTO_INTERVAL = 1.0
+# seconds an idle hashing task sleeps before checking if it may work
+AUTO_IDLE_SLEEP = 0.05
+# number of working tasks to start with
+AUTO_START = 2
+# how much the hashing rate must drop before we change direction
+AUTO_TOLERANCE = 0.05
+
+def cpu_max_limit(cpu_max):
+    """Return the number of CPUs allowed by a cgroup v2 cpu.max value
+
+    :param cpu_max: the contents of a cpu.max file, for example
+                    "200000 100000", or "max 100000" for no limit
+
+    Returns None if there is no limit.
+    """
+    fields = cpu_max.split()
+    if fields[0] == 'max':
+        return None
+    return quota_limit(int(fields[0]), int(fields[1]))
 
-class WriterWithSize:
-    """Wraps a file-like object, providing write() and flush() functions.
-    Keeps a counter of the number of characters written, accessible via
-    the "size" member variable.
+def quota_limit(quota, period):
+    """Return the number of CPUs allowed by a CPU quota
 
-    Note that if the underlying object is binary, write() expects bytes(),
-    and if it is text, write() expects str(). If a text file is used, then
-    the "size" parameter is a count of characters, not bytes."""
-    def __init__(self, f):
-        """create the WriterWithSize
+    :param quota: microseconds of CPU time allowed per period
+                  (negative for no limit)
+    :param period: length of the period, in microseconds
 
-        :param f: a file-like object
+    Returns None if there is no limit.
+    """
+    if (quota <= 0) or (period <= 0):
+        return None
+    return max(int(math.ceil(quota / float(period))), 1)
 
-        f need only implement the write() and flush() functions.
-        """
-        self.f = f
-        self.size = 0
-    def write(self, data):
-        """write the given string to the file-like object
+def read_file(name):
+    """Return the contents of a (small) file"""
+    f = open(name, 'r')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def cgroup_cpu_limit():
+    """Return the number of CPUs allowed by our cgroup, or None
+
+    Both cgroup v2 (cpu.max) and v1 (cpu.cfs_quota_us) are checked,
+    using the cgroup that this process is in.
+    """
+    try:
+        cgroups = read_file('/proc/self/cgroup').splitlines()
+    except (IOError, OSError):
+        return None
+    for line in cgroups:
+        fields = line.split(':', 2)
+        if len(fields) != 3:
+            continue
+        (hierarchy, controllers, path) = fields
+        try:
+            if hierarchy == '0' and controllers == '':
+                limit = cpu_max_limit(
+                    read_file('/sys/fs/cgroup' + path + '/cpu.max'))
+            elif 'cpu' in controllers.split(','):
+                cgroup_dir = '/sys/fs/cgroup/' + controllers + path
+                limit = quota_limit(
+                    int(read_file(cgroup_dir + '/cpu.cfs_quota_us')),
+                    int(read_file(cgroup_dir + '/cpu.cfs_period_us')))
+            else:
+                continue
+        except (IOError, OSError, ValueError, IndexError):
+            continue
+        if limit is not None:
+            return limit
+    return None
+
+def available_cpus():
+    """Return the number of CPUs we may use
+
+    This takes into account the CPUs this process is allowed to run on
+    and any cgroup CPU quota (for example in a container), not just the
+    number of CPUs in the system.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        ncpus = len(os.sched_getaffinity(0))
+    else:
+        ncpus = multiprocessing.cpu_count()
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        ncpus = min(ncpus, limit)
+    return max(ncpus, 1)
+
+def next_pool_size(active, max_active, direction, rate, last_rate):
+    """decide how many hashing tasks should work next (hill-climbing)
+
+    :param active: the number of tasks working now
+    :param max_active: the number of hashing tasks started
+    :param direction: 1 if we were adding tasks, -1 if removing them
+    :param rate: the hashing rate with the current number of tasks
+    :param last_rate: the hashing rate before the last change, or None
+
+    Returns a tuple of (number of tasks, direction).
+    """
+    if (last_rate is not None) and (rate < last_rate * (1 - AUTO_TOLERANCE)):
+        direction = -direction
+    new_active = active + direction
+    if (new_active < 1) or (new_active > max_active):
+        direction = -direction
+        new_active = active + direction
+    return (min(max(new_active, 1), max_active), direction)
+
+def pool_tuner(active, max_active, bytes_read, finished):
+    """adjust the number of working hashing tasks to maximize throughput
+
+    :param active: a counter with the number of tasks that may work
+    :param max_active: the number of hashing tasks started
+    :param bytes_read: the counter of bytes hashed
+    :param finished: a threading.Event, set when we should stop
+
+    This is expected to be run as a thread in the main process.
+    """
+    direction = 1
+    last_rate = None
+    last_bytes = bytes_read.value
+    last_time = time.time()
+    while not finished.is_set():
+        finished.wait(AUTO_INTERVAL)
+        if finished.is_set():
+            break
+        now = time.time()
+        now_bytes = bytes_read.value
+        rate = (now_bytes - last_bytes) / (now - last_time)
+        (last_bytes, last_time) = (now_bytes, now)
+        # if nothing is being hashed we learn nothing, so wait
+        if rate <= 0:
+            continue
+        (new_active, direction) = next_pool_size(active.value, max_active,
+                                                 direction, rate, last_rate)
+        last_rate = rate
+        with active.get_lock():
+            active.value = new_active
+
+def shard_arg(value):
+    """convert the --shard argument, "I/N", into a tuple of (I, N)"""
+    (index, count) = [ int(n) for n in value.split('/') ]
+    if (count < 1) or (index < 0) or (index >= count):
+        raise ValueError("shard %d/%d does not exist" % (index, count))
+    return (index, count)
+
+# most hashing tasks for which "--engine auto" uses threads
+ENGINE_MAX_THREADS = 4
+
+def choose_engine(engine, ncpus):
+    """decide whether to hash files in threads or processes
+
+    :param engine: "threads", "processes" or "auto", from the --engine
+                   option
+    :param ncpus: the number of hashing tasks (the most, if the number
+                  is tuned as we go)
+
+    Without the multiprocessing module, threads are used whatever was
+    asked for.
+
+    "auto" is a rule of thumb rather than a measurement: CPython
+    releases the GIL while reading and hashing, so a few threads hash
+    in parallel without passing every file between processes, but
+    with more of them the time each spends holding the GIL adds up, so
+    threads are used on CPython for up to ENGINE_MAX_THREADS tasks and
+    processes otherwise. (Other implementations may not release the
+    GIL while hashing.) benchmark.py shows which is faster on a given
+    system.
+    """
+    if use_threads:
+        return 'threads'
+    if engine != 'auto':
+        return engine
+    if (platform.python_implementation() == 'CPython') and \
+       (ncpus <= ENGINE_MAX_THREADS):
+        return 'threads'
+    return 'processes'
+
+def ncpus_arg(value):
+    """convert the --ncpus argument, which is a number or auto"""
+    if value == 'auto':
+        return value
+    return int(value)
+
+# multipliers for the suffixes allowed on rates
+RATE_SUFFIXES = { 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3 }
+
+def rate_arg(value):
+    """convert a rate, such as "20M", into a number per second"""
+    value = value.strip()
+    multiplier = RATE_SUFFIXES.get(value[-1:].upper())
+    if multiplier is None:
+        multiplier = 1
+    else:
+        value = value[:-1]
+    rate = float(value) * multiplier
+    if rate < 0:
+        raise ValueError("rate must not be negative")
+    return rate
+
+def rule_arg(action):
+    """return a function to convert a --exclude, --include, or
+    --exclude-from argument into an (action, pattern) tuple"""
+    def convert(value):
+        return (action, make_type_unicode(value))
+    return convert
+
+class WriterWithSize:
+    """Wraps a file-like object, providing write() and flush() functions.
+    Keeps a counter of the number of characters written, accessible via
+    the "size" member variable.
+
+    Note that if the underlying object is binary, write() expects bytes(),
+    and if it is text, write() expects str(). If a text file is used, then
+    the "size" parameter is a count of characters, not bytes."""
+    def __init__(self, f):
+        """create the WriterWithSize
+
+        :param f: a file-like object
+
+        f need only implement the write() and flush() functions.
+        """
+        self.f = f
+        self.size = 0
+    def write(self, data):
+        """write the given string to the file-like object
 
         :param data: a string
         """
@@ -785,6 +2316,260 @@ class WriterWithSize:
         """flush the underlying file-like object"""
         self.f.flush()
 
+class LocalCounter:
+    """A counter with the same interface as a multiprocessing.Value,
+    for use when all of the work is done in a single process.
+
+    The current count is in the "value" member variable, and must be
+    changed while holding the lock returned by get_lock()."""
+    def __init__(self):
+        """create the LocalCounter, starting at zero"""
+        self.value = 0
+        self.lock = threading.Lock()
+    def get_lock(self):
+        """return the lock protecting the value"""
+        return self.lock
+
+# To run on busy systems without getting in the way, the bytes read for
+# hashing and the directories and files looked at by the walk can be
+# limited to a rate (--max-read-rate and --max-file-rate). Each limit
+# is a token bucket, shared by all of the threads and processes doing
+# that work. A task takes tokens for what it did, and if that leaves
+# the bucket in debt, it sleeps until the debt would be paid back.
+# The rates can be changed while running, with a control file (see
+# rate_controller()).
+
+# seconds of work that can be done at once after being idle
+RATE_BURST = 1.0
+
+class token_bucket:
+    """token_bucket limits the rate of some operation, across threads
+    or processes."""
+    def __init__(self, rate=0, processes=False):
+        """create the token_bucket, starting full
+
+        :param rate: the amount allowed each second, or 0 for no limit
+        :param processes: True if the bucket is shared with other
+                          processes, rather than only threads
+        """
+        # the rate, tokens in the bucket, and the time it was filled
+        values = [ rate, rate * RATE_BURST, time.time() ]
+        if processes:
+            self.values = multiprocessing.Array('d', values)
+            self.lock = self.values.get_lock()
+        else:
+            self.values = values
+            self.lock = threading.Lock()
+    def rate(self):
+        """return the current rate, or 0 for no limit"""
+        return self.values[0]
+    def set_rate(self, rate):
+        """change the rate
+
+        :param rate: the amount allowed each second, or 0 for no limit
+        """
+        with self.lock:
+            if self.values[0] <= 0:
+                # there was no limit, so start full
+                self.values[1] = rate * RATE_BURST
+            else:
+                self.values[1] = min(self.values[1], rate * RATE_BURST)
+            self.values[0] = rate
+            self.values[2] = time.time()
+    def take(self, amount):
+        """take tokens for work done, waiting if there are too few
+
+        :param amount: the number of tokens, such as the bytes read
+        """
+        with self.lock:
+            rate = self.values[0]
+            if rate <= 0:
+                return
+            now = time.time()
+            tokens = self.values[1] + ((now - self.values[2]) * rate)
+            tokens = min(tokens, rate * RATE_BURST) - amount
+            self.values[1] = tokens
+            self.values[2] = now
+        if tokens < 0:
+            time.sleep(-tokens / rate)
+
+# seconds between checks of the rate control file for changes
+RATE_CONTROL_INTERVAL = 1.0
+
+def start_rate_controller(control_name, byte_limit, file_limit):
+    """start a rate_controller() thread, which also reads the control
+    file on SIGHUP
+
+    :param control_name: the name of the rate control file
+    :param byte_limit: the token_bucket for bytes read
+    :param file_limit: the token_bucket for files and directories
+
+    Returns a threading.Event to set to stop the thread.
+    """
+    reload = threading.Event()
+    finished = threading.Event()
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: reload.set())
+    task = threading.Thread(target=rate_controller,
+                            args=(control_name, byte_limit, file_limit,
+                                  reload, finished))
+    task.daemon = True
+    task.start()
+    return finished
+
+def read_rate_control(control_file):
+    """read the rates from a rate control file
+
+    :param control_file: a file-like object
+
+    Each line is "read-rate" or "file-rate" and a rate, as for the
+    --max-read-rate and --max-file-rate options. Blank lines and lines
+    starting with "#" are ignored. Returns a dictionary with the rates
+    given.
+    """
+    rates = { }
+    for line in control_file:
+        line = line.strip()
+        if (not line) or line.startswith('#'):
+            continue
+        (name, value) = line.split(None, 1)
+        if name not in ('read-rate', 'file-rate'):
+            raise ValueError("unknown rate '%s'" % name)
+        rates[name] = rate_arg(value)
+    return rates
+
+def rate_controller(control_name, byte_limit, file_limit, reload, finished):
+    """change the rate limits when the rate control file changes
+
+    :param control_name: the name of the rate control file
+    :param byte_limit: the token_bucket for bytes read
+    :param file_limit: the token_bucket for files and directories
+    :param reload: a threading.Event set to read the file immediately
+                   (as on SIGHUP)
+    :param finished: a threading.Event set when we should stop
+
+    This is expected to be run as a thread in the main process, which
+    checks the modification time of the file every
+    RATE_CONTROL_INTERVAL seconds. The buckets are shared, so a change
+    applies to all of the hashing tasks.
+    """
+    last_mtime = None
+    while not finished.is_set():
+        try:
+            mtime = os.stat(control_name).st_mtime
+        except OSError:
+            # no file means no changes
+            mtime = None
+        if reload.is_set() or (mtime != last_mtime):
+            reload.clear()
+            last_mtime = mtime
+            try:
+                control_file = open(control_name, 'r')
+                try:
+                    rates = read_rate_control(control_file)
+                finally:
+                    control_file.close()
+                if 'read-rate' in rates:
+                    byte_limit.set_rate(rates['read-rate'])
+                if 'file-rate' in rates:
+                    file_limit.set_rate(rates['file-rate'])
+            except (IOError, OSError, ValueError) as e:
+                # keep the current rates until the file is fixed
+                sys.stderr.write("Error reading rate control file: %s\n" %
+                                 (getattr(e, 'strerror', None) or str(e)))
+        reload.wait(RATE_CONTROL_INTERVAL)
+
+# On network file systems (NFS, CIFS, and the like), each lstat() waits
+# for a round trip to the server, so when they are called one after
+# another most of the time is spent waiting. With --stat-threads, the
+# names of each directory are given to a pool of threads which call
+# lstat() on them concurrently, a limited number ahead of the one being
+# output, and output_file() collects the results in order.
+
+# how many lstat() calls may be waiting for each thread
+STAT_PREFETCH_DEPTH = 2
+
+class stat_prefetcher:
+    """stat_prefetcher calls os.lstat() on the files of a directory in
+    a pool of threads, ahead of when the results are needed."""
+    def __init__(self, num_threads, limit=None):
+        """start the threads
+
+        :param num_threads: the number of lstat() calls to run at once
+        :param limit: an optional token_bucket limiting the rate of
+                      lstat() calls
+        """
+        self.limit = limit
+        self.window = num_threads * STAT_PREFETCH_DEPTH
+        # paths not yet given to the threads, in order
+        self.pending = collections.deque()
+        # paths given to the threads, but whose results are not collected
+        self.requested = set()
+        # (stat, exception) for each path which the threads finished
+        self.results = { }
+        self.cond = threading.Condition()
+        self.q_paths = Queue.Queue()
+        for n in range(num_threads):
+            task = threading.Thread(target=self._run)
+            task.daemon = True
+            task.start()
+    def _run(self):
+        while True:
+            path = self.q_paths.get()
+            if self.limit is not None:
+                self.limit.take(1)
+            try:
+                result = (os.lstat(path), None)
+            except OSError as e:
+                result = (None, e)
+            with self.cond:
+                # results for paths no longer wanted are dropped
+                if path in self.requested:
+                    self.results[path] = result
+                    self.cond.notify_all()
+    def _fill(self):
+        # called holding the condition
+        while self.pending and (len(self.requested) < self.window):
+            path = self.pending.popleft()
+            self.requested.add(path)
+            self.q_paths.put(path)
+    def prefetch(self, paths):
+        """start calling os.lstat() on a list of paths
+
+        :param paths: the paths, in the order they will be asked for
+
+        Any paths from an earlier call not yet asked for are forgotten.
+        """
+        with self.cond:
+            self.pending = collections.deque(paths)
+            self.requested.clear()
+            self.results.clear()
+            self._fill()
+    def lstat(self, path):
+        """return os.lstat() of a path, waiting for it if necessary
+
+        :param path: the path, which should be the next one prefetched
+
+        Raises the same exception as os.lstat() if that failed. Paths
+        that were not prefetched are simply passed to os.lstat(), under
+        the same limit but without holding up the threads.
+        """
+        with self.cond:
+            prefetched = path in self.requested
+        if not prefetched:
+            if self.limit is not None:
+                self.limit.take(1)
+            return os.lstat(path)
+        with self.cond:
+            while path not in self.results:
+                self.cond.wait()
+            (st, exception) = self.results.pop(path)
+            self.requested.discard(path)
+            self._fill()
+        if exception is not None:
+            raise exception
+        return st
+
 # In order to support both single-core and multi-core operation, we
 # use a class which hides the details of file information output.
 #
@@ -805,18 +2590,56 @@ class file_info_output_stream_base(object):
     """file_info_output_stream_base is an abstract class which defines
     the generic information and processes needed to output file
     information."""
-    def __init__(self, outfile):
+    def __init__(self, outfile, bytes_read=None, header=True,
+                 header_lines=( )):
         """initialize the file_info output stream
 
         :param outfile: a file descriptor to write to
+        :param bytes_read: a counter of bytes hashed (a LocalCounter is
+                           created if None)
+        :param header: False if we are appending to existing output, so
+                       the header has already been written
+        :param header_lines: lines to write after the version line, such
+                             as the include and exclude rules
         """
         self.outfile = WriterWithSize(outfile)
+        if bytes_read is None:
+            bytes_read = LocalCounter()
+        self.bytes_read = bytes_read
+        # total size of the regular files we have sent to be hashed
+        self.bytes_queued = 0
+        # a profile_stats object, if we are profiling
+        self.profile = None
+        # (block size, number of blocks) to fingerprint rather than hash
+        self.sample = None
+        # a stat_prefetcher, if lstat() is called in a thread pool
+        self.prefetcher = None
+        # token_bucket objects limiting the rate of reading files and
+        # of calling lstat(), if there are limits
+        self.byte_limit = None
+        self.file_limit = None
+        # True to reuse the hash of files with the same shared extents
+        self.shared_extents = False
+        self.extent_keys = { }
+        # a directory_digests object, if the digest of each directory is
+        # output (by the serializer instead, with more than one core)
+        self.digests = None
         self.inode_cache = { }
+        # the inodes in the cache that can be seen again, because they
+        # have hard links, which are all a checkpoint needs to record
+        self.linked_inodes = { }
         self.prev_stat = None
+        # devices of directories we have stat'ed but not yet visited,
+        # so we don't have to stat them again to check for FAT
+        self.dir_devices = { }
+        if not header:
+            return
         if stat_has_time_ns():
             self.outfile.write('%%fileinfo %s+n\n' % FILEINFO_VERSION)
         else:
             self.outfile.write('%%fileinfo %s\n' % FILEINFO_VERSION)
+        for line in header_lines:
+            self.outfile.write(line)
         self.outfile.flush()
 
     def _process_dir(self, chdir_obj):
@@ -857,12 +2680,112 @@ class file_info_output_stream_base(object):
         :param file_obj: file we want to write information about
         """
         pass
+    def _process_checkpoint(self, checkpoint_obj):
+        """method called when we want to record a checkpoint
+
+        This is intended to be an abstract method, overwritten by concrete
+        implementations. The default implementation does nothing.
+
+        :param checkpoint_obj: the checkpoint to record
+        """
+        pass
+    def _process_marker(self, marker_obj):
+        """method called when we want to output a line that is not about
+        a file, such as a skipped mount point or the start of a unit of
+        a shard
+
+        This is intended to be an abstract method, overwritten by concrete
+        implementations. The default implementation does nothing.
+
+        :param marker_obj: the marker to output
+        """
+        pass
+    def flush(self):
+        """send on any work being held back, at the end of the output
+
+        The default implementation does nothing.
+        """
+        pass
+    def output_checkpoint(self, checkpoint_name, directories, root_index,
+                          components, rules=( )):
+        """record a checkpoint after the output of a directory
+
+        :param checkpoint_name: the name of the checkpoint file
+        :param directories: the top directories given on the command line
+        :param root_index: the index of the top directory being walked
+        :param components: the directory, from relative_components()
+        :param rules: the include and exclude rules, as (action, pattern)
+        """
+        state = { 'version': FILEINFO_VERSION,
+                  'directories': directories,
+                  'rules': [ list(rule) for rule in rules ],
+                  'root': root_index,
+                  'path': components,
+                  'inodes': list(self.linked_inodes.keys()), }
+        self._process_checkpoint(checkpoint_info(checkpoint_name, state))
+    def restore_checkpoint(self, state):
+        """restore the inode cache and previous stat from a checkpoint
+
+        :param state: a dictionary read by read_checkpoint()
+        """
+        self.inode_cache = dict.fromkeys(state['inodes'], True)
+        self.linked_inodes = dict.fromkeys(state['inodes'], True)
+        if state['last_stat'] is not None:
+            self.prev_stat = saved_stat(state['last_stat'])
+    def prune_mounts(self, dir_name, dirs, st_dev, markers=False):
+        """remove subdirectories on other file systems from dirs
+
+        :param dir_name: the name of the directory being walked
+        :param dirs: the names of its subdirectories, which are pruned
+        :param st_dev: the device of the top directory
+        :param markers: True to output a marker for each one removed
+
+        The devices of subdirectories that have been output are already
+        known, and anything else is stat'ed here. The mount points
+        themselves are still reported, but not their contents.
+        """
+        kept = [ ]
+        for name in dirs:
+            full_path = os.path.normpath(os.path.join(dir_name, name))
+            dir_dev = self.dir_devices.get(full_path)
+            if dir_dev is None:
+                try:
+                    dir_dev = os.lstat(full_path).st_dev
+                except OSError:
+                    dir_dev = st_dev
+            if dir_dev == st_dev:
+                kept.append(name)
+                continue
+            self.dir_devices.pop(full_path, None)
+            if markers:
+                self._process_marker(skipped_mount_info(full_path))
+        dirs[:] = kept
+    def output_unit(self, unit):
+        """output the start of a unit of work in a shard
+
+        :param unit: the number of the unit (see shard_subtrees())
+        """
+        self._process_marker(unit_info(unit))
     def output_dir(self, dir_name):
         """output the fact that we have changed to another directory
 
         :param dir_name: the name of the directory that we have changed to
         """
-        self._process_dir(chdir_info(dir_name))
+        st_dev = self.dir_devices.pop(os.path.normpath(dir_name), None)
+        self._process_dir(chdir_info(dir_name, st_dev))
+    def prefetch_stats(self, dir_name, names):
+        """start the lstat() calls for the files of a directory, if there
+        is a prefetcher
+
+        :param dir_name: the name of the directory
+        :param names: the names of its files and subdirectories, in the
+                      order they will be output
+        """
+        if self.prefetcher is None:
+            return
+        self.prefetcher.prefetch([ os.path.normpath(os.path.join(dir_name,
+                                                                 name))
+                                   for name in names ])
     def output_file(self, dir_name, file_name):
         """output information about the given file in the given directory
 
@@ -875,22 +2798,53 @@ class file_info_output_stream_base(object):
         makes the determination if we need to calculate a checksum or not.
         """
         full_path = os.path.normpath(os.path.join(dir_name, file_name))
-        this_stat = os.lstat(full_path)
+        if self.prefetcher is None:
+            lstat = os.lstat
+            if self.file_limit is not None:
+                self.file_limit.take(1)
+        else:
+            lstat = self.prefetcher.lstat
+        if self.profile is None:
+            this_stat = lstat(full_path)
+        else:
+            start = profile_timer()
+            this_stat = lstat(full_path)
+            self.profile.record('lstat', profile_timer() - start)
         if this_stat.st_ino in self.inode_cache:
             # if we have previously seen this inode, the rest of the
             # meta-data has already been output, so all we need to record
             # is the inode number
             self._process_inode(cached_info(file_name, this_stat))
         else:
-            info = file_info(file_name, full_path, this_stat)
-            if stat.S_ISREG(this_stat.st_mode):
+            info = file_info(file_name, full_path, this_stat, self.sample)
+            if stat.S_ISREG(this_stat.st_mode) and self.shared_extents:
+                info.extent_key = shared_extent_key(full_path, this_stat)
+            if info.extent_key in self.extent_keys:
+                # a clone of a file already hashed, so the hash of that
+                # file is output for this one too (see share_hash())
+                info.reuse_hash = True
+                self._process_non_checksum_file(info)
+            elif stat.S_ISREG(this_stat.st_mode):
                 # for regular files, we will calculate a hash of the file
+                if self.sample is None:
+                    self.bytes_queued += this_stat.st_size
+                else:
+                    for (offset, length) in sample_ranges(this_stat.st_size,
+                                                          self.sample):
+                        self.bytes_queued += length
+                if info.extent_key is not None:
+                    self.extent_keys[info.extent_key] = True
                 self._process_checksum_file(info)
             else:
                 # otherwise, we output without a hash
                 self._process_non_checksum_file(info)
             # record the fact that we have seen this inode
             self.inode_cache[this_stat.st_ino] = True
+            if (this_stat.st_nlink > 1) and \
+               not stat.S_ISDIR(this_stat.st_mode):
+                self.linked_inodes[this_stat.st_ino] = True
+        if stat.S_ISDIR(this_stat.st_mode):
+            self.dir_devices[full_path] = this_stat.st_dev
         self.prev_stat = this_stat
 
 class file_info_output_stream_immediate(file_info_output_stream_base):
@@ -900,16 +2854,59 @@ class file_info_output_stream_immediate(file_info_output_stream_base):
     The methods defined simply call the underlying output functions
     from the objects passed in.
     """
-    def __init__(self, outfile):
-        super(file_info_output_stream_immediate, self).__init__(outfile)
+    def __init__(self, outfile, bytes_read=None, header=True,
+                 header_lines=( )):
+        super(file_info_output_stream_immediate, self).__init__(outfile,
+                                                                bytes_read,
+                                                                header,
+                                                                header_lines)
+        self.shared_hashes = { }
+    def _output(self, info_obj):
+        if isinstance(info_obj, file_info):
+            info_obj.share_hash(self.shared_hashes, self.bytes_read,
+                                self.byte_limit)
+        if self.digests is not None:
+            self.digests.add(info_obj)
+        if self.profile is None:
+            info_obj.output(self.outfile, sys.stderr, self.prev_stat)
+        else:
+            start = profile_timer()
+            info_obj.output(self.outfile, sys.stderr, self.prev_stat)
+            self.profile.record('output', profile_timer() - start)
     def _process_dir(self, chdir_obj):
-        chdir_obj.output(self.outfile, sys.stderr, self.prev_stat)
+        self._output(chdir_obj)
     def _process_inode(self, inode_obj):
-        inode_obj.output(self.outfile, sys.stderr, self.prev_stat)
+        self._output(inode_obj)
     def _process_checksum_file(self, file_obj):
-        get_checksum(file_obj).output(self.outfile, sys.stderr, self.prev_stat)
+        if self.profile is None:
+            get_checksum(file_obj, self.bytes_read, self.byte_limit)
+        else:
+            start = profile_timer()
+            get_checksum(file_obj, self.bytes_read, self.byte_limit)
+            self.profile.record('checksum', profile_timer() - start)
+        self._output(file_obj)
     def _process_non_checksum_file(self, file_obj):
-        file_obj.output(self.outfile, sys.stderr, self.prev_stat)
+        self._output(file_obj)
+    def _process_checkpoint(self, checkpoint_obj):
+        self._output(checkpoint_obj)
+    def _process_marker(self, marker_obj):
+        self._output(marker_obj)
+    def flush(self):
+        if self.digests is not None:
+            self.digests.finish()
+
+# When the hashing tasks take files in the order they are output, a
+# large file near the end of a directory starts late, and everything
+# after it waits in the serializer until it is done, while the other
+# tasks run out of work. So the background stream holds a window of
+# files waiting to be hashed, and sends the largest of them to the
+# hashing tasks first. The output is still in order, since the
+# serializer uses the sequence numbers. To keep the serializer from
+# buffering too much, a file that has waited while twice the window of
+# other items arrived is sent next, regardless of its size.
+
+# the number of files held back to choose the largest from
+SCHEDULE_WINDOW = 64
 
 class file_info_output_stream_background(file_info_output_stream_base):
     """file_info_output_stream_background is a concrete implementation
@@ -919,23 +2916,138 @@ class file_info_output_stream_background(file_info_output_stream_base):
     sequence number is maintained and used to insure output is made
     in the proper order.
     """
-    def __init__(self, outfile, q_checksum, q_serializer):
-        super(file_info_output_stream_background, self).__init__(outfile)
+    def __init__(self, outfile, q_checksum, q_serializer, bytes_read=None,
+                 header=True, header_lines=( ), window=SCHEDULE_WINDOW):
+        super(file_info_output_stream_background, self).__init__(outfile,
+                                                                 bytes_read,
+                                                                 header,
+                                                                 header_lines)
         self.q_checksum = q_checksum
         self.q_serializer = q_serializer
         self.number = 0
+        # files waiting to be hashed, largest first (see SCHEDULE_WINDOW)
+        # and in order, as [ -size, number, file_obj ] entries, with the
+        # file_obj set to None once it has been sent
+        self.window = window
+        self.waiting = [ ]
+        self.waiting_order = collections.deque()
+        self.num_waiting = 0
     def _process_dir(self, chdir_obj):
         self.q_serializer.put((self.number, chdir_obj))
         self.number = self.number + 1
     def _process_inode(self, inode_obj):
         self.q_serializer.put((self.number, inode_obj))
         self.number = self.number + 1
+    def _send_checksum_file(self, number, file_obj):
+        if self.profile is None:
+            self.q_checksum.put((number, file_obj))
+        else:
+            self.profile.sample_queue('checksum', queue_depth(self.q_checksum))
+            start = profile_timer()
+            self.q_checksum.put((number, file_obj))
+            self.profile.record('checksum_put', profile_timer() - start)
+    def _send_waiting(self, entry):
+        self._send_checksum_file(entry[1], entry[2])
+        entry[2] = None
+        self.num_waiting = self.num_waiting - 1
+    def _send_next(self):
+        # drop the entries already sent from the front of each
+        while self.waiting_order[0][2] is None:
+            self.waiting_order.popleft()
+        while self.waiting[0][2] is None:
+            heapq.heappop(self.waiting)
+        oldest = self.waiting_order[0]
+        if oldest[1] < self.number - (2 * self.window):
+            self._send_waiting(oldest)
+        else:
+            self._send_waiting(heapq.heappop(self.waiting))
     def _process_checksum_file(self, file_obj):
-        self.q_checksum.put((self.number, file_obj))
+        if self.window <= 0:
+            self._send_checksum_file(self.number, file_obj)
+        else:
+            entry = [ -file_obj.stat.st_size, self.number, file_obj ]
+            heapq.heappush(self.waiting, entry)
+            self.waiting_order.append(entry)
+            self.num_waiting = self.num_waiting + 1
+            if self.num_waiting > self.window:
+                self._send_next()
         self.number = self.number + 1
+    def flush(self):
+        while self.waiting:
+            entry = heapq.heappop(self.waiting)
+            if entry[2] is not None:
+                self._send_waiting(entry)
+        self.waiting_order.clear()
     def _process_non_checksum_file(self, file_obj):
         self.q_serializer.put((self.number, file_obj))
         self.number = self.number + 1
+    def _process_checkpoint(self, checkpoint_obj):
+        self.q_serializer.put((self.number, checkpoint_obj))
+        self.number = self.number + 1
+    def _process_marker(self, marker_obj):
+        self.q_serializer.put((self.number, marker_obj))
+        self.number = self.number + 1
+
+class file_info_output_stream_records(file_info_output_stream_base):
+    """file_info_output_stream_records is a concrete implementation
+    used by walk_records(), which keeps the information in memory
+    rather than writing it out.
+
+    Checksums are calculated immediately, or by hashing threads if
+    queues to and from them are given. A sequence number is maintained
+    so the information can be collected in the proper order by
+    ready_info().
+    """
+    def __init__(self, q_checksum=None, q_results=None, checksums=True):
+        super(file_info_output_stream_records, self).__init__(None,
+                                                              header=False)
+        self.checksums = checksums
+        self.q_checksum = q_checksum
+        self.q_results = q_results
+        self.number = 0
+        self.next_number = 0
+        self.result_buffer = { }
+    def _store(self, info_obj):
+        self.result_buffer[self.number] = info_obj
+        self.number = self.number + 1
+    def _process_dir(self, chdir_obj):
+        self._store(chdir_obj)
+    def _process_inode(self, inode_obj):
+        self._store(inode_obj)
+    def _process_checksum_file(self, file_obj):
+        if not self.checksums:
+            self._store(file_obj)
+        elif self.q_checksum is None:
+            self._store(get_checksum(file_obj, self.bytes_read,
+                                     self.byte_limit))
+        else:
+            self.q_checksum.put((self.number, file_obj))
+            self.number = self.number + 1
+    def _process_non_checksum_file(self, file_obj):
+        self._store(file_obj)
+    def _process_marker(self, marker_obj):
+        self._store(marker_obj)
+    def outstanding(self):
+        """return the number of items not yet collected"""
+        return self.number - self.next_number
+    def ready_info(self, limit=0):
+        """return the info objects that are ready, in order
+
+        :param limit: the number of items that may be left outstanding,
+                      waiting for their checksum
+
+        This waits for checksums until no more than limit items are
+        outstanding.
+        """
+        ready = [ ]
+        while True:
+            while self.next_number in self.result_buffer:
+                ready.append(self.result_buffer.pop(self.next_number))
+                self.next_number = self.next_number + 1
+            if self.outstanding() <= limit:
+                return ready
+            (number, info_obj) = self.q_results.get()
+            self.result_buffer[number] = info_obj
 
 class file_info_input_stream_EXCEPTION(Exception):
     """file_info_input_stream_EXCEPTION is a base for all exceptions that can occur when reading a meta-information file
@@ -970,6 +3082,9 @@ class file_info_input_stream:
     def __init__(self, instream):
         self.instream = instream
         self.line_num = 1
+        # the complete fields of the last file read, and of each inode
+        self.fields = None
+        self.inodes = { }
         s = self.instream.readline()
         magic = "%fileinfo "
         if not s.startswith(magic):
@@ -986,15 +3101,73 @@ class file_info_input_stream:
         if s != "\n":
             raise file_info_input_stream_BADVERSION()
         self.have_read_dir = False
+        # the header lines after the version, apart from the shard
+        self.header_lines = [ ]
+        # (index, count) if this is one shard of a snapshot
+        self.shard = None
+        # (block size, number of blocks) if fingerprints were sampled
+        self.sample = None
+        # True if the snapshot has the digest of each directory
+        self.digests = False
 
     def read_next(self):
+        """read the next item from the file
+
+        Returns a tuple of (type, value), or None at the end of the file.
+        For files and cached inodes, the complete information about the
+        file (with the delta encoding undone) is in self.fields. For the
+        digest of a directory, the value is a tuple of (directory,
+        digest).
+        """
+        fields = { }
         while True:
             # TODO: unescaping stuff
             s = self.instream.readline()
             self.line_num = self.line_num + 1
             if s == '':
+                if fields:
+                    raise file_info_input_stream_SYNTAX_ERROR(self.line_num)
                 answer = None
                 break
+            if s[0] in FIELD_LETTERS:
+                fields[s[0]] = s[1:-1]
+                continue
+            if fields and (s[0] not in '>@'):
+                raise file_info_input_stream_SYNTAX_ERROR(self.line_num)
+            if (s[0] == '%') and not self.have_read_dir:
+                (action, _, value) = s[1:-1].partition(' ')
+                if action == 'shard':
+                    try:
+                        self.shard = shard_arg(value)
+                    except ValueError:
+                        raise file_info_input_stream_SYNTAX_ERROR(
+                                  self.line_num)
+                    continue
+                if action == 'sample':
+                    try:
+                        self.sample = tuple([ int(n) for n in value.split() ])
+                    except ValueError:
+                        raise file_info_input_stream_SYNTAX_ERROR(
+                                  self.line_num)
+                    if len(self.sample) != 2:
+                        raise file_info_input_stream_SYNTAX_ERROR(
+                                  self.line_num)
+                elif action in ('include', 'exclude'):
+                    # the snapshot only has what the rules included, so
+                    # they are only kept with the other header lines
+                    pass
+                elif action == 'digests':
+                    self.digests = True
+                else:
+                    raise file_info_input_stream_SYNTAX_ERROR(self.line_num)
+                self.header_lines.append(s)
+                continue
+            if s[0] == '&':
+                try:
+                    answer = ('unit', int(s[1:-1]))
+                except ValueError:
+                    raise file_info_input_stream_SYNTAX_ERROR(self.line_num)
+                break
             if s[0] == '!':
                 self.have_read_dir = True
                 answer = ('dir', s[1:-1])
@@ -1003,17 +3176,98 @@ class file_info_input_stream:
                 self.have_read_dir = True
                 answer = ('msdos_dir', s[1:-1])
                 break
+            if s[0] == '-':
+                answer = ('skipped_mount', s[1:-1])
+                break
+            if not self.have_read_dir:
+                raise file_info_input_stream_NO_START_DIR()
+            if s[0] == '*':
+                (digest, _, dir_name) = s[1:-1].partition(' ')
+                if not dir_name:
+                    raise file_info_input_stream_SYNTAX_ERROR(self.line_num)
+                answer = ('digest', (dir_name, digest))
+                break
             if s[0] == '@':
+                # the other fields are the same as when the inode was
+                # first output
+                if fields.get('i') not in self.inodes:
+                    raise file_info_input_stream_SYNTAX_ERROR(self.line_num)
+                self.fields = self.inodes[fields['i']]
                 answer = ('inode', s[1:-1])
                 break
             if s[0] == '>':
+                self.fields = decode_fields(fields, self.fields)
+                self.inodes[self.fields.get('i')] = self.fields
                 answer = ('file', s[1:-1])
                 break
             raise file_info_input_stream_SYNTAX_ERROR(self.line_num)
-        if not self.have_read_dir:
-            raise file_info_input_stream_NO_START_DIR()
         return answer
 
+def check_hashes(stream, out, byte_limit=None, base_dir=None):
+    """check the contents of files against a snapshot
+
+    :param stream: a file_info_input_stream to read the snapshot from
+    :param out: a file-like object to report differences to
+    :param byte_limit: an optional token_bucket limiting the rate at
+                       which bytes are read
+    :param base_dir: the directory that relative paths in the snapshot
+                     are relative to, if not the current directory (the
+                     paths are still reported as they are in the
+                     snapshot)
+
+    Each regular file with a hash or a sampled fingerprint in the
+    snapshot is read again, and a line is output for each one that is
+    different: "hash mismatch" if the full hash is different, or
+    "sample mismatch" if the sampled fingerprint is different (so the
+    file has changed, although we only read part of it). Files that
+    cannot be read are reported too. Returns the number of lines output.
+    """
+    problems = 0
+    dir_name = None
+    while True:
+        item = stream.read_next()
+        if item is None:
+            break
+        (item_type, value) = item
+        if item_type in ('dir', 'msdos_dir'):
+            dir_name = unescape_filename(value)
+            continue
+        if item_type != 'file':
+            continue
+        if '#' in stream.fields:
+            (kind, expected, sample) = ('hash', stream.fields['#'], None)
+        elif '~' in stream.fields:
+            (kind, expected, sample) = ('sample', stream.fields['~'],
+                                        stream.sample)
+        else:
+            continue
+        file_name = unescape_filename(value)
+        full_path = os.path.join(dir_name, file_name)
+        if base_dir is None:
+            read_path = full_path
+        else:
+            read_path = os.path.join(base_dir, full_path)
+        try:
+            info = file_info(file_name, read_path, os.lstat(read_path),
+                             sample)
+        except OSError as e:
+            info = file_info(file_name, read_path, None)
+            info.set_hashing_error(e)
+        else:
+            get_checksum(info, None, byte_limit)
+        if info.hashing_error is not None:
+            error = getattr(info.hashing_error, 'strerror', None) or \
+                    str(info.hashing_error)
+            out.write("cannot read (%s): %s\n" %
+                      (error, escape_filename(full_path)))
+        elif info.encoded_hash != expected:
+            out.write("%s mismatch: %s\n" %
+                      (kind, escape_filename(full_path)))
+        else:
+            continue
+        problems = problems + 1
+    return problems
+
 def human_time(seconds):
     sub_seconds = seconds - int(seconds)
     seconds = int(seconds)
@@ -1048,7 +3302,7 @@ def human_bytes(b):
     elif b >= 1024:
         b2 = "%.1f KiB" % (b / 1024)
     else:
-        b2 = "%d B"
+        b2 = "%d B" % b
     # calcluate base 10 values
     # http://en.wikipedia.org/wiki/SI_prefix
     if b >= 1000000000000000:
@@ -1062,7 +3316,7 @@ def human_bytes(b):
     elif b >= 1000:
         b10 = "%.1f KB" % (b / 1000)
     else:
-        b10 = "%d B"
+        b10 = "%d B" % b
     return "%s / %s" % (b2, b10)
 
 plural_of = {
@@ -1077,31 +3331,110 @@ def plural(n, word):
         return plural_of[word]
 
 class progress_output:
-    def __init__(self, num_dir, num_file, progress_interval, start_time=None):
-        self.total_dir_count = num_dir
-        self.total_file_count = num_file
-        self.total_count = num_dir + num_file
+    """progress_output reports how far along we are on stderr
+
+    The total number of directories and files may not be known when we
+    start, since they are counted by count_files() while the output is
+    being generated. Until the count is complete, the totals are only
+    a lower bound, and so is the estimated time remaining.
+
+    If the output stream is given, we also report the hashing
+    throughput and estimate the remaining time from the bytes left to
+    hash. We don't know the sizes of files we have not reached yet, so
+    we assume they have the same average size as the ones we have.
+    """
+    def __init__(self, num_dir, num_file, progress_interval, start_time=None,
+                 totals_complete=True, stream=None):
+        self.set_totals(num_dir, num_file, totals_complete)
         self.dir_count = 0
         self.file_count = 0
+        self.stream = stream
         self.progress_interval = progress_interval
         if start_time is None:
             self.start_time = time.time()
+        else:
+            self.start_time = start_time
         self.last_time = self.start_time
+        self.reporter = None
+    def set_totals(self, num_dir, num_file, totals_complete=True):
+        """update the number of directories and files we expect to process
+
+        :param num_dir: the number of directories
+        :param num_file: the number of files
+        :param totals_complete: False if these are only the counts so far
+        """
+        self.total_dir_count = num_dir
+        self.total_file_count = num_file
+        self.total_count = num_dir + num_file
+        self.totals_complete = totals_complete
+    def bytes_left(self):
+        """estimate the number of bytes that remain to be hashed"""
+        bytes_queued = self.stream.bytes_queued
+        remaining = max(self.total_count - self.file_count, 0)
+        if self.file_count > 0:
+            unseen = (bytes_queued / self.file_count) * remaining
+        else:
+            unseen = 0
+        return max(bytes_queued + unseen - self.stream.bytes_read.value, 0)
     def _status(self, current_time):
         run_time = current_time - self.start_time
         if (self.total_count != 0) and (run_time > 0):
-            progress = " (%.1f%% done, %.1f/second)" % (
-                (self.file_count * 100) / self.total_count,
-                (self.file_count / run_time))
+            rate = self.file_count / run_time
+            remaining = max(self.total_count - self.file_count, 0)
+            if rate > 0:
+                seconds_left = remaining / rate
+            else:
+                seconds_left = None
+            if self.stream is not None:
+                bytes_left = self.bytes_left()
+                byte_rate = self.stream.bytes_read.value / run_time
+                if byte_rate > 0:
+                    seconds_left = max(seconds_left or 0,
+                                       bytes_left / byte_rate)
+                throughput = ", %.1f MB/s, %s to go" % (byte_rate / 1000000,
+                                                       human_bytes(bytes_left))
+            else:
+                throughput = ""
+            if seconds_left is None:
+                eta = "-"
+            else:
+                eta = human_time(seconds_left)
+            if self.totals_complete:
+                progress = " (%.1f%% done, %.1f/second%s, %s left)" % (
+                    (self.file_count * 100) / self.total_count, rate,
+                    throughput, eta)
+            else:
+                progress = " (of at least %d, %.1f/second%s, %s+ left)" % (
+                    self.total_count, rate, throughput, eta)
         else:
             progress = ""
         sys.stderr.write("\r%d %s from %d %s in %s%s" %
             (self.file_count, plural(self.file_count, "file"), 
             self.dir_count, plural(self.dir_count, "directory"),
             human_time(run_time), progress))
+    def _report(self):
+        while True:
+            self.finished.wait(self.progress_interval)
+            if self.finished.is_set():
+                break
+            self._status(time.time())
+    def start(self):
+        """start reporting from a separate thread
+        
+        Status is then reported every progress_interval seconds even
+        if the main thread is blocked, for example while a large file
+        is being hashed.
+        """
+        self.finished = threading.Event()
+        self.reporter = threading.Thread(target=self._report)
+        self.reporter.daemon = True
+        self.reporter.start()
     def update(self, dir_inc, file_inc, current_time=None):
         self.dir_count = self.dir_count + dir_inc
         self.file_count = self.file_count + file_inc
+        # the reporting thread outputs the status if we have one
+        if self.reporter is not None:
+            return
         if current_time is None:
             now = time.time()
         else:
@@ -1110,6 +3443,9 @@ class progress_output:
             self.last_time = now
             self._status(now)
     def complete(self, current_time=None):
+        if self.reporter is not None:
+            self.finished.set()
+            self.reporter.join()
         if current_time is None:
             now = time.time()
         else:
@@ -1117,6 +3453,91 @@ class progress_output:
         self._status(now)
         sys.stderr.write("\n")
 
+def count_files(fileinfo_dirs, progress, rules=None, one_file_system=False,
+                shard=None, limit=None):
+    """count directories and files for progress reporting
+
+    :param fileinfo_dirs: a list of directories to count
+    :param progress: a progress_output object to update with the counts
+    :param rules: a path_rules object, if only some are reported
+    :param one_file_system: True to stay on the file system of each
+                            directory, as with --one-file-system
+    :param shard: only count this shard, as a tuple of (index, count)
+    :param limit: an optional token_bucket limiting the rate at which
+                  directories are read
+
+    This is expected to be run as a thread alongside the main walk, so
+    that we don't have to wait for a complete extra traversal of the
+    directories before starting. It only reads directories, which also
+    has the effect of warming the cache for the main walk.
+    """
+    total_dirs = 0
+    total_files = 0
+    unit = 0
+    for fileinfo_dir in fileinfo_dirs:
+        if one_file_system:
+            root_dev = os.stat(fileinfo_dir).st_dev
+        for root, dirs, files in profiled_walk(fileinfo_dir, None, limit):
+            if rules is not None:
+                components = relative_components(fileinfo_dir, root)
+                dirs[:] = rules.filter(components, dirs, True)
+                files = rules.filter(components, files, False)
+            # mount points are reported, but not what is in them
+            in_shard = (shard is None) or (root != fileinfo_dir) or \
+                       shard_owns(unit, shard)
+            if in_shard:
+                total_dirs = total_dirs + len(dirs)
+            if one_file_system:
+                dirs[:] = [ name for name in dirs
+                            if same_device(os.path.join(root, name),
+                                           root_dev) ]
+            if (shard is not None) and (root == fileinfo_dir):
+                dirs.sort()
+                (units, unit) = shard_subtrees(dirs, unit, shard)
+            if not in_shard:
+                continue
+            total_files = total_files + len(files)
+            progress.set_totals(total_dirs, total_files, False)
+    progress.set_totals(total_dirs, total_files, True)
+
+def same_device(file_name, st_dev):
+    """Determine whether a file is on the given device
+
+    :param file_name: the name of the file
+    :param st_dev: the device
+
+    A file that cannot be stat'ed is assumed to be on the device.
+    """
+    try:
+        return os.lstat(file_name).st_dev == st_dev
+    except OSError:
+        return True
+
+def profiled_walk(top, profile, limit=None):
+    """os.walk(), recording the time taken to read each directory
+
+    :param top: the directory to start from
+    :param profile: a profile_stats object, or None if not profiling
+    :param limit: an optional token_bucket limiting the rate at which
+                  directories are read
+    """
+    walker = os.walk(top)
+    if (profile is None) and (limit is None):
+        for entry in walker:
+            yield entry
+        return
+    while True:
+        start = profile_timer()
+        try:
+            entry = next(walker)
+        except StopIteration:
+            return
+        if profile is not None:
+            profile.record('walk', profile_timer() - start)
+        if limit is not None:
+            limit.take(1)
+        yield entry
+
 def make_type_unicode(s):
     """Convert the passed argument into a unicode type.
 
@@ -1133,6 +3554,1275 @@ def make_type_unicode(s):
     else:
         return s
 
+class file_record:
+    """file_record is the information about one file returned by
+    walk_records().
+
+    The members are:
+
+    * path - the path of the file, starting with the directory walked
+    * stat - the value returned by os.lstat() for the file
+    * hash - the SHA224 hash of the file, base64-encoded as in the
+      output, or None if it is not a regular file or could not be read
+    * error - the exception raised reading the file, or None
+    * hard_link - for a file whose inode was already returned, the path
+      of that earlier file (with the same stat and hash), otherwise None
+    """
+    def __init__(self, path, stat, hash=None, error=None, hard_link=None):
+        self.path = path
+        self.stat = stat
+        self.hash = hash
+        self.error = error
+        self.hard_link = hard_link
+    def __repr__(self):
+        return "file_record(%r, hash=%r)" % (self.path, self.hash)
+
+def walk_records(directories, ncpus=1, batch_size=1000, rules=None,
+                 one_file_system=False, checksums=True):
+    """Walk directories and yield a file_record for each file
+
+    :param directories: a directory, or a list of directories
+    :param ncpus: the number of threads to hash files in, or 1 to hash
+                  them in the calling thread
+    :param batch_size: the most files to read ahead of the caller
+    :param rules: a list of (action, pattern) tuples, as for --exclude
+                  and --include
+    :param one_file_system: True to not descend into other file systems
+    :param checksums: False to not hash files, so no hash is returned
+
+    This is the library interface to fileinfo: the files are walked
+    and hashed in the same order and the same way as for the output,
+    but records are returned instead of being written. Nothing is read
+    until the records are asked for, and no more than batch_size files
+    are read ahead of the caller, so the caller can stop at any point.
+    Subdirectories are returned as files within their parent, and the
+    directories walked are not returned themselves.
+    """
+    if not isinstance(directories, (list, tuple)):
+        directories = [ directories ]
+    if rules:
+        matcher = path_rules(rules)
+    else:
+        matcher = None
+
+    if not checksums:
+        ncpus = 1
+    if ncpus > 1:
+        # hash in threads, so we need no extra processes
+        q_checksum = Queue.Queue(ncpus * 4)
+        q_results = Queue.Queue()
+        for n in range(ncpus):
+            task = threading.Thread(target=checksum_generator,
+                                    args=(q_checksum, q_results))
+            task.daemon = True
+            task.start()
+        stream = file_info_output_stream_records(q_checksum, q_results)
+    else:
+        stream = file_info_output_stream_records(checksums=checksums)
+
+    # the first file returned for each inode with hard links
+    first_paths = { }
+    dir_name = None
+    try:
+        for top in directories:
+            top = make_type_unicode(top)
+            if one_file_system:
+                root_dev = os.stat(top).st_dev
+            for root, dirs, files in profiled_walk(top, None):
+                dirs.sort()
+                if matcher is not None:
+                    components = relative_components(top, root)
+                    dirs[:] = matcher.filter(components, dirs, True)
+                    files[:] = matcher.filter(components, files, False)
+                stream.output_dir(root)
+                for name in dirs:
+                    stream.output_file(root, name)
+                    if stream.outstanding() < batch_size:
+                        continue
+                    (records, dir_name) = ready_records(stream,
+                                                        batch_size // 2,
+                                                        dir_name,
+                                                        first_paths)
+                    for record in records:
+                        yield record
+                if one_file_system:
+                    stream.prune_mounts(root, dirs, root_dev)
+                files.sort()
+                for name in files:
+                    stream.output_file(root, name)
+                    if stream.outstanding() < batch_size:
+                        continue
+                    (records, dir_name) = ready_records(stream,
+                                                        batch_size // 2,
+                                                        dir_name,
+                                                        first_paths)
+                    for record in records:
+                        yield record
+        (records, dir_name) = ready_records(stream, 0, dir_name, first_paths)
+        for record in records:
+            yield record
+    finally:
+        # stop the hashing threads, even if the caller stopped early
+        if ncpus > 1:
+            for n in range(ncpus):
+                q_checksum.put(None)
+
+def ready_records(stream, limit, dir_name, first_paths):
+    """Collect the records of the files that are ready from the stream
+
+    :param stream: a file_info_output_stream_records
+    :param limit: the number of files that may be left outstanding
+    :param dir_name: the directory of the last file collected
+    :param first_paths: a dictionary of the first record for each inode
+                        with hard links, which is updated
+
+    Returns a tuple of the list of file_records and the directory of
+    the last of them.
+    """
+    records = [ ]
+    for info in stream.ready_info(limit):
+        if isinstance(info, chdir_info):
+            dir_name = info.dir_name
+            continue
+        records.append(info_record(info, dir_name, first_paths))
+    return (records, dir_name)
+
+def info_record(info, dir_name, first_paths):
+    """Convert an info object from the output stream into a file_record
+
+    :param info: a file_info or cached_info object
+    :param dir_name: the directory the file is in
+    :param first_paths: a dictionary of the first record for each inode
+                        with hard links, which is updated
+    """
+    path = os.path.normpath(os.path.join(dir_name, info.file_name))
+    first = first_paths.get(info.stat.st_ino)
+    if isinstance(info, cached_info) and (first is not None):
+        return file_record(path, info.stat, first.hash, first.error,
+                           first.path)
+    record = file_record(path, info.stat,
+                         getattr(info, 'encoded_hash', None),
+                         getattr(info, 'hashing_error', None))
+    if info.stat.st_nlink > 1:
+        first_paths[info.stat.st_ino] = record
+    return record
+
+# To find duplicate files, we only need to hash files with the same
+# size as another file. Of those, we first compare a fingerprint of a
+# few blocks of each (see sample_ranges()), and only read all of the
+# files whose fingerprints are the same. Usually this is a small part
+# of all the data.
+
+# blocks compared before reading files completely, as for --sample
+DUPLICATE_SAMPLE = (4096, 3)
+
+class hashing_pool:
+    """hashing_pool keeps a set of hashing tasks running, so that several
+    lists of files can be hashed without starting new tasks for each."""
+    def __init__(self, ncpus=1, threads=True, bytes_read=None):
+        """start the hashing tasks
+
+        :param ncpus: the number of hashing tasks to use
+        :param threads: True to hash in threads, False for processes
+        :param bytes_read: an optional counter of bytes hashed (LocalCounter
+                           for threads, multiprocessing.Value for processes)
+
+        The same hashing tasks are used as for the output (see
+        checksum_generator()). With only one task, the files are hashed
+        in the calling thread instead.
+        """
+        self.bytes_read = bytes_read
+        self.tasks = [ ]
+        if ncpus <= 1:
+            return
+        if threads:
+            (queue_type, task_type) = (Queue.Queue, threading.Thread)
+        else:
+            (queue_type, task_type) = (multiprocessing.Queue,
+                                       multiprocessing.Process)
+        self.q_checksum = queue_type(ncpus * 4)
+        self.q_results = queue_type()
+        for n in range(ncpus):
+            task = task_type(target=checksum_generator,
+                             args=(self.q_checksum, self.q_results,
+                                   bytes_read, None, 'checksum', None, 0,
+                                   kernel_hash))
+            # so a watcher that is killed does not wait for the tasks
+            task.daemon = True
+            task.start()
+            self.tasks.append(task)
+    def hash(self, infos):
+        """calculate the checksums of a list of file_info objects
+
+        :param infos: a list of file_info objects
+
+        Returns a list of the file_info objects with their checksums, in
+        the same order.
+        """
+        if not self.tasks:
+            return [ get_checksum(info, self.bytes_read) for info in infos ]
+        # the results queue is not limited, so the tasks never wait on us
+        for info in enumerate(infos):
+            self.q_checksum.put(info)
+        results = [ None ] * len(infos)
+        for n in range(len(infos)):
+            (number, info) = self.q_results.get()
+            results[number] = info
+        return results
+    def close(self):
+        """stop the hashing tasks, and wait for them to finish"""
+        for task in self.tasks:
+            self.q_checksum.put(None)
+        # a process does not exit until what it sent has been read
+        finished = 0
+        while finished < len(self.tasks):
+            if self.q_results.get() is None:
+                finished = finished + 1
+        for task in self.tasks:
+            task.join()
+        self.tasks = [ ]
+
+def hash_files(infos, ncpus=1, threads=True, bytes_read=None):
+    """calculate the checksums of a list of file_info objects
+
+    :param infos: a list of file_info objects
+    :param ncpus: the number of hashing tasks to use
+    :param threads: True to hash in threads, False for processes
+    :param bytes_read: an optional counter of bytes hashed (LocalCounter
+                       for threads, multiprocessing.Value for processes)
+
+    The hashing tasks only last for this call; to hash several lists,
+    use a hashing_pool. Returns a list of the file_info objects with
+    their checksums, in the same order.
+    """
+    pool = hashing_pool(ncpus, threads, bytes_read)
+    try:
+        return pool.hash(infos)
+    finally:
+        pool.close()
+
+def same_hash_groups(infos):
+    """Group file_info objects with the same size and checksum
+
+    :param infos: a list of file_info objects with checksums
+
+    Returns a list of the groups with more than one member. Files that
+    could not be read are left out.
+    """
+    groups = { }
+    for info in infos:
+        if info.encoded_hash is not None:
+            key = (info.stat.st_size, info.encoded_hash)
+            groups.setdefault(key, [ ]).append(info)
+    return [ group for group in groups.values() if len(group) > 1 ]
+
+def find_duplicates(directories, ncpus=1, threads=True, rules=None,
+                    one_file_system=False, bytes_read=None):
+    """Find regular files with the same contents
+
+    :param directories: a list of directories to look in
+    :param ncpus: the number of hashing tasks to use
+    :param threads: True to hash in threads, False for processes
+    :param rules: a list of (action, pattern) tuples, as for --exclude
+                  and --include
+    :param one_file_system: True to not descend into other file systems
+    :param bytes_read: an optional counter of bytes hashed
+
+    Empty files, and hard links to a file already seen, are not counted
+    as duplicates. Returns a tuple of (list of duplicates, number of
+    directories, number of files). Each duplicate is a tuple of (size,
+    hash, list of paths), and the list is sorted with the most space
+    wasted first.
+    """
+    by_size = { }
+    num_dirs = 0
+    num_files = 0
+    for record in walk_records(directories, rules=rules,
+                               one_file_system=one_file_system,
+                               checksums=False):
+        if stat.S_ISDIR(record.stat.st_mode):
+            num_dirs = num_dirs + 1
+            continue
+        num_files = num_files + 1
+        if (record.hard_link is None) and \
+           stat.S_ISREG(record.stat.st_mode) and (record.stat.st_size > 0):
+            by_size.setdefault(record.stat.st_size, [ ]).append(record)
+
+    candidates = [ ]
+    for records in by_size.values():
+        if len(records) > 1:
+            candidates.extend([ file_info(os.path.basename(r.path), r.path,
+                                          r.stat, DUPLICATE_SAMPLE)
+                                for r in records ])
+    pool = hashing_pool(ncpus, threads, bytes_read)
+    try:
+        candidates = pool.hash(candidates)
+
+        full = [ ]
+        for group in same_hash_groups(candidates):
+            full.extend([ file_info(info.file_name, info.full_path,
+                                    info.stat)
+                          for info in group ])
+        full = pool.hash(full)
+    finally:
+        pool.close()
+
+    duplicates = [ ]
+    for group in same_hash_groups(full):
+        duplicates.append((group[0].stat.st_size, group[0].encoded_hash,
+                           sorted([ info.full_path for info in group ])))
+    duplicates.sort(key=lambda d: (-d[0] * (len(d[2]) - 1), d[2]))
+    return (duplicates, num_dirs, num_files)
+
+def output_duplicates(out, duplicates):
+    """Output the duplicates found by find_duplicates()
+
+    :param out: a file-like object to write to
+    :param duplicates: the list of duplicates
+
+    Each set of duplicates is output as the size, the hash, and the
+    paths of the files, using the same letters as for file information.
+    """
+    for (size, encoded_hash, paths) in duplicates:
+        out.write("s%d\n" % size)
+        out.write("#" + encoded_hash + "\n")
+        for path in paths:
+            out.write(">" + escape_filename(path) + "\n")
+
+# Tools that take many snapshots of small directories spend most of
+# their time starting Python and the hashing tasks rather than reading
+# the directories. With --serve, fileinfo.py starts once and listens on
+# a Unix socket, with the hashing tasks waiting for work, and each
+# connection asks for one snapshot or check. A request is a line of
+# JSON, such as:
+#
+#     {"command": "snapshot", "directories": ["a"], "cwd": "/data"}
+#     {"command": "check", "snapshot": "a.fileinfo", "cwd": "/data"}
+#
+# Relative paths are relative to "cwd", if it is given, and are output
+# as they were given, so the output is the same as running fileinfo.py
+# in that directory.
+#
+# The reply is a line "ok" followed by the output, as fileinfo.py would
+# write it, or "error" and a message. If something goes wrong part way
+# through, the output ends with a "%error" line. Requests are handled
+# one at a time. The --connect option sends a request and writes the
+# output, as if fileinfo.py had been run on its own.
+
+# the number of connections that may wait while a request is handled
+SERVE_BACKLOG = 16
+# the most files to read ahead of the output in a snapshot
+SERVE_BATCH = 1000
+
+class server_error(Exception):
+    """server_error is raised when a request to a server fails"""
+    pass
+
+def socket_file(conn, mode):
+    """return a text file object for a connected socket
+
+    :param conn: the socket
+    :param mode: 'r' or 'w'
+    """
+    try:
+        return conn.makefile(mode, encoding='utf-8',
+                             errors='surrogateescape', newline='\n')
+    except TypeError:
+        # Python 2 sockets only have binary files, which take str
+        return conn.makefile(mode)
+
+class snapshot_server:
+    """snapshot_server answers requests for snapshots and checks on a
+    Unix socket, using hashing tasks that stay running between them."""
+    def __init__(self, q_checksum=None, q_results=None, header_lines=( ),
+                 sample=None, matcher=None, one_file_system=False):
+        """initialize the server
+
+        :param q_checksum: a Queue to send files to the hashing tasks,
+                           or None to hash them in this thread
+        :param q_results: a Queue to get the hashed files back from
+        :param header_lines: lines to write after the version line
+        :param sample: (block size, number of blocks) to fingerprint
+                       rather than hash files
+        :param matcher: a path_rules object, if only some files are
+                        reported
+        :param one_file_system: True to not descend into other file
+                                systems
+        """
+        self.q_checksum = q_checksum
+        self.q_results = q_results
+        if stat_has_time_ns():
+            self.version_line = '%%fileinfo %s+n\n' % FILEINFO_VERSION
+        else:
+            self.version_line = '%%fileinfo %s\n' % FILEINFO_VERSION
+        self.header_lines = header_lines
+        self.sample = sample
+        self.matcher = matcher
+        self.one_file_system = one_file_system
+        self.file_limit = None
+        self.byte_limit = None
+        # True to output the digest of each directory
+        self.digests = False
+        # True to output a marker for each mount point not descended into
+        self.mount_markers = False
+        # True to reuse the hashes of files with shared extents
+        self.shared_extents = False
+        # a stat_prefetcher, shared by the requests, if there is one
+        self.prefetcher = None
+    def snapshot(self, directories, out, cwd=None):
+        """write a snapshot of some directories
+
+        :param directories: a list of directories
+        :param out: a file-like object to write the snapshot to
+        :param cwd: the directory that relative directories are relative
+                    to, if not our own current directory
+
+        Directories are output with the names given, as if the snapshot
+        had been taken in cwd.
+        """
+        stream = file_info_output_stream_records(self.q_checksum,
+                                                 self.q_results)
+        stream.sample = self.sample
+        stream.file_limit = self.file_limit
+        stream.byte_limit = self.byte_limit
+        stream.shared_extents = self.shared_extents
+        stream.prefetcher = self.prefetcher
+        # hashes of files with shared extents (see shared_extent_key())
+        shared_hashes = { }
+        out.write(self.version_line)
+        for line in self.header_lines:
+            out.write(line)
+        prev_stat = None
+        if self.digests:
+            digests = directory_digests(out)
+        else:
+            digests = None
+        try:
+            for given_top in directories:
+                given_top = make_type_unicode(given_top)
+                if cwd is None:
+                    top = given_top
+                else:
+                    top = os.path.join(make_type_unicode(cwd), given_top)
+                if self.one_file_system:
+                    root_dev = os.stat(top).st_dev
+                for root, dirs, files in profiled_walk(top, None,
+                                                       self.file_limit):
+                    dirs.sort()
+                    if self.matcher is not None:
+                        components = relative_components(top, root)
+                        dirs[:] = self.matcher.filter(components, dirs, True)
+                        files[:] = self.matcher.filter(components, files,
+                                                       False)
+                    files.sort()
+                    stream.prefetch_stats(root, dirs + files)
+                    stream.output_dir(root)
+                    for name in dirs:
+                        stream.output_file(root, name)
+                    if self.one_file_system:
+                        stream.prune_mounts(root, dirs, root_dev,
+                                            self.mount_markers)
+                    for name in files:
+                        stream.output_file(root, name)
+                    if stream.outstanding() < SERVE_BATCH:
+                        continue
+                    prev_stat = self._output(stream.ready_info(SERVE_BATCH // 2),
+                                             out, prev_stat, top, given_top,
+                                             digests, shared_hashes)
+                prev_stat = self._output(stream.ready_info(), out, prev_stat,
+                                         top, given_top, digests,
+                                         shared_hashes)
+            if digests is not None:
+                digests.finish()
+        finally:
+            # collect any files still being hashed, so they are not
+            # mixed up with the next request
+            stream.ready_info()
+    def _output(self, infos, out, prev_stat, top, given_top, digests,
+                shared_hashes):
+        for info in infos:
+            if isinstance(info, (chdir_info, skipped_mount_info)) and \
+               (top != given_top):
+                # the directory we walked, named as the client named it
+                info.dir_name = given_top + info.dir_name[len(top):]
+            if isinstance(info, file_info):
+                info.share_hash(shared_hashes, None, self.byte_limit)
+            if digests is not None:
+                digests.add(info)
+            prev_stat = info.output(out, sys.stderr, prev_stat)
+        return prev_stat
+    def handle(self, conn):
+        """answer one request
+
+        :param conn: a connected socket
+        """
+        infile = socket_file(conn, 'r')
+        out = socket_file(conn, 'w')
+        try:
+            try:
+                request = json.loads(infile.readline())
+                command = request.get('command')
+                cwd = request.get('cwd')
+                if command == 'snapshot':
+                    directories = request['directories']
+                    for directory in directories:
+                        if not os.path.isdir(os.path.join(cwd or '',
+                                                          directory)):
+                            raise ValueError("not a directory: %s" %
+                                             directory)
+                elif command == 'check':
+                    snapshot_file = open(os.path.join(cwd or '',
+                                                      request['snapshot']),
+                                         'r')
+                else:
+                    raise ValueError("unknown command '%s'" % command)
+            except (ValueError, KeyError, TypeError, AttributeError,
+                    IOError, OSError) as e:
+                out.write("error %s\n" %
+                          (getattr(e, 'strerror', None) or str(e)))
+                return
+            out.write("ok\n")
+            try:
+                if command == 'snapshot':
+                    self.snapshot(directories, out, cwd)
+                else:
+                    try:
+                        check_hashes(file_info_input_stream(snapshot_file),
+                                     out, self.byte_limit, cwd)
+                    finally:
+                        snapshot_file.close()
+            except (IOError, OSError, file_info_input_stream_EXCEPTION) as e:
+                out.write("%%error %s\n" %
+                          (getattr(e, 'strerror', None) or
+                           str(e) or e.__class__.__name__))
+        finally:
+            out.close()
+            infile.close()
+            # closing the files leaves the socket open, so tell the
+            # client that the reply is complete
+            try:
+                conn.shutdown(socket.SHUT_WR)
+            except socket.error:
+                pass
+    def serve(self, socket_name):
+        """answer requests on a Unix socket, until we are killed
+
+        :param socket_name: the path of the socket to create
+        """
+        if os.path.exists(socket_name):
+            # a socket left behind by a server that has stopped is
+            # removed, but not one that is still answering
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_name)
+            except socket.error:
+                os.remove(socket_name)
+            else:
+                raise server_error("a server is already running on %s" %
+                                   socket_name)
+            finally:
+                probe.close()
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(socket_name)
+        try:
+            listener.listen(SERVE_BACKLOG)
+            while True:
+                conn = listener.accept()[0]
+                try:
+                    self.handle(conn)
+                except (socket.error, IOError, OSError) as e:
+                    # most likely the client went away
+                    sys.stderr.write("Error answering request: %s\n" %
+                                     (getattr(e, 'strerror', None) or e))
+                finally:
+                    conn.close()
+        finally:
+            listener.close()
+            os.remove(socket_name)
+
+def connect_server(socket_name, request, out):
+    """send a request to a server started with --serve
+
+    :param socket_name: the path of the server's socket
+    :param request: a dictionary with the request (see snapshot_server)
+    :param out: a file-like object to write the output to
+
+    Returns the number of lines of output. Raises server_error if the
+    request fails.
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_name)
+        writer = socket_file(conn, 'w')
+        writer.write(json.dumps(request) + "\n")
+        writer.close()
+        reader = socket_file(conn, 'r')
+        try:
+            status = reader.readline()
+            if status != "ok\n":
+                raise server_error(status[6:].strip() or "no reply")
+            lines = 0
+            for line in reader:
+                if line.startswith('%error '):
+                    raise server_error(line[7:].strip())
+                out.write(line)
+                lines = lines + 1
+        finally:
+            reader.close()
+    finally:
+        conn.close()
+    return lines
+
+# With --watch, the snapshot is kept up to date as files change, rather
+# than walking the whole tree again. After an initial walk, the
+# information about every file is kept in memory, and the Linux inotify
+# API (used through ctypes) tells us which entries of which directories
+# have changed. Only those are stat'ed again, and only files whose
+# size, times or inode changed are hashed again. Changes are collected
+# for a while, then applied, and a new snapshot is written over the
+# output file (to a temporary file, renamed over the old one, so the
+# output file is always a complete snapshot).
+#
+# Each top directory has its own inotify instance. If the kernel queue
+# of events for one of them overflows, some changes are lost, so that
+# tree is walked again (still only hashing files that changed).
+#
+# inotify reports a change to a file with hard links in the directory
+# it was changed through, so the links in other directories keep their
+# old information until something else changes them.
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_CLOEXEC = 0x00080000
+
+# the events we need to see to keep the snapshot up to date
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+# struct inotify_event, which is followed by the name
+INOTIFY_EVENT = struct.Struct('=iIII')
+# bytes read from an inotify instance at once
+INOTIFY_BUFFER = 65536
+
+# default seconds to collect changes for before writing a snapshot
+WATCH_INTERVAL = 10.0
+
+def encode_path(path):
+    """return a file name as bytes, for a system call
+
+    :param path: the file name
+    """
+    if hasattr(os, 'fsencode'):
+        return os.fsencode(path)
+    if isinstance(path, bytes):
+        return path
+    return path.encode(sys.getfilesystemencoding() or 'utf-8')
+
+def decode_path(path):
+    """return a file name from a system call as os.walk() would
+
+    :param path: the file name, as bytes
+    """
+    if hasattr(os, 'fsdecode'):
+        return os.fsdecode(path)
+    try:
+        return path.decode(sys.getfilesystemencoding() or 'utf-8')
+    except UnicodeDecodeError:
+        # Python 2 leaves names that cannot be decoded as they are
+        return path
+
+def inotify_events(data):
+    """split the data read from an inotify instance into events
+
+    :param data: the bytes read
+
+    Returns a list of (watch descriptor, mask, name) tuples, where the
+    name is bytes, and empty for an event about the watched directory.
+    """
+    events = [ ]
+    offset = 0
+    while offset + INOTIFY_EVENT.size <= len(data):
+        (wd, mask, cookie, length) = INOTIFY_EVENT.unpack_from(data, offset)
+        offset = offset + INOTIFY_EVENT.size
+        name = data[offset:offset+length].rstrip(b'\0')
+        offset = offset + length
+        events.append((wd, mask, name))
+    return events
+
+class inotify_watches:
+    """inotify_watches is an inotify instance, watching a set of
+    directories for changes."""
+    def __init__(self):
+        """create the inotify instance
+
+        Raises OSError if inotify is not available.
+        """
+        libc = None
+        if (ctypes is not None) and (platform.system() == 'Linux'):
+            libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.libc = libc
+        self.fd = self._check(libc.inotify_init1(IN_CLOEXEC))
+        # the directory of each watch descriptor, and the other way
+        self.paths = { }
+        self.watches = { }
+    def _check(self, result):
+        if result < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return result
+    def fileno(self):
+        """return the file descriptor, for select()"""
+        return self.fd
+    def add(self, path):
+        """watch a directory
+
+        :param path: the name of the directory
+
+        Watching a directory again (perhaps under a new name, after it
+        was moved) replaces the old watch.
+        """
+        wd = self._check(self.libc.inotify_add_watch(self.fd,
+                                                     encode_path(path),
+                                                     WATCH_MASK |
+                                                     IN_ONLYDIR |
+                                                     IN_DONT_FOLLOW))
+        old_path = self.paths.get(wd)
+        if (old_path is not None) and (old_path != path):
+            del self.watches[old_path]
+        self.paths[wd] = path
+        self.watches[path] = wd
+    def remove(self, path):
+        """stop watching a directory
+
+        :param path: the name of the directory
+        """
+        wd = self.watches.pop(path, None)
+        if (wd is None) or (self.paths.get(wd) != path):
+            return
+        del self.paths[wd]
+        # the directory may already be gone, which removes the watch
+        self.libc.inotify_rm_watch(self.fd, wd)
+    def read(self):
+        """read the events that are waiting
+
+        Returns a list of (directory, mask, name) tuples, where the name
+        is empty for an event about the directory itself. The directory
+        is None for an event on a watch that was removed, or for an
+        overflow of the queue.
+        """
+        events = [ ]
+        for (wd, mask, name) in inotify_events(os.read(self.fd,
+                                                       INOTIFY_BUFFER)):
+            path = self.paths.get(wd)
+            if mask & IN_IGNORED:
+                # the directory is gone, so the kernel removed the watch
+                if path is not None:
+                    del self.paths[wd]
+                    del self.watches[path]
+                continue
+            events.append((path, mask, decode_path(name)))
+        return events
+    def close(self):
+        """close the inotify instance"""
+        os.close(self.fd)
+
+def unchanged_stat(old, new):
+    """Determine whether a file has the same contents as before, going
+    by its stat values
+
+    :param old: the value returned by os.lstat() earlier
+    :param new: the value returned by os.lstat() now
+    """
+    return (old.st_dev == new.st_dev) and (old.st_ino == new.st_ino) and \
+           (old.st_size == new.st_size) and \
+           (file_time_details(old)[1:] == file_time_details(new)[1:])
+
+class watched_tree:
+    """watched_tree keeps the information about every file below a top
+    directory in memory, so that it can be output again at any time,
+    and updated one entry at a time as files change."""
+    def __init__(self, top, sample=None, matcher=None, one_file_system=False):
+        """initialize the tree, which is empty until it is scanned
+
+        :param top: the top directory
+        :param sample: (block size, number of blocks) to fingerprint
+                       rather than hash files
+        :param matcher: a path_rules object, if only some files are
+                        reported
+        :param one_file_system: True to not descend into other file
+                                systems
+        """
+        self.top = top
+        self.sample = sample
+        self.matcher = matcher
+        self.one_file_system = one_file_system
+        self.root_dev = None
+        # each directory os.walk() would visit, as a tuple of (names
+        # from the top down, chdir_info, dictionary of the entries by
+        # name), where each entry is a tuple of (True if os.walk() lists
+        # it as a directory, file_info)
+        self.sections = { }
+        # the parent directory and name of each directory below the top
+        self.parents = { }
+        # the directory and name of each symbolic link, since whether
+        # os.walk() lists it as a directory depends on its target
+        self.links = set()
+        # an inotify_watches object, if we are watching for changes
+        self.watches = None
+        # names changed in each directory since the last update
+        self.changed = { }
+        self.overflowed = False
+        # the regular files forgotten during an update, by device and
+        # inode, so a directory that was moved need not be read again
+        self.forgotten = { }
+        # the directory and name of each regular file, by device and
+        # inode, since a change through one hard link to a file is only
+        # reported in the directory of that link (and a new link can be
+        # made to any file)
+        self.hard_links = { }
+    def _stat_entry(self, dir_name, name, old, pending):
+        full_path = os.path.normpath(os.path.join(dir_name, name))
+        try:
+            st = os.lstat(full_path)
+        except OSError:
+            # it has gone, and we will hear about that
+            return None
+        if stat.S_ISDIR(st.st_mode):
+            is_dir = True
+        elif stat.S_ISLNK(st.st_mode):
+            # os.walk() lists a link to a directory with the directories
+            is_dir = os.path.isdir(full_path)
+            self.links.add((dir_name, name))
+        else:
+            is_dir = False
+        info = file_info(name, full_path, st, self.sample)
+        if stat.S_ISREG(st.st_mode):
+            self.hard_links.setdefault((st.st_dev, st.st_ino),
+                                       set()).add((dir_name, name))
+            if (old is None) or (old[1].stat.st_ino != st.st_ino):
+                # perhaps it was here under another name
+                earlier = self.forgotten.get((st.st_dev, st.st_ino))
+            else:
+                earlier = old[1]
+            if (earlier is not None) and (earlier.encoded_hash is not None) \
+               and unchanged_stat(earlier.stat, st):
+                info.set_hash(earlier.encoded_hash)
+            else:
+                pending.append(info)
+        return (is_dir, info)
+    def _update_links(self, keys, fresh, pending):
+        # stat the other links to files with hard links again, since
+        # their sizes, times and link counts change with the file
+        for key in keys:
+            for (dir_name, name) in list(self.hard_links.get(key, ( ))):
+                if (dir_name, name) in fresh:
+                    continue
+                entries = self.sections.get(dir_name, (None, None, { }))[2]
+                old = entries.get(name)
+                if (old is None) or \
+                   ((old[1].stat.st_dev, old[1].stat.st_ino) != key):
+                    self.hard_links[key].discard((dir_name, name))
+                    continue
+                entry = self._stat_entry(dir_name, name, old, pending)
+                # anything other than a file is left to its own events
+                if (entry is not None) and \
+                   stat.S_ISREG(entry[1].stat.st_mode):
+                    entries[name] = entry
+            if not self.hard_links.get(key, True):
+                del self.hard_links[key]
+    def _link_keys(self, info, keys):
+        if stat.S_ISREG(info.stat.st_mode) and (info.stat.st_nlink > 1):
+            keys.add((info.stat.st_dev, info.stat.st_ino))
+    def _forget(self, dir_name, name, entry):
+        info = entry[1]
+        if stat.S_ISREG(info.stat.st_mode):
+            key = (info.stat.st_dev, info.stat.st_ino)
+            self.forgotten[key] = info
+            locations = self.hard_links.get(key, set())
+            locations.discard((dir_name, name))
+            if not locations:
+                self.hard_links.pop(key, None)
+    def _remove(self, dir_name, unwatch=True):
+        # forget a directory and everything below it
+        for (name, entry) in self.sections.pop(dir_name)[2].items():
+            self._forget(dir_name, name, entry)
+            child = os.path.join(dir_name, name)
+            if child in self.sections:
+                del self.parents[child]
+                self._remove(child, unwatch)
+        if unwatch and (self.watches is not None):
+            self.watches.remove(dir_name)
+    def _watch(self, dir_name):
+        if self.watches is None:
+            return
+        try:
+            self.watches.add(dir_name)
+        except OSError as e:
+            # most likely too many watches, see max_user_watches
+            sys.stderr.write("Cannot watch '%s' for changes: %s\n" %
+                             (dir_name, e.strerror))
+    def scan(self, dir_name, pending):
+        """walk a directory again, and everything below it
+
+        :param dir_name: the directory, as os.walk() would name it
+        :param pending: a list of file_info objects for files to be
+                        hashed, which is added to
+
+        The hash of each file that has not changed is kept, as long as
+        the file was forgotten during the same update.
+        """
+        old_roots = [ ]
+        if dir_name in self.sections:
+            # the watches are kept, so no change is missed while walking
+            old_roots = self._subtree(dir_name)
+            self._remove(dir_name, False)
+        if dir_name == self.top:
+            try:
+                self.root_dev = os.stat(self.top).st_dev
+            except OSError:
+                return
+        # each directory is watched before it is read, so anything that
+        # changes after we read it is reported
+        self._watch(dir_name)
+        # the hard links found, and the entries that are up to date
+        keys = set()
+        fresh = set()
+        for root, dirs, files in os.walk(dir_name):
+            dirs.sort()
+            files.sort()
+            components = relative_components(self.top, root)
+            if self.matcher is not None:
+                dirs[:] = self.matcher.filter(components, dirs, True)
+                files[:] = self.matcher.filter(components, files, False)
+            entries = { }
+            for name in dirs + files:
+                entry = self._stat_entry(root, name, None, pending)
+                if entry is not None:
+                    entries[name] = entry
+                    self._link_keys(entry[1], keys)
+                    fresh.add((root, name))
+            if root == self.top:
+                st_dev = self.root_dev
+            else:
+                (parent, name) = self.parents[root]
+                st_dev = self.sections[parent][2][name][1].stat.st_dev
+            self.sections[root] = (components, chdir_info(root, st_dev),
+                                   entries)
+            dirs[:] = [ name for name in dirs
+                        if (name in entries) and
+                           stat.S_ISDIR(entries[name][1].stat.st_mode) and
+                           not (self.one_file_system and
+                                (entries[name][1].stat.st_dev !=
+                                 self.root_dev)) ]
+            for name in dirs:
+                child = os.path.join(root, name)
+                self.parents[child] = (root, name)
+                self._watch(child)
+        for root in old_roots:
+            if (root not in self.sections) and (self.watches is not None):
+                self.watches.remove(root)
+        self._update_links(keys, fresh, pending)
+    def _subtree(self, dir_name):
+        subtree = [ dir_name ]
+        for (name, entry) in self.sections[dir_name][2].items():
+            child = os.path.join(dir_name, name)
+            if child in self.sections:
+                subtree.extend(self._subtree(child))
+        return subtree
+    def update_entry(self, dir_name, name, pending, new_dirs=None):
+        """stat one entry of a directory again
+
+        :param dir_name: the directory, as os.walk() would name it
+        :param name: the name of the entry
+        :param pending: a list of files to be hashed, as for scan()
+        :param new_dirs: a list to add a new subdirectory to, if it is
+                         to be walked later rather than now
+
+        A new subdirectory is walked, and a subdirectory that has gone
+        is forgotten, along with everything below it.
+        """
+        if dir_name not in self.sections:
+            return
+        (components, chdir_obj, entries) = self.sections[dir_name]
+        child = os.path.join(dir_name, name)
+        old = entries.pop(name, None)
+        if old is not None:
+            self._forget(dir_name, name, old)
+        entry = self._stat_entry(dir_name, name, old, pending)
+        if (entry is not None) and (self.matcher is not None):
+            if not self.matcher.filter(components, [ name ], entry[0]):
+                entry = None
+        if entry is not None:
+            entries[name] = entry
+        keys = set()
+        for e in (old, entry):
+            if e is not None:
+                self._link_keys(e[1], keys)
+        self._update_links(keys, set([ (dir_name, name) ]), pending)
+        descend = (entry is not None) and \
+                  stat.S_ISDIR(entry[1].stat.st_mode) and \
+                  not (self.one_file_system and
+                       (entry[1].stat.st_dev != self.root_dev))
+        if child in self.sections:
+            if descend and (entry[1].stat.st_ino == old[1].stat.st_ino):
+                # the same directory, whose contents are watched
+                return
+            del self.parents[child]
+            self._remove(child)
+        if descend:
+            self.parents[child] = (dir_name, name)
+            if new_dirs is None:
+                self.scan(child, pending)
+            else:
+                new_dirs.append(child)
+    def add_events(self, events):
+        """record the entries changed, from inotify events
+
+        :param events: a list of (directory, mask, name) tuples, as
+                       returned by inotify_watches.read()
+        """
+        for (dir_name, mask, name) in events:
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+            elif (dir_name is None) or (dir_name not in self.sections):
+                continue
+            elif name:
+                self.changed.setdefault(dir_name, set()).add(name)
+                # the times of the directory itself change too
+                if dir_name in self.parents:
+                    (parent, dir_base) = self.parents[dir_name]
+                    self.changed.setdefault(parent, set()).add(dir_base)
+            elif dir_name == self.top:
+                # there is no parent watching the top directory
+                self.overflowed = True
+    def update(self, pending):
+        """apply the changes recorded by add_events()
+
+        :param pending: a list of files to be hashed, as for scan()
+        """
+        changed = self.changed
+        self.changed = { }
+        if self.overflowed:
+            self.overflowed = False
+            self.scan(self.top, pending)
+        else:
+            # parents first, so a directory that has gone is forgotten
+            # before we try to look in it, and new directories last, so
+            # files moved from elsewhere are forgotten before we get to
+            # them (and their hashes are kept)
+            new_dirs = [ ]
+            for dir_name in sorted(changed,
+                                   key=lambda d: len(self.sections[d][0])
+                                                 if d in self.sections
+                                                 else 0):
+                for name in sorted(changed[dir_name]):
+                    self.update_entry(dir_name, name, pending, new_dirs)
+            for dir_name in new_dirs:
+                (parent, name) = self.parents.get(dir_name, (None, None))
+                if name in self.sections.get(parent, (None, None, { }))[2]:
+                    self.scan(dir_name, pending)
+        # the target of a link may have come or gone
+        for (dir_name, name) in list(self.links):
+            entry = self.sections.get(dir_name, (None, None, { }))[2].get(name)
+            if (entry is None) or not stat.S_ISLNK(entry[1].stat.st_mode):
+                self.links.discard((dir_name, name))
+                continue
+            is_dir = os.path.isdir(entry[1].full_path)
+            if is_dir != entry[0]:
+                self.sections[dir_name][2][name] = (is_dir, entry[1])
+        self.forgotten = { }
+    def output(self, out, prev_stat, inodes, digests=None):
+        """output the information about the tree, as a walk would
+
+        :param out: a file-like object to write to
+        :param prev_stat: the last stat object output
+        :param inodes: a dictionary of the stat objects output for each
+                       inode already output, which is added to
+        :param digests: a directory_digests object, if the digest of
+                        each directory is output
+
+        Returns the last stat object output.
+        """
+        for dir_name in sorted(self.sections,
+                               key=lambda d: self.sections[d][0]):
+            (components, chdir_obj, entries) = self.sections[dir_name]
+            if digests is not None:
+                digests.add(chdir_obj)
+            prev_stat = chdir_obj.output(out, None, prev_stat)
+            for name in sorted(entries, key=lambda n: (not entries[n][0], n)):
+                info = entries[name][1]
+                if info.stat.st_ino in inodes:
+                    # readers take the rest from where it was output
+                    info = cached_info(name, inodes[info.stat.st_ino])
+                else:
+                    inodes[info.stat.st_ino] = info.stat
+                if digests is not None:
+                    digests.add(info)
+                prev_stat = info.output(out, None, prev_stat)
+        return prev_stat
+
+class snapshot_watcher:
+    """snapshot_watcher keeps a snapshot of some directories up to date,
+    with a watched_tree for each."""
+    def __init__(self, directories, header_lines=( ), sample=None,
+                 matcher=None, one_file_system=False, ncpus=1, threads=True):
+        """initialize the watcher
+
+        :param directories: a list of directories
+        :param header_lines: lines to write after the version line
+        :param sample: (block size, number of blocks) to fingerprint
+                       rather than hash files
+        :param matcher: a path_rules object, if only some files are
+                        reported
+        :param one_file_system: True to not descend into other file
+                                systems
+        :param ncpus: the number of hashing tasks to use
+        :param threads: True to hash in threads, False for processes
+        """
+        self.trees = [ watched_tree(make_type_unicode(top), sample, matcher,
+                                    one_file_system)
+                       for top in directories ]
+        if stat_has_time_ns():
+            self.version_line = '%%fileinfo %s+n\n' % FILEINFO_VERSION
+        else:
+            self.version_line = '%%fileinfo %s\n' % FILEINFO_VERSION
+        self.header_lines = header_lines
+        self.ncpus = ncpus
+        self.threads = threads
+        # a count of the bytes hashed
+        if threads or (ncpus <= 1):
+            self.bytes_read = LocalCounter()
+        else:
+            self.bytes_read = multiprocessing.Value('d', 0)
+        # True to output the digest of each directory
+        self.digests = False
+        # the hashing tasks, started by start() and kept until close()
+        self.pool = None
+    def start(self, watch=True):
+        """walk the directories, and start watching them
+
+        :param watch: False to only walk the directories, so update()
+                      must be told what changed (for testing)
+
+        Raises OSError if inotify is not available.
+        """
+        if watch:
+            for tree in self.trees:
+                tree.watches = inotify_watches()
+        self.pool = hashing_pool(self.ncpus, self.threads, self.bytes_read)
+        pending = [ ]
+        for tree in self.trees:
+            tree.scan(tree.top, pending)
+        self._hash(pending)
+    def close(self):
+        """stop the hashing tasks"""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+    def _hash(self, pending):
+        # a file with hard links only needs to be read once
+        first = { }
+        infos = [ ]
+        for info in pending:
+            key = (info.stat.st_dev, info.stat.st_ino)
+            if key not in first:
+                first[key] = len(infos)
+                infos.append(info)
+        # processes hash copies of the file_info objects, so the results
+        # are copied back to the ones in the trees
+        hashed = self.pool.hash(infos)
+        for result in hashed:
+            result.report_error(sys.stderr)
+        for info in pending:
+            result = hashed[first[(info.stat.st_dev, info.stat.st_ino)]]
+            info.set_hash(result.encoded_hash)
+            info.set_hashing_error(result.hashing_error)
+    def read_events(self, timeout):
+        """wait for changes, and record them
+
+        :param timeout: the most seconds to wait, or None to wait until
+                        something changes
+
+        Returns True if there were any changes.
+        """
+        ready = select.select([ tree.watches for tree in self.trees ],
+                              [ ], [ ], timeout)[0]
+        for tree in self.trees:
+            if tree.watches in ready:
+                tree.add_events(tree.watches.read())
+        return bool(ready)
+    def update(self):
+        """apply the changes recorded, hashing the files that changed"""
+        pending = [ ]
+        for tree in self.trees:
+            tree.update(pending)
+        self._hash(pending)
+    def output(self, out):
+        """output the snapshot
+
+        :param out: a file-like object to write to
+        """
+        out.write(self.version_line)
+        for line in self.header_lines:
+            out.write(line)
+        prev_stat = None
+        inodes = { }
+        if self.digests:
+            digests = directory_digests(out)
+        else:
+            digests = None
+        for tree in self.trees:
+            prev_stat = tree.output(out, prev_stat, inodes, digests)
+        if digests is not None:
+            digests.finish()
+    def write_snapshot(self, outfile_name):
+        """write the snapshot over a file, all at once
+
+        :param outfile_name: the name of the file
+        """
+        temp_name = outfile_name + '.new'
+        outfile = open(temp_name, 'w')
+        try:
+            self.output(outfile)
+        finally:
+            outfile.close()
+        os.rename(temp_name, outfile_name)
+    def watch(self, outfile_name, interval=WATCH_INTERVAL):
+        """write a snapshot whenever files change, until we are killed
+
+        :param outfile_name: the name of the file to write to
+        :param interval: seconds to collect changes for, once something
+                         changes, before writing the snapshot (so a file
+                         being written is not hashed over and over)
+        """
+        try:
+            self.write_snapshot(outfile_name)
+            while True:
+                self.read_events(None)
+                deadline = time.time() + interval
+                while True:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.read_events(remaining)
+                self.update()
+                self.write_snapshot(outfile_name)
+        finally:
+            self.close()
+
 def main():
     begin_time = time.time()
 
@@ -1146,16 +4836,26 @@ def main():
         ncpus = 1
         can_count_cpus = False
     else:
-        ncpus = multiprocessing.cpu_count()
+        ncpus = available_cpus()
         can_count_cpus = True
 
     parser = argparse.ArgumentParser(description='Output file information, or check files information.')
     if can_count_cpus:
-        help='(defaults to number of cores, which is %d on this system)' % ncpus
+        help='(defaults to number of cores available, which is %d on this system), or "auto" to adjust while running' % ncpus
     else:
         help='(defaults to 1, since we cannot count CPUs on this system)'
-    parser.add_argument('-n', '--ncpus', type=int,
+    parser.add_argument('-n', '--ncpus', type=ncpus_arg,
                         help='number of cores to use ' + help)
+    if use_threads:
+        engines = ('threads', )
+        engine = 'threads'
+        help = '(only threads are available on this system)'
+    else:
+        engines = ('threads', 'processes', 'auto')
+        engine = 'processes'
+        help = '(defaults to processes), or "auto" to use threads on CPython with up to %d cores and processes otherwise' % ENGINE_MAX_THREADS
+    parser.add_argument("--engine", choices=engines, default=engine,
+                        help='run hashing in threads or in separate processes ' + help)
     parser.add_argument('-p', '--progress', action="store_true",
                         help='output updates as processing occurs')
     parser.add_argument('-s', '--summary', action="store_true",
@@ -1166,16 +4866,181 @@ def main():
                         help='check files against information in a file')
     parser.add_argument('-i', "--infile", type=str,
                         help='file to read from if checking (defaults to STDIN)')
+    parser.add_argument("--profile", type=str,
+                        help='write a report of time spent in each stage of processing to this file, in JSON format')
+    parser.add_argument("--checkpoint", type=str,
+                        help='periodically record progress in this file, so an interrupted run can be resumed (requires --outfile)')
+    parser.add_argument("--checkpoint-interval", type=float, default=300,
+                        help='seconds between checkpoints (defaults to 300)')
+    parser.add_argument("--resume", action="store_true",
+                        help='continue the output from the checkpoint file')
+    parser.add_argument("--time-limit", type=float,
+                        help='stop after this many seconds, recording a checkpoint so the run can be resumed later')
+    parser.add_argument("--exclude", type=rule_arg('exclude'),
+                        action="append", dest="rules", metavar="PATTERN",
+                        help='do not report files or directories matching this .gitignore-style pattern (may be repeated, the last matching --exclude or --include wins)')
+    parser.add_argument("--include", type=rule_arg('include'),
+                        action="append", dest="rules", metavar="PATTERN",
+                        help='report files or directories matching this pattern, even if excluded by an earlier rule')
+    parser.add_argument("--exclude-from", type=rule_arg('file'),
+                        action="append", dest="rules", metavar="FILE",
+                        help='read patterns to exclude from this file, in .gitignore format ("!" before a pattern includes it)')
+    parser.add_argument('-x', "--one-file-system", action="store_true",
+                        help='do not descend into directories on other file systems (mount points are still reported)')
+    parser.add_argument("--mount-markers", action="store_true",
+                        help='with --one-file-system, output a line for each mount point not descended into')
+    parser.add_argument("--sample", action="store_true",
+                        help='output a fingerprint of the size and some blocks of each file (marked with "~") rather than the hash of all of it, for a quick check of large files')
+    parser.add_argument("--sample-size", type=sample_arg, default=SAMPLE_SIZE,
+                        help='bytes in each block read for --sample (defaults to %d)' % SAMPLE_SIZE)
+    parser.add_argument("--sample-count", type=sample_arg, default=SAMPLE_COUNT,
+                        help='number of blocks read for --sample, including the first and last (defaults to %d)' % SAMPLE_COUNT)
+    parser.add_argument("--kernel-hash", action="store_true",
+                        help='on Linux, have the kernel hash large files (with an AF_ALG socket and sendfile), so the contents are not copied into Python; the hashes are the same, and hashlib is used where this is not available, for files over 2147479552 bytes, and while the read rate is limited')
+    parser.add_argument("--max-read-rate", type=rate_arg, metavar="RATE",
+                        help='read files for hashing at no more than RATE bytes per second, in total (a K, M, or G suffix multiplies by 1024, 1024^2, or 1024^3)')
+    parser.add_argument("--max-file-rate", type=rate_arg, metavar="RATE",
+                        help='look at no more than RATE files and directories per second')
+    parser.add_argument("--rate-control", type=str, metavar="FILE",
+                        help='change the rates while running, from a file with lines like "read-rate 10M" or "file-rate 500" (0 for no limit), which is read again when it changes or on SIGHUP')
+    parser.add_argument("--schedule-window", type=int, default=SCHEDULE_WINDOW, metavar="N",
+                        help='with more than one core, hash the largest of the next N files first, so large files do not hold up the output at the end (defaults to %d, 0 hashes files in output order)' % SCHEDULE_WINDOW)
+    parser.add_argument("--stat-threads", type=int, default=0, metavar="N",
+                        help='call lstat() on up to %d times N files at once, in N threads, which is much faster on network file systems such as NFS (defaults to 0, calling lstat() on one file at a time)' % STAT_PREFETCH_DEPTH)
+    parser.add_argument("--shared-extents", action="store_true",
+                        help='on Linux, do not read files that share all of their data with an earlier file of the same size (copy-on-write clones on btrfs or XFS), but output the same hash')
+    parser.add_argument("--duplicates", action="store_true",
+                        help='rather than file information, output sets of files with the same contents, largest waste of space first')
+    parser.add_argument("--serve", type=str, metavar="SOCKET",
+                        help='keep running, with the hashing tasks started, and answer requests for snapshots or checks on this Unix socket (the other options apply to every request)')
+    parser.add_argument("--connect", type=str, metavar="SOCKET",
+                        help='ask the server on this Unix socket (see --serve) for the output, instead of reading the files here')
+    parser.add_argument("--watch", action="store_true",
+                        help='on Linux, keep running after writing the output file, and write a new snapshot over it whenever files change, using inotify so that only the files that changed are looked at again')
+    parser.add_argument("--watch-interval", type=float, default=WATCH_INTERVAL, metavar="SECONDS",
+                        help='with --watch, collect changes for this many seconds before writing a new snapshot (defaults to %g)' % WATCH_INTERVAL)
+    parser.add_argument("--digests", action="store_true",
+                        help='after each directory and everything below it, output a line with a digest of their information (marked with "*"), so that snapshots can be compared a subtree at a time')
+    parser.add_argument("--shard", type=shard_arg, metavar="I/N",
+                        help='only output shard I of N (counting from 0), to be combined with the other shards by merge_shards.py')
     parser.add_argument('directory', nargs="*",
                         help='where to report file information from (reports current directory if none specified)')
     args = parser.parse_args()
 
     # note that we explicitly ignore a CPU count of 0, and leave the
     # count at the default
-    if args.ncpus:
+    auto_ncpus = False
+    if args.ncpus == 'auto':
+        # we use the available cores as the most we will try
+        auto_ncpus = True
+    elif args.ncpus:
         ncpus = args.ncpus
 
-    if args.outfile:
+    if (args.resume or (args.time_limit is not None)) and \
+       not args.checkpoint:
+        parser.error("--resume and --time-limit require --checkpoint")
+    if args.checkpoint and not args.outfile:
+        parser.error("--checkpoint requires --outfile")
+    if args.shard and args.checkpoint:
+        parser.error("--shard cannot be used with --checkpoint")
+    if args.duplicates and (args.shard or args.checkpoint or args.check):
+        parser.error("--duplicates cannot be used with --shard, --checkpoint or --check")
+    limited = (args.max_read_rate or args.max_file_rate or args.rate_control)
+    if args.duplicates and limited:
+        parser.error("--duplicates cannot be used with rate limits")
+    if args.digests and (args.checkpoint or args.duplicates or args.check):
+        parser.error("--digests cannot be used with --checkpoint, --duplicates or --check")
+    if args.mount_markers and not args.one_file_system:
+        parser.error("--mount-markers requires --one-file-system")
+    if (args.serve or args.connect) and \
+       (args.shard or args.checkpoint or args.duplicates or args.progress or
+        args.profile):
+        parser.error("--serve and --connect cannot be used with --shard, --checkpoint, --duplicates, --progress or --profile")
+    if args.serve and (args.check or args.connect):
+        parser.error("--serve cannot be used with --check or --connect")
+    if args.connect and args.check and not args.infile:
+        parser.error("--connect with --check requires --infile")
+    if args.watch and not args.outfile:
+        parser.error("--watch requires --outfile")
+    if args.watch and \
+       (args.check or args.shard or args.checkpoint or args.duplicates or
+        args.serve or args.connect or args.progress or args.profile or
+        args.mount_markers or limited):
+        parser.error("--watch cannot be used with --check, --shard, --checkpoint, --duplicates, --serve, --connect, --progress, --profile, --mount-markers or rate limits")
+
+    rules = [ ]
+    for (action, pattern) in args.rules or [ ]:
+        if action == 'file':
+            try:
+                rules.extend(read_rules_file(pattern))
+            except (IOError, OSError) as e:
+                parser.error("cannot read rules from '%s': %s" %
+                             (pattern, e.strerror))
+        else:
+            rules.append((action, pattern))
+    if rules:
+        matcher = path_rules(rules)
+        header_lines = matcher.header_lines()
+    else:
+        matcher = None
+        header_lines = [ ]
+    if args.sample:
+        sample = (args.sample_size, args.sample_count)
+        header_lines.append('%%sample %d %d\n' % sample)
+    else:
+        sample = None
+    if args.digests:
+        header_lines.append(DIGESTS_HEADER)
+    if args.shard:
+        header_lines.append('%%shard %d/%d\n' % args.shard)
+    if args.kernel_hash and not set_kernel_hash(True):
+        sys.stderr.write("Kernel hashing is not available, using hashlib\n")
+
+    if args.directory:
+        fileinfo_dirs = args.directory
+    else:
+        fileinfo_dirs = [ '.' ]
+
+    if args.connect:
+        # the server has a different working directory, so paths are
+        # relative to ours
+        if args.check:
+            request = { 'command': 'check',
+                        'snapshot': args.infile,
+                        'cwd': os.getcwd() }
+        else:
+            request = { 'command': 'snapshot',
+                        'directories': fileinfo_dirs,
+                        'cwd': os.getcwd() }
+        if args.outfile:
+            outfile = open(args.outfile, 'w')
+        else:
+            outfile = sys.stdout
+        try:
+            lines = connect_server(args.connect, request, outfile)
+        except (server_error, socket.error) as e:
+            outfile.flush()
+            sys.stderr.write("Error from server: %s\n" %
+                             (getattr(e, 'strerror', None) or e))
+            sys.exit(1)
+        outfile.flush()
+        if args.check and lines:
+            sys.exit(1)
+        return
+
+    resume_state = None
+    if args.resume:
+        resume_state = read_checkpoint(args.checkpoint)
+        if resume_state['directories'] != fileinfo_dirs:
+            parser.error("directories do not match those in the checkpoint")
+        if resume_state.get('rules', [ ]) != [ list(r) for r in rules ]:
+            parser.error("rules do not match those in the checkpoint")
+        # throw away any output after the checkpoint and add to the rest
+        outfile = open(args.outfile, 'r+')
+        outfile.truncate(resume_state['offset'])
+        outfile.seek(0, os.SEEK_END)
+    elif args.outfile and not args.watch:
+        # (a watcher replaces the output file, see write_snapshot())
         outfile = open(args.outfile, 'w')
     else:
         outfile = sys.stdout
@@ -1185,110 +5050,348 @@ def main():
     else:
         infile = sys.stdin
 
-    if args.directory:
-        fileinfo_dirs = args.directory
-    else:
-        fileinfo_dirs = [ '.' ]
-
     # if we are threading, we use the Queue and threading modules,
     # otherwise the multiprocessing module
-    if use_threads:
+    threads = (choose_engine(args.engine, ncpus) == 'threads')
+    if threads:
         my_queue_type = Queue.Queue
         my_thread_type = threading.Thread
     else:
         my_queue_type = multiprocessing.Queue
         my_thread_type = multiprocessing.Process
 
-    if args.check:
+    # the limits are shared by all of the tasks, so they are created
+    # before any processes
+    if limited:
+        byte_limit = token_bucket(args.max_read_rate or 0,
+                                  (not threads) and (ncpus > 1))
+        file_limit = token_bucket(args.max_file_rate or 0)
+    else:
+        byte_limit = None
+        file_limit = None
+
+    if args.serve:
+        # stop cleanly, so the socket is removed and processes stopped
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda signum, frame: sys.exit(0))
+        if ncpus > 1:
+            q_checksum = my_queue_type(ncpus * 4)
+            q_results = my_queue_type()
+            for n in range(ncpus):
+                task = my_thread_type(target=checksum_generator,
+                                      args=(q_checksum, q_results, None,
+                                            None, 'checksum-%d' % n, None,
+                                            n, kernel_hash, byte_limit))
+                task.daemon = True
+                task.start()
+        else:
+            q_checksum = None
+            q_results = None
+        server = snapshot_server(q_checksum, q_results, header_lines, sample,
+                                 matcher, args.one_file_system)
+        server.file_limit = file_limit
+        server.byte_limit = byte_limit
+        server.digests = args.digests
+        server.mount_markers = args.mount_markers
+        server.shared_extents = args.shared_extents
+        if args.stat_threads > 0:
+            server.prefetcher = stat_prefetcher(args.stat_threads,
+                                                file_limit)
+        if args.rate_control:
+            start_rate_controller(args.rate_control, byte_limit, file_limit)
+        try:
+            server.serve(args.serve)
+        except (server_error, socket.error) as e:
+            sys.stderr.write("Error starting server: %s\n" %
+                             (getattr(e, 'strerror', None) or e))
+            sys.exit(1)
+    elif args.watch:
+        watcher = snapshot_watcher(fileinfo_dirs, header_lines, sample,
+                                   matcher, args.one_file_system, ncpus,
+                                   threads)
+        watcher.digests = args.digests
+        try:
+            watcher.start()
+        except OSError as e:
+            sys.stderr.write("Cannot watch for changes: %s\n" % e.strerror)
+            sys.exit(1)
+        watcher.watch(args.outfile, args.watch_interval)
+    elif args.check:
+        if args.rate_control:
+            start_rate_controller(args.rate_control, byte_limit, file_limit)
         stream = file_info_input_stream(infile)
-        while True:
-            info = stream.read_next()
-            if info is None:
-                break
+        problems = check_hashes(stream, outfile, byte_limit)
+        if problems:
+            outfile.flush()
+            sys.exit(1)
+    elif args.duplicates:
+        # we hash everything we need at once, so there is nothing to tune
+        auto_ncpus = False
+        if threads:
+            bytes_read = LocalCounter()
+        else:
+            bytes_read = multiprocessing.Value('d', 0)
+        fileinfo_dirs = [ make_type_unicode(d) for d in fileinfo_dirs ]
+        (duplicates, total_dirs, total_files) = \
+            find_duplicates(fileinfo_dirs, ncpus, threads, rules,
+                            args.one_file_system, bytes_read)
+        writer = WriterWithSize(outfile)
+        output_duplicates(writer, duplicates)
+        writer.flush()
+        bytes_written = writer.size
+        total_bytes_read = int(bytes_read.value)
+        if args.summary:
+            wasted = sum([ size * (len(paths) - 1)
+                           for (size, encoded_hash, paths) in duplicates ])
+            sys.stderr.write("Duplicate sets:        %8d\n" % len(duplicates))
+            sys.stderr.write("Bytes duplicated:      %8d (%s)\n" %
+                             (wasted, human_bytes(wasted)))
     else:
-        if args.progress:
-            total_dirs = 0
-            total_files = 0
-            sys.stderr.write("Collecting file counts...")
-            for fileinfo_dir in fileinfo_dirs:
-                for root, dirs, files in os.walk(fileinfo_dir):
-                    for name in dirs:
-                        total_dirs = total_dirs + 1
-                    for name in files:
-                        total_files = total_files + 1
-                    sys.stderr.write("\rCollecting file counts... %d %s in %d %s" %
-                        (total_files, plural(total_files, "file"),
-                         total_dirs, plural(total_dirs, "dir")))
-            sys.stderr.write("\n")
-            progress = progress_output(total_dirs, total_files, 0.1)
+        if args.profile:
+            q_profile = my_queue_type()
+        else:
+            q_profile = None
+
+        if resume_state is None:
+            last_stat = None
+        else:
+            last_stat = saved_stat(resume_state['last_stat'])
+        write_header = resume_state is None
+        # a shard cannot know the digests of the directories it shares
+        # with the others, so merge_shards.py outputs them all
+        write_digests = args.digests and not args.shard
 
         # create processing units
         if ncpus == 1:
-            stream = file_info_output_stream_immediate(outfile)
+            stream = file_info_output_stream_immediate(outfile,
+                                                       header=write_header,
+                                                       header_lines=header_lines)
         else:
+            # the hashing tasks all add to a single count of bytes read
+            if threads:
+                bytes_read = LocalCounter()
+            else:
+                bytes_read = multiprocessing.Value('d', 0)
+            # with automatic tuning, only some of the tasks work at once
+            if not auto_ncpus:
+                active = None
+            elif threads:
+                active = LocalCounter()
+            else:
+                active = multiprocessing.Value('i', 0)
+            if active is not None:
+                active.value = min(AUTO_START, ncpus)
             # XXX: how big should this queue be?
             q_checksum = my_queue_type(ncpus * 4)
             q_serializer = my_queue_type()
             for n in range(ncpus):
                 my_thread_type(target=checksum_generator,
-                                        args=(q_checksum, q_serializer)).start()
+                               args=(q_checksum, q_serializer, bytes_read,
+                                     q_profile, 'checksum-%d' % n,
+                                     active, n, kernel_hash,
+                                     byte_limit)).start()
             stream = file_info_output_stream_background(outfile,
-                                                       q_checksum, q_serializer)
+                                                       q_checksum, q_serializer,
+                                                       bytes_read,
+                                                       write_header,
+                                                       header_lines,
+                                                       args.schedule_window)
             serializer_task = my_thread_type(target=serializer,
                                            args=(q_serializer, ncpus,
-                                                 stream.outfile))
+                                                 stream.outfile, q_profile,
+                                                 last_stat, write_digests,
+                                                 bytes_read, byte_limit))
             serializer_task.start()
 
+        # count files in the background while we work, starting after
+        # any processes have been created so they don't inherit the thread
+        if args.progress:
+            progress = progress_output(0, 0, 0.1, totals_complete=False,
+                                       stream=stream)
+            counter_task = threading.Thread(target=count_files,
+                                            args=(fileinfo_dirs, progress,
+                                                  matcher,
+                                                  args.one_file_system,
+                                                  args.shard, file_limit))
+            counter_task.daemon = True
+            counter_task.start()
+            progress.start()
+        if args.rate_control:
+            start_rate_controller(args.rate_control, byte_limit, file_limit)
+
+        if args.profile:
+            stream.profile = profile_stats('main')
+        stream.sample = sample
+        stream.shared_extents = args.shared_extents
+        stream.byte_limit = byte_limit
+        stream.file_limit = file_limit
+        if write_digests and (ncpus == 1):
+            stream.digests = directory_digests(stream.outfile)
+        if args.stat_threads > 0:
+            stream.prefetcher = stat_prefetcher(args.stat_threads,
+                                                file_limit)
+
+        if auto_ncpus and (ncpus > 1):
+            tuner_finished = threading.Event()
+            tuner_task = threading.Thread(target=pool_tuner,
+                                          args=(active, ncpus,
+                                                stream.bytes_read,
+                                                tuner_finished))
+            tuner_task.daemon = True
+            tuner_task.start()
+
+        if resume_state is not None:
+            stream.restore_checkpoint(resume_state)
+            resume_root = resume_state['root']
+            resume_path = resume_state['path']
+        else:
+            resume_root = -1
+            resume_path = None
+        last_checkpoint = time.time()
+        out_of_time = False
+
         total_dirs = 0
         total_files = 0
-        total_bytes_read = 0
-        for fileinfo_dir in fileinfo_dirs:
+        unit = 0
+        for (root_index, fileinfo_dir) in enumerate(fileinfo_dirs):
+            # skip top directories completely output before a checkpoint
+            if root_index < resume_root:
+                continue
+
             # In Python 2, if we invoke os.walk() with a Unicode string
             # we'll get Unicode file names, so we need to insure that
             # our directory names are Unicode.
             # Python 3 of course always returns Unicode names.
             fileinfo_dir = make_type_unicode(fileinfo_dir)
+            if args.one_file_system:
+                root_dev = os.stat(fileinfo_dir).st_dev
 
-            for root, dirs, files in os.walk(fileinfo_dir):
-                # XXX: we can skip output for empty directories
-                stream.output_dir(root)
-                if args.progress:
-                    progress.update(1, 0)
+            for root, dirs, files in profiled_walk(fileinfo_dir,
+                                                   stream.profile,
+                                                   file_limit):
                 # do dirs first then files to give us some pipelining...
                 # might be nice to have some sort algorithm that outputs
                 # as it goes... so the remaining processing can start
                 # while the sort completes... hm...
+                # (the sort also sets the order os.walk() descends in,
+                # which resuming from a checkpoint depends on)
                 dirs.sort()
+                if args.checkpoint or (matcher is not None) or args.shard:
+                    components = relative_components(fileinfo_dir, root)
+                if matcher is not None:
+                    # pruning dirs here stops os.walk() descending into
+                    # excluded directories
+                    dirs[:] = matcher.filter(components, dirs, True)
+                    files[:] = matcher.filter(components, files, False)
+                if (root_index == resume_root) and (resume_path is not None):
+                    if already_output(components, dirs, resume_path):
+                        # once we reach the checkpoint, we are caught up
+                        if components == resume_path:
+                            resume_path = None
+                        if args.one_file_system:
+                            stream.prune_mounts(root, dirs, root_dev)
+                        continue
+                if args.shard and not components:
+                    if not shard_owns(unit, args.shard):
+                        # every shard numbers the subtrees the same way
+                        if args.one_file_system:
+                            stream.prune_mounts(root, dirs, root_dev)
+                        (subtree_units, unit) = shard_subtrees(dirs, unit,
+                                                               args.shard)
+                        continue
+                    stream.output_unit(unit)
+                elif args.shard and (len(components) == 1):
+                    stream.output_unit(subtree_units[components[0]])
+                files.sort()
+                stream.prefetch_stats(root, dirs + files)
+                # XXX: we can skip output for empty directories
+                stream.output_dir(root)
+                if args.progress:
+                    progress.update(1, 0)
                 for name in dirs:
                     stream.output_file(root, name)
                     if args.progress:
                         progress.update(0, 1)
-                files.sort()
+                total_dirs = total_dirs + len(dirs)
+                if args.one_file_system:
+                    stream.prune_mounts(root, dirs, root_dev,
+                                        args.mount_markers)
+                if args.shard and not components:
+                    (subtree_units, unit) = shard_subtrees(dirs, unit,
+                                                           args.shard)
                 for name in files:
                     stream.output_file(root, name)
                     if args.progress:
                         progress.update(0, 1)
-                total_dirs = total_dirs + len(dirs)
                 total_files = total_files + len(files)
 
+                if args.checkpoint:
+                    now = time.time()
+                    if (args.time_limit is not None) and \
+                       (now - begin_time >= args.time_limit):
+                        out_of_time = True
+                    if out_of_time or \
+                       (now - last_checkpoint >= args.checkpoint_interval):
+                        stream.output_checkpoint(args.checkpoint,
+                                                 fileinfo_dirs, root_index,
+                                                 components, rules)
+                        last_checkpoint = now
+                    if out_of_time:
+                        break
+            if out_of_time:
+                break
+
+        # the main thread is done with its own work at this point
+        stream.flush()
+        if args.profile:
+            profiles = [ stream.profile.data() ]
+
         # finish processing and wait for completion
         if ncpus > 1:
+            # every hashing task has to be working to see the end
+            if active is not None:
+                tuner_finished.set()
+                tuner_task.join()
+                final_active = active.value
+                with active.get_lock():
+                    active.value = ncpus
             for n in range(ncpus):
                 q_checksum.put(None)
+            # collect the statistics before joining, since a process
+            # doesn't exit until everything it put on a queue is read
+            if args.profile:
+                for n in range(ncpus + 1):
+                    profiles.append(q_profile.get())
             serializer_task.join()
             bytes_written = q_serializer.get()
         else:
             bytes_written = stream.outfile.size
+        total_bytes_read = int(stream.bytes_read.value)
+
+        if out_of_time:
+            sys.stderr.write("Time limit reached, continue with --resume\n")
+        elif args.checkpoint and os.path.exists(args.checkpoint):
+            # the output is complete, so there is nothing to resume
+            os.remove(args.checkpoint)
 
         if args.progress:
             progress.complete()
 
+        if args.profile:
+            profile_file = open(args.profile, 'w')
+            json.dump(profile_report(profiles), profile_file,
+                      indent=1, sort_keys=True)
+            profile_file.write("\n")
+            profile_file.close()
+
     if args.summary:
         sys.stderr.write("Number of directories: %8d\n" % total_dirs)
         sys.stderr.write("Number of files:       %8d\n" % total_files)
-        # XXX: gather total bytes
-#        sys.stderr.write("  Total size:   %15d (%s)\n" % 
-#                         (total_bytes_read, human_bytes(total_bytes_read)))
+        if auto_ncpus and (ncpus > 1):
+            sys.stderr.write("Hashing tasks at end:  %8d (of %d)\n" %
+                             (final_active, ncpus))
+        sys.stderr.write("Bytes read:            %8d (%s)\n" %
+                         (total_bytes_read, human_bytes(total_bytes_read)))
         total_run_time = time.time() - begin_time
         sys.stderr.write("Total run time: %15s\n" % human_time(total_run_time))
         if total_run_time > 0:
@@ -1296,11 +5399,12 @@ def main():
                              (total_dirs / total_run_time))
             sys.stderr.write("  Files / second:        %8.1f\n" % 
                              (total_files / total_run_time))
+            sys.stderr.write("  MB / second:           %8.1f\n" %
+                             (total_bytes_read / total_run_time / 1000000))
         else:
-            sys.stderr.write("  Directories / second:       -.-\n" % 
-                             (total_dirs / total_run_time))
-            sys.stderr.write("  Files / second:             -.-\n" % 
-                             (total_files / total_run_time))
+            sys.stderr.write("  Directories / second:       -.-\n")
+            sys.stderr.write("  Files / second:             -.-\n")
+            sys.stderr.write("  MB / second:                -.-\n")
             
         if total_files > 0:
             sys.stderr.write("Size of output:        %8d (%.1f bytes/file)\n" %
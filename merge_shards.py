@@ -0,0 +1,188 @@
+"""
+This program merges the shards written by "fileinfo.py --shard I/N"
+into a single snapshot, identical to the one that a single run of
+fileinfo.py would have written.
+
+For example, to write a snapshot in 4 shards in parallel (which could
+also be run on different machines sharing the same storage):
+
+    $ for i in 0 1 2 3; do
+    >     python fileinfo.py --shard $i/4 -o shard.$i /data &
+    > done; wait
+    $ python merge_shards.py -o data.fileinfo shard.0 shard.1 shard.2 shard.3
+
+Each shard holds some of the units of work (see shard_subtrees() in
+fileinfo.py), in order, each starting with an '&' line. The merge reads
+the next unit from whichever shard has it, so only one line of each
+shard needs to be in memory at a time.
+
+Each shard was written without knowing about the others, so the
+information about each file was output relative to the previous file
+in the same shard, and a hard link is only output as a cached inode
+(an '@' line) if the inode was seen in the same shard. The merge undoes
+this, and outputs each file relative to the previous file in the
+merged snapshot, with cached inodes wherever a single run would have
+them. A shard cannot know the digests of the directories it shares with
+the others, so if the snapshot has digests (see "fileinfo.py
+--digests"), the merge outputs them all.
+"""
+
+import sys
+import heapq
+import argparse
+
+import fileinfo
+
+class merge_error(Exception):
+    """merge_error is raised when the shards cannot be merged"""
+    pass
+
+class merged_output:
+    """merged_output writes the items read from the shards, with the
+    delta encoding and inode cache of a single run."""
+    def __init__(self, out, digests=False):
+        """initialize the merged output
+
+        :param out: a file-like object to write the snapshot to
+        :param digests: True to output the digest of each directory
+        """
+        self.out = out
+        self.prev_fields = None
+        # the complete fields of each inode output
+        self.inodes = { }
+        if digests:
+            self.digests = fileinfo.directory_digests(out)
+        else:
+            self.digests = None
+    def write(self, item, fields):
+        """output an item read from a shard
+
+        :param item: a tuple of (type, value), from read_next()
+        :param fields: the complete fields of a file or cached inode
+        """
+        (item_type, value) = item
+        if item_type in ('dir', 'msdos_dir'):
+            if item_type == 'dir':
+                cmd = "!"
+            else:
+                cmd = ":"
+            if self.digests is not None:
+                self.digests.directory(cmd, value)
+            self.out.write(cmd + value + "\n")
+        elif item_type == 'skipped_mount':
+            if self.digests is not None:
+                self.digests.skipped_mount(value)
+            self.out.write("-" + value + "\n")
+        elif item_type in ('file', 'inode'):
+            inode = fields['i']
+            if inode in self.inodes:
+                self.out.write("i" + inode + "\n")
+                self.out.write("@" + value + "\n")
+                self.prev_fields = self.inodes[inode]
+                if self.digests is not None:
+                    self.digests.write("i" + inode + "\n@" + value + "\n")
+            else:
+                fileinfo.encode_fields(self.out, fields, self.prev_fields)
+                self.out.write(">" + value + "\n")
+                self.inodes[inode] = fields
+                self.prev_fields = fields
+                if self.digests is not None:
+                    fileinfo.encode_fields(self.digests, fields, None)
+                    self.digests.write(">" + value + "\n")
+        elif item_type == 'digest':
+            # the digests are all output again (see finish())
+            pass
+        else:
+            raise merge_error("unexpected %s in shard" % item_type)
+    def finish(self):
+        """output the digests of the directories still open, at the end
+        of the snapshot"""
+        if self.digests is not None:
+            self.digests.finish()
+
+def read_headers(streams):
+    """check the shards belong together, and return the header lines
+
+    :param streams: a list of file_info_input_stream objects, which
+                    have each read their first item
+    """
+    counts = set([ stream.shard and stream.shard[1] for stream in streams ])
+    if None in counts:
+        raise merge_error("not a shard")
+    if len(counts) != 1:
+        raise merge_error("shards are from different runs")
+    count = counts.pop()
+    indexes = sorted([ stream.shard[0] for stream in streams ])
+    if indexes != list(range(count)):
+        raise merge_error("expected shards 0 to %d, got %s" %
+                          (count - 1, ", ".join(map(str, indexes))))
+    for stream in streams[1:]:
+        if (stream.nano != streams[0].nano) or \
+           (stream.header_lines != streams[0].header_lines):
+            raise merge_error("shards are from different runs")
+    if streams[0].nano:
+        version = '%%fileinfo %s+n\n' % fileinfo.FILEINFO_VERSION
+    else:
+        version = '%%fileinfo %s\n' % fileinfo.FILEINFO_VERSION
+    return [ version ] + streams[0].header_lines
+
+def merge_shards(instreams, out):
+    """merge the shards of a snapshot into a single snapshot
+
+    :param instreams: a list of file-like objects to read the shards from
+    :param out: a file-like object to write the snapshot to
+    """
+    streams = [ fileinfo.file_info_input_stream(f) for f in instreams ]
+    # the heap has the number of the next unit in each shard
+    heap = [ ]
+    for (n, stream) in enumerate(streams):
+        item = stream.read_next()
+        if item is None:
+            continue
+        if item[0] != 'unit':
+            raise merge_error("shard %d does not start with a unit" % n)
+        heapq.heappush(heap, (item[1], n))
+    for line in read_headers(streams):
+        out.write(line)
+
+    output = merged_output(out, streams[0].digests)
+    next_unit = 0
+    while heap:
+        (unit, n) = heapq.heappop(heap)
+        if unit != next_unit:
+            raise merge_error("unit %d is missing" % next_unit)
+        next_unit = next_unit + 1
+        stream = streams[n]
+        while True:
+            item = stream.read_next()
+            if item is None:
+                break
+            if item[0] == 'unit':
+                heapq.heappush(heap, (item[1], n))
+                break
+            output.write(item, stream.fields)
+    output.finish()
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge the shards written by "fileinfo.py --shard" into a single snapshot.')
+    parser.add_argument('-o', '--outfile', type=str,
+                        help='file to write to (defaults to STDOUT)')
+    parser.add_argument('shard', nargs="+",
+                        help='the files with each shard')
+    args = parser.parse_args()
+
+    instreams = [ open(name, 'r') for name in args.shard ]
+    if args.outfile:
+        outfile = open(args.outfile, 'w')
+    else:
+        outfile = sys.stdout
+    try:
+        merge_shards(instreams, outfile)
+    except (merge_error, fileinfo.file_info_input_stream_EXCEPTION) as e:
+        sys.stderr.write("Error merging shards: %s\n" %
+                         (str(e) or e.__class__.__name__))
+        sys.exit(1)
+    outfile.close()
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,9 @@ test_with_version() {
         return
     fi
     echo Testing with $*
-    time $* test_fileinfo.py
+    time $* test_fileinfo.py && time $* test_benchmark.py && \
+        time $* test_merge_shards.py && time $* test_snapshot_delta.py && \
+        time $* test_snapshot_store.py
     if [ $? -ne 0 ]; then
         RETVAL=$?
         echo TESTS FAILED FOR $1
@@ -0,0 +1,511 @@
+"""
+This program writes a delta between two snapshots written by
+fileinfo.py, with only what changed between them, and rebuilds a
+snapshot from a base snapshot and a chain of deltas.
+
+For example, to keep a full snapshot from the first night, and only the
+changes after that:
+
+    $ python fileinfo.py -o monday.fileinfo /data
+    $ python fileinfo.py /data | \
+    >     python snapshot_delta.py -o tuesday.delta monday.fileinfo -
+    $ python fileinfo.py /data | \
+    >     python snapshot_delta.py -o wednesday.delta tuesday.fileinfo -
+
+(where tuesday.fileinfo, if it was not kept, can be rebuilt as below).
+To rebuild the snapshot of Wednesday:
+
+    $ python snapshot_delta.py --apply -o wednesday.fileinfo \
+    >     monday.fileinfo tuesday.delta wednesday.delta
+
+Both are done a directory at a time, so only the index of the
+directories of the base is kept in memory when writing a delta, and
+nothing but the directory being rebuilt when applying one.
+
+A delta starts with its own version line, the digest of the snapshot it
+applies to (the SHA224 hash of its text, base64-encoded as for files),
+and the header lines of the snapshot it rebuilds, each after "%header":
+
+    %fileinfo-delta 0.4
+    %base GA0M/SJY26NzYANCbFjjEEnnxb73kfx0Icw+jg==
+    %header %fileinfo 0.4+n
+    %header %exclude *.o
+
+and it ends with the digest of the snapshot it rebuilds, so the result
+can be checked:
+
+    %result w2oX8lngi3g5gBwMBM34Xwdqcm79YrO+MGCJtg==
+
+In between, the directories of the result are described in order,
+going through the directories of the base in order at the same time.
+"%copy N" copies the next N directories of the base unchanged, and
+"%drop N" leaves out the next N. A directory that changed, or is new,
+starts with its line from the result ("!" or ":"). If the next
+directory of the base has the same name, the changes are to that
+directory, otherwise the directory is new.
+
+The changes to the entries of a directory work the same way. "=N"
+copies the next N entries of the base directory, and "xN" leaves out
+the next N. An entry that changed, or is new, is written as it would be
+in a snapshot, and replaces the next entry of the base directory if
+that has the same name. Any entries of the base directory left at the
+end are left out, as are any directories of the base left at the end.
+
+The information about a file is only written where it differs from the
+file before it in the delta, as in a snapshot, but a hard link is
+written like any other file (with ">"). The result has cached inodes
+("@") wherever fileinfo.py would have written them, as merge_shards.py
+does. The digests of directories (see "fileinfo.py --digests") are left
+out of a delta, since they are output again in the result.
+"""
+
+import sys
+import base64
+import hashlib
+import collections
+import argparse
+
+import fileinfo
+import merge_shards
+
+class delta_error(Exception):
+    """delta_error is raised when a delta cannot be written or applied"""
+    pass
+
+class digest_file:
+    """digest_file wraps a file-like object, and calculates the digest
+    of the text read from it or written to it. The header lines at the
+    start are kept too."""
+    def __init__(self, f):
+        """wrap the file
+
+        :param f: a file-like object
+        """
+        self.f = f
+        self.hash = hashlib.sha224()
+        self.header_lines = [ ]
+        self.in_header = True
+    def _add(self, s):
+        if self.in_header:
+            if s.startswith('%'):
+                self.header_lines.append(s)
+            else:
+                self.in_header = False
+        if not isinstance(s, bytes):
+            s = s.encode('utf-8', 'surrogateescape')
+        self.hash.update(s)
+    def readline(self):
+        """read a line"""
+        s = self.f.readline()
+        self._add(s)
+        return s
+    def write(self, s):
+        """write a string"""
+        self.f.write(s)
+        self._add(s)
+    def digest(self):
+        """return the digest of the text so far, base64-encoded"""
+        return base64.b64encode(self.hash.digest()).decode()
+
+def read_sections(stream):
+    """yield the directories of a snapshot, in order
+
+    :param stream: a file_info_input_stream to read the snapshot from
+
+    Each directory is a tuple of (item, list of entries), where the item
+    is the ('dir', name) or ('msdos_dir', name) read for it. Each entry
+    is a tuple of (type, name, fields): 'file', with the complete fields
+    of the file (for a cached inode too), or 'skipped_mount' and None.
+    """
+    section = None
+    while True:
+        item = stream.read_next()
+        if item is None:
+            break
+        (item_type, value) = item
+        if item_type in ('dir', 'msdos_dir'):
+            if section is not None:
+                yield section
+            section = (item, [ ])
+        elif item_type in ('file', 'inode'):
+            section[1].append(('file', value, stream.fields))
+        elif item_type == 'skipped_mount':
+            section[1].append((item_type, value, None))
+        elif item_type == 'digest':
+            # the digests are output again when the snapshot is rebuilt
+            # (see write_sections())
+            pass
+        else:
+            raise delta_error("unexpected %s in snapshot (shards must be "
+                              "merged first)" % item_type)
+    if section is not None:
+        yield section
+
+def index_sections(f):
+    """read a snapshot, to find its directories
+
+    :param f: a file-like object to read the snapshot from
+
+    Returns a tuple of (digest of the snapshot, dictionary of the
+    positions of each directory name, in order).
+    """
+    reader = digest_file(f)
+    positions = { }
+    n = 0
+    while True:
+        s = reader.readline()
+        if s == '':
+            break
+        if s[0] in '!:':
+            positions.setdefault(s[1:-1], collections.deque()).append(n)
+            n = n + 1
+    return (reader.digest(), positions)
+
+def next_position(positions, key, start):
+    """return the position of a name in the base, at or after start
+
+    :param positions: a dictionary of deques of positions, by name,
+                      which is updated to drop the positions before start
+    :param key: the name
+    :param start: the first position we can use
+
+    Returns None if there is no such position, so the name is new.
+    """
+    found = positions.get(key)
+    while found and (found[0] < start):
+        found.popleft()
+    if not found:
+        return None
+    return found.popleft()
+
+class delta_writer:
+    """delta_writer writes the body of a delta, a directory at a time."""
+    def __init__(self, out):
+        """initialize the writer
+
+        :param out: a file-like object to write to
+        """
+        self.out = out
+        self.prev_fields = None
+        # directories or entries copied, but not yet written
+        self.copies = 0
+    def _flush_copies(self, command):
+        if self.copies:
+            self.out.write("%s%d\n" % (command, self.copies))
+            self.copies = 0
+    def copy(self):
+        """copy the next directory of the base"""
+        self.copies = self.copies + 1
+    def drop(self, count):
+        """leave out directories of the base
+
+        :param count: the number of directories
+        """
+        self._flush_copies('%copy ')
+        self.out.write("%%drop %d\n" % count)
+    def _write_entry(self, entry):
+        (entry_type, name, fields) = entry
+        if entry_type == 'file':
+            fileinfo.encode_fields(self.out, fields, self.prev_fields)
+            self.out.write(">" + name + "\n")
+            self.prev_fields = fields
+        else:
+            self.out.write("-" + name + "\n")
+    def section(self, section, base_section=None):
+        """write the changes to a directory
+
+        :param section: the directory in the result, from read_sections()
+        :param base_section: the directory in the base it changes, or
+                             None if it is new
+        """
+        self._flush_copies('%copy ')
+        ((item_type, name), entries) = section
+        if item_type == 'msdos_dir':
+            self.out.write(":" + name + "\n")
+        else:
+            self.out.write("!" + name + "\n")
+        if base_section is None:
+            base_entries = [ ]
+        else:
+            base_entries = base_section[1]
+        positions = { }
+        for (n, entry) in enumerate(base_entries):
+            positions.setdefault(entry[:2], collections.deque()).append(n)
+        next_base = 0
+        for entry in entries:
+            found = next_position(positions, entry[:2], next_base)
+            if found is None:
+                self._flush_copies('=')
+                self._write_entry(entry)
+                continue
+            if found > next_base:
+                self._flush_copies('=')
+                self.out.write("x%d\n" % (found - next_base))
+            if base_entries[found] == entry:
+                self.copies = self.copies + 1
+            else:
+                self._flush_copies('=')
+                self._write_entry(entry)
+            next_base = found + 1
+        self._flush_copies('=')
+    def finish(self):
+        """write anything still held back"""
+        self._flush_copies('%copy ')
+
+def make_delta(base, new, out):
+    """write the delta between two snapshots
+
+    :param base: a file-like object to read the base snapshot from,
+                 which is read twice (so it cannot be a pipe)
+    :param new: a file-like object to read the new snapshot from
+    :param out: a file-like object to write the delta to
+    """
+    (base_digest, positions) = index_sections(base)
+    base.seek(0)
+    base_sections = read_sections(fileinfo.file_info_input_stream(base))
+    new_reader = digest_file(new)
+    new_sections = read_sections(fileinfo.file_info_input_stream(new_reader))
+
+    # the header of the new snapshot has been read once we have the
+    # first directory
+    first = next(new_sections, None)
+    out.write("%%fileinfo-delta %s\n" % fileinfo.FILEINFO_VERSION)
+    out.write("%%base %s\n" % base_digest)
+    for line in new_reader.header_lines:
+        out.write("%header " + line)
+
+    writer = delta_writer(out)
+    next_base = 0
+    section = first
+    while section is not None:
+        found = next_position(positions, section[0][1], next_base)
+        if found is None:
+            writer.section(section)
+        else:
+            if found > next_base:
+                writer.drop(found - next_base)
+                for n in range(found - next_base):
+                    next(base_sections)
+            base_section = next(base_sections)
+            if base_section == section:
+                writer.copy()
+            else:
+                writer.section(section, base_section)
+            next_base = found + 1
+        section = next(new_sections, None)
+    writer.finish()
+    out.write("%%result %s\n" % new_reader.digest())
+
+class delta_reader:
+    """delta_reader reads a delta, and applies it to the directories of
+    its base."""
+    def __init__(self, instream):
+        """read the header of the delta
+
+        :param instream: a file-like object to read the delta from
+        """
+        self.instream = instream
+        self.line_num = 0
+        s = self._readline()
+        if s != "%%fileinfo-delta %s\n" % fileinfo.FILEINFO_VERSION:
+            raise delta_error("not a delta, or not version %s" %
+                              fileinfo.FILEINFO_VERSION)
+        s = self._readline()
+        if not s.startswith("%base "):
+            self._syntax_error()
+        self.base_digest = s[len("%base "):-1]
+        self.header_lines = [ ]
+        s = self._readline()
+        while s.startswith("%header "):
+            self.header_lines.append(s[len("%header "):])
+            s = self._readline()
+        self.next_line = s
+        # set once the whole delta has been read
+        self.result_digest = None
+    def _readline(self):
+        self.line_num = self.line_num + 1
+        return self.instream.readline()
+    def _syntax_error(self):
+        raise delta_error("syntax error in delta at line %d" % self.line_num)
+    def _count(self, s, prefix):
+        try:
+            return int(s[len(prefix):])
+        except ValueError:
+            self._syntax_error()
+    def apply(self, base_sections):
+        """yield the directories of the result, in order
+
+        :param base_sections: an iterator over the directories of the
+                              base, as from read_sections()
+        """
+        base_sections = iter(base_sections)
+        next_base = next(base_sections, None)
+        section = None
+        base_entries = [ ]
+        next_entry = 0
+        fields = { }
+        prev_fields = None
+        s = self.next_line
+        while True:
+            if s == '':
+                if fields:
+                    self._syntax_error()
+                raise delta_error("delta is incomplete")
+            if s[0] in fileinfo.FIELD_LETTERS:
+                if section is None:
+                    self._syntax_error()
+                fields[s[0]] = s[1:-1]
+            elif fields and (s[0] != '>'):
+                self._syntax_error()
+            elif s[0] in '!:%':
+                # the end of the directory before
+                if section is not None:
+                    yield section
+                    section = None
+                if s.startswith('%copy '):
+                    for n in range(self._count(s, '%copy ')):
+                        if next_base is None:
+                            raise delta_error("delta does not match base")
+                        yield next_base
+                        next_base = next(base_sections, None)
+                elif s.startswith('%drop '):
+                    for n in range(self._count(s, '%drop ')):
+                        if next_base is None:
+                            raise delta_error("delta does not match base")
+                        next_base = next(base_sections, None)
+                elif s.startswith('%result '):
+                    self.result_digest = s[len('%result '):-1]
+                    break
+                elif s[0] == '%':
+                    self._syntax_error()
+                else:
+                    if s[0] == '!':
+                        item = ('dir', s[1:-1])
+                    else:
+                        item = ('msdos_dir', s[1:-1])
+                    section = (item, [ ])
+                    if (next_base is not None) and \
+                       (next_base[0][1] == item[1]):
+                        base_entries = next_base[1]
+                        next_base = next(base_sections, None)
+                    else:
+                        base_entries = [ ]
+                    next_entry = 0
+            elif section is None:
+                self._syntax_error()
+            elif s[0] in '=x':
+                count = self._count(s, s[0])
+                if next_entry + count > len(base_entries):
+                    raise delta_error("delta does not match base")
+                if s[0] == '=':
+                    section[1].extend(base_entries[next_entry:
+                                                   next_entry+count])
+                next_entry = next_entry + count
+            elif s[0] in '>-':
+                if s[0] == '>':
+                    prev_fields = fileinfo.decode_fields(fields, prev_fields)
+                    entry = ('file', s[1:-1], prev_fields)
+                    fields = { }
+                else:
+                    entry = ('skipped_mount', s[1:-1], None)
+                # a changed entry replaces the one in the base
+                if (next_entry < len(base_entries)) and \
+                   (base_entries[next_entry][:2] == entry[:2]):
+                    next_entry = next_entry + 1
+                section[1].append(entry)
+            else:
+                self._syntax_error()
+            s = self._readline()
+
+def write_sections(header_lines, sections, out):
+    """write a snapshot
+
+    :param header_lines: the lines before the first directory
+    :param sections: an iterator over the directories, as from
+                     read_sections()
+    :param out: a file-like object to write to
+    """
+    for line in header_lines:
+        out.write(line)
+    output = merge_shards.merged_output(out, fileinfo.DIGESTS_HEADER in
+                                             header_lines)
+    for (item, entries) in sections:
+        output.write(item, None)
+        for (entry_type, name, fields) in entries:
+            output.write((entry_type, name), fields)
+    output.finish()
+
+def apply_deltas(base, deltas, out):
+    """rebuild a snapshot from a base and a chain of deltas
+
+    :param base: a file-like object to read the base snapshot from
+    :param deltas: a list of file-like objects to read the deltas from,
+                   each applying to the result of the one before
+    :param out: a file-like object to write the result to
+
+    Raises delta_error if the deltas do not apply to the base, or the
+    result is not the snapshot the last delta was made from (in which
+    case what was written should be thrown away).
+    """
+    readers = [ delta_reader(f) for f in deltas ]
+    if not readers:
+        raise delta_error("no deltas to apply")
+    base_reader = digest_file(base)
+    sections = read_sections(fileinfo.file_info_input_stream(base_reader))
+    for reader in readers:
+        sections = reader.apply(sections)
+    writer = digest_file(out)
+    write_sections(readers[-1].header_lines, sections, writer)
+    # read the rest of the base, for its digest
+    while base_reader.readline() != '':
+        pass
+    digests = [ base_reader.digest() ] + \
+              [ reader.result_digest for reader in readers ]
+    for (n, reader) in enumerate(readers):
+        if reader.base_digest != digests[n]:
+            if n == 0:
+                raise delta_error("the first delta is not for this base")
+            raise delta_error("delta %d is not for the result of delta %d" %
+                              (n + 1, n))
+    if writer.digest() != readers[-1].result_digest:
+        raise delta_error("the result is not the snapshot the delta was "
+                          "made from")
+
+def main():
+    parser = argparse.ArgumentParser(description='Write the delta between two snapshots written by fileinfo.py, or rebuild a snapshot from a base snapshot and deltas.')
+    parser.add_argument('-o', '--outfile', type=str,
+                        help='file to write to (defaults to STDOUT)')
+    parser.add_argument('--apply', action="store_true",
+                        help='rebuild a snapshot by applying the deltas to the base, in order')
+    parser.add_argument('base',
+                        help='the base snapshot')
+    parser.add_argument('file', nargs="+",
+                        help='the new snapshot ("-" for STDIN), or with --apply the deltas')
+    args = parser.parse_args()
+    if (not args.apply) and (len(args.file) != 1):
+        parser.error("only one new snapshot can be compared with the base")
+
+    instreams = [ ]
+    for name in args.file:
+        if name == '-':
+            instreams.append(sys.stdin)
+        else:
+            instreams.append(open(name, 'r'))
+    base = open(args.base, 'r')
+    if args.outfile:
+        outfile = open(args.outfile, 'w')
+    else:
+        outfile = sys.stdout
+    try:
+        if args.apply:
+            apply_deltas(base, instreams, outfile)
+        else:
+            make_delta(base, instreams[0], outfile)
+    except (delta_error, merge_shards.merge_error,
+            fileinfo.file_info_input_stream_EXCEPTION) as e:
+        sys.stderr.write("Error: %s\n" % (str(e) or e.__class__.__name__))
+        sys.exit(1)
+    outfile.close()
+
+if __name__ == "__main__":
+    main()
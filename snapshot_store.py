@@ -0,0 +1,424 @@
+"""
+This program keeps snapshots written by fileinfo.py in a store where
+each directory is only kept once, however many snapshots it is in, and
+exports them again exactly as they were written.
+
+For example, to keep a snapshot every night, and get back the one from
+Tuesday:
+
+    $ python fileinfo.py /data | \
+    >     python snapshot_store.py --add tuesday /backup/store
+    $ python snapshot_store.py --export tuesday -o tuesday.fileinfo \
+    >     /backup/store
+
+Since most directories do not change from one night to the next, the
+store grows with the number of directories that change, rather than
+with the size of the tree.
+
+The store is a directory, with the objects in "objects" and a manifest
+for each snapshot in "snapshots". Each object is a file named by the
+SHA224 hash of its contents, in hex, in a directory named by the first
+two digits. There are two kinds of objects:
+
+* a directory of the snapshot, as it would be written if it were the
+  first directory in the snapshot (so the information about each file
+  is only left out where it is the same as the file before it in the
+  directory), with the '@' line of each cached inode replaced by the
+  complete information about the file, as for the file it is a hard
+  link to
+* a tree, with the object of a directory on the first line, followed by
+  the tree of each directory below it in the snapshot
+
+So when a directory changes, only its object and the trees of the
+directories above it are new. The manifest of a snapshot starts with
+its own version line and the header lines of the snapshot, each after
+"%header", followed by the tree of each top directory, and ends with
+the digest of the snapshot (the SHA224 hash of its text, base64-encoded
+as for files), so the export can be checked:
+
+    %fileinfo-store 0.4
+    %header %fileinfo 0.4+n
+    5a1c7d0f0b6e1d2b9e8a6c4f3d2e1f0a9b8c7d6e5f4a3b2c1d0e9f8a
+    %result w2oX8lngi3g5gBwMBM34Xwdqcm79YrO+MGCJtg==
+
+The snapshot is exported as snapshot_delta.py rebuilds one, with cached
+inodes ("@") and the digests of directories (see "fileinfo.py
+--digests") output where fileinfo.py would have written them. A
+snapshot that would not come out the same (because it was not written
+by fileinfo.py, or is a shard) is not added.
+"""
+
+import os
+import os.path
+import sys
+import hashlib
+import argparse
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import fileinfo
+import merge_shards
+import snapshot_delta
+
+class store_error(Exception):
+    """store_error is raised when a snapshot cannot be added to or
+    exported from the store"""
+    pass
+
+class null_file:
+    """null_file is a file-like object that throws away what is written
+    to it"""
+    def write(self, s):
+        pass
+
+class object_store:
+    """object_store reads and writes the objects of a store, and the
+    manifests of its snapshots."""
+    def __init__(self, store_dir):
+        """initialize the store
+
+        :param store_dir: the directory of the store
+        """
+        self.objects_dir = os.path.join(store_dir, "objects")
+        self.snapshots_dir = os.path.join(store_dir, "snapshots")
+    def _object_path(self, key):
+        return os.path.join(self.objects_dir, key[:2], key[2:])
+    def _write_file(self, path, text):
+        # another process may be adding the same object, so each writes
+        # its own file (hidden, so it is not taken for an object or a
+        # snapshot), and the rename replaces the file all at once
+        (dir_name, name) = os.path.split(path)
+        temp_name = os.path.join(dir_name, ".%s.%d" % (name, os.getpid()))
+        f = open(temp_name, 'w')
+        try:
+            f.write(text)
+        finally:
+            f.close()
+        os.rename(temp_name, path)
+    def put(self, text):
+        """add an object, if it is not already in the store
+
+        :param text: the contents of the object
+
+        Returns the key of the object.
+        """
+        key = hashlib.sha224(text.encode('utf-8')).hexdigest()
+        path = self._object_path(key)
+        if not os.path.exists(path):
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            self._write_file(path, text)
+        return key
+    def get(self, key):
+        """return the contents of an object
+
+        :param key: the key of the object
+        """
+        try:
+            f = open(self._object_path(key), 'r')
+        except IOError:
+            raise store_error("object %s is missing" % key)
+        try:
+            return f.read()
+        finally:
+            f.close()
+    def keys(self):
+        """return the keys of all of the objects"""
+        keys = [ ]
+        if not os.path.isdir(self.objects_dir):
+            return keys
+        for prefix in os.listdir(self.objects_dir):
+            for name in os.listdir(os.path.join(self.objects_dir, prefix)):
+                if not name.startswith('.'):
+                    keys.append(prefix + name)
+        return keys
+    def remove(self, key):
+        """remove an object
+
+        :param key: the key of the object
+        """
+        os.remove(self._object_path(key))
+    def _manifest_path(self, name):
+        if (not name) or ('/' in name) or name.startswith('.'):
+            raise store_error("'%s' is not a valid snapshot name" % name)
+        return os.path.join(self.snapshots_dir, name)
+    def write_manifest(self, name, header_lines, trees, digest):
+        """write the manifest of a snapshot, replacing any before
+
+        :param name: the name of the snapshot
+        :param header_lines: the header lines of the snapshot
+        :param trees: the keys of the trees of its top directories
+        :param digest: the digest of the text of the snapshot
+        """
+        lines = [ "%%fileinfo-store %s\n" % fileinfo.FILEINFO_VERSION ]
+        for line in header_lines:
+            lines.append("%header " + line)
+        for key in trees:
+            lines.append(key + "\n")
+        lines.append("%%result %s\n" % digest)
+        path = self._manifest_path(name)
+        if not os.path.isdir(self.snapshots_dir):
+            os.makedirs(self.snapshots_dir)
+        self._write_file(path, ''.join(lines))
+    def read_manifest(self, name):
+        """read the manifest of a snapshot
+
+        :param name: the name of the snapshot
+
+        Returns a tuple of (header lines, keys of the trees of the top
+        directories, digest of the text of the snapshot).
+        """
+        try:
+            f = open(self._manifest_path(name), 'r')
+        except IOError:
+            raise store_error("there is no snapshot '%s'" % name)
+        try:
+            lines = f.readlines()
+        finally:
+            f.close()
+        if (not lines) or \
+           (lines[0] != "%%fileinfo-store %s\n" % fileinfo.FILEINFO_VERSION):
+            raise store_error("the manifest of '%s' is not version %s" %
+                              (name, fileinfo.FILEINFO_VERSION))
+        if not lines[-1].startswith("%result "):
+            raise store_error("the manifest of '%s' is incomplete" % name)
+        header_lines = [ ]
+        trees = [ ]
+        for line in lines[1:-1]:
+            if line.startswith("%header "):
+                header_lines.append(line[len("%header "):])
+            else:
+                trees.append(line[:-1])
+        return (header_lines, trees, lines[-1][len("%result "):-1])
+    def names(self):
+        """return the names of the snapshots, sorted"""
+        if not os.path.isdir(self.snapshots_dir):
+            return [ ]
+        return sorted([ name for name in os.listdir(self.snapshots_dir)
+                        if not name.startswith('.') ])
+    def remove_manifest(self, name):
+        """remove the manifest of a snapshot
+
+        :param name: the name of the snapshot
+        """
+        try:
+            os.remove(self._manifest_path(name))
+        except OSError:
+            raise store_error("there is no snapshot '%s'" % name)
+
+def section_text(section):
+    """return the object of a directory
+
+    :param section: the directory, from snapshot_delta.read_sections()
+    """
+    out = StringIO()
+    ((item_type, name), entries) = section
+    if item_type == 'msdos_dir':
+        out.write(":" + name + "\n")
+    else:
+        out.write("!" + name + "\n")
+    prev_fields = None
+    for (entry_type, name, fields) in entries:
+        if entry_type == 'file':
+            fileinfo.encode_fields(out, fields, prev_fields)
+            out.write(">" + name + "\n")
+            prev_fields = fields
+        else:
+            out.write("-" + name + "\n")
+    return out.getvalue()
+
+def read_section(text):
+    """return a directory from its object
+
+    :param text: the object of the directory, from section_text()
+    """
+    version = "%%fileinfo %s\n" % fileinfo.FILEINFO_VERSION
+    stream = fileinfo.file_info_input_stream(StringIO(version + text))
+    return next(snapshot_delta.read_sections(stream))
+
+class tree_writer:
+    """tree_writer adds the directories of a snapshot to a store, with
+    the trees of the directories they are below."""
+    def __init__(self, store):
+        """initialize the writer
+
+        :param store: the object_store to add the objects to
+        """
+        self.store = store
+        # the directories not yet complete, outermost first, as lists of
+        # [ name, key of the directory, keys of the trees below ]
+        self.open_dirs = [ ]
+        # the keys of the trees of the top directories
+        self.trees = [ ]
+    def _close(self):
+        (name, key, subtrees) = self.open_dirs.pop()
+        tree = self.store.put(''.join([ k + "\n"
+                                        for k in [ key ] + subtrees ]))
+        if self.open_dirs:
+            self.open_dirs[-1][2].append(tree)
+        else:
+            self.trees.append(tree)
+    def add(self, section):
+        """add a directory
+
+        :param section: the directory, from snapshot_delta.read_sections()
+        """
+        name = section[0][1]
+        while self.open_dirs and \
+              (fileinfo.subdirectory_path(name, self.open_dirs[-1][0]) is
+               None):
+            self._close()
+        self.open_dirs.append([ name, self.store.put(section_text(section)),
+                                [ ] ])
+    def finish(self):
+        """add the trees of the directories still open, at the end of the
+        snapshot"""
+        while self.open_dirs:
+            self._close()
+
+def tree_sections(store, key):
+    """yield the directories of a tree, in order
+
+    :param store: the object_store the tree is in
+    :param key: the key of the tree
+    """
+    keys = store.get(key).split()
+    if not keys:
+        raise store_error("tree %s is empty" % key)
+    yield read_section(store.get(keys[0]))
+    for subtree in keys[1:]:
+        for section in tree_sections(store, subtree):
+            yield section
+
+def add_snapshot(store, name, instream):
+    """add a snapshot to a store
+
+    :param store: an object_store
+    :param name: the name to add the snapshot as
+    :param instream: a file-like object to read the snapshot from
+
+    The snapshot is only added if it would be exported exactly as it
+    is, otherwise store_error is raised (and the objects added for it
+    are left for remove_unused() to remove).
+    """
+    reader = snapshot_delta.digest_file(instream)
+    sections = snapshot_delta.read_sections(
+                   fileinfo.file_info_input_stream(reader))
+    # the header of the snapshot has been read once we have the first
+    # directory
+    first = next(sections, None)
+    writer = tree_writer(store)
+    def added():
+        section = first
+        while section is not None:
+            writer.add(section)
+            yield section
+            section = next(sections, None)
+    # write the snapshot as it would be exported, to check it is the same
+    check = snapshot_delta.digest_file(null_file())
+    snapshot_delta.write_sections(reader.header_lines, added(), check)
+    writer.finish()
+    if check.digest() != reader.digest():
+        raise store_error("the snapshot would not be exported as it is "
+                          "(it was not written by fileinfo.py?)")
+    store.write_manifest(name, reader.header_lines, writer.trees,
+                         reader.digest())
+
+def export_snapshot(store, name, out):
+    """write a snapshot from a store
+
+    :param store: an object_store
+    :param name: the name of the snapshot
+    :param out: a file-like object to write the snapshot to
+
+    Raises store_error if the snapshot is not the one that was added (in
+    which case what was written should be thrown away).
+    """
+    (header_lines, trees, digest) = store.read_manifest(name)
+    def sections():
+        for key in trees:
+            for section in tree_sections(store, key):
+                yield section
+    writer = snapshot_delta.digest_file(out)
+    snapshot_delta.write_sections(header_lines, sections(), writer)
+    if writer.digest() != digest:
+        raise store_error("the store is damaged, snapshot '%s' is not the "
+                          "one that was added" % name)
+
+def remove_unused(store):
+    """remove the objects that are not in any snapshot
+
+    :param store: an object_store
+
+    Returns the number of objects removed.
+    """
+    used = set()
+    def mark(key):
+        if key in used:
+            return
+        used.add(key)
+        keys = store.get(key).split()
+        used.add(keys[0])
+        for subtree in keys[1:]:
+            mark(subtree)
+    for name in store.names():
+        for key in store.read_manifest(name)[1]:
+            mark(key)
+    removed = 0
+    for key in store.keys():
+        if key not in used:
+            store.remove(key)
+            removed = removed + 1
+    return removed
+
+def main():
+    parser = argparse.ArgumentParser(description='Keep snapshots written by fileinfo.py in a store where each directory is only kept once, and export them exactly as they were written.')
+    parser.add_argument('-o', '--outfile', type=str,
+                        help='with --export or --list, file to write to (defaults to STDOUT)')
+    action = parser.add_mutually_exclusive_group(required=True)
+    action.add_argument('--add', type=str, metavar="NAME",
+                        help='add the snapshot read from FILE (or STDIN) to the store with this name, replacing any snapshot with the same name')
+    action.add_argument('--export', type=str, metavar="NAME",
+                        help='write the snapshot with this name')
+    action.add_argument('--list', action="store_true",
+                        help='list the names of the snapshots in the store')
+    action.add_argument('--remove', type=str, metavar="NAME",
+                        help='remove the snapshot with this name, and the objects no other snapshot uses (the store must not be added to at the same time)')
+    parser.add_argument('store',
+                        help='the directory of the store (created by the first --add)')
+    parser.add_argument('file', nargs="?",
+                        help='with --add, the snapshot to add (defaults to STDIN)')
+    args = parser.parse_args()
+    if args.file and not args.add:
+        parser.error("a snapshot file can only be given with --add")
+
+    store = object_store(args.store)
+    if args.add and args.file and (args.file != '-'):
+        instream = open(args.file, 'r')
+    else:
+        instream = sys.stdin
+    if args.outfile:
+        outfile = open(args.outfile, 'w')
+    else:
+        outfile = sys.stdout
+    try:
+        if args.add:
+            add_snapshot(store, args.add, instream)
+        elif args.export:
+            export_snapshot(store, args.export, outfile)
+        elif args.list:
+            for name in store.names():
+                outfile.write(name + "\n")
+        else:
+            store.remove_manifest(args.remove)
+            remove_unused(store)
+    except (store_error, snapshot_delta.delta_error, merge_shards.merge_error,
+            fileinfo.file_info_input_stream_EXCEPTION) as e:
+        sys.stderr.write("Error: %s\n" % (str(e) or e.__class__.__name__))
+        sys.exit(1)
+    outfile.close()
+
+if __name__ == "__main__":
+    main()
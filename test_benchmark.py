@@ -0,0 +1,87 @@
+import benchmark
+import os
+import os.path
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+# test the synthetic tree generator
+class TreeTests(unittest.TestCase):
+    def _list_tree(self, top):
+        names = [ ]
+        for root, dirs, files in os.walk(top):
+            rel_root = os.path.relpath(root, top)
+            for name in files:
+                st = os.lstat(os.path.join(root, name))
+                names.append((rel_root, name, st.st_size))
+        return sorted(names)
+
+    def test_file_size(self):
+        rng = random.Random(0)
+        self.assertEqual(benchmark.file_size(rng, 'fixed', 100, 1000), 100)
+        self.assertEqual(benchmark.file_size(rng, 'fixed', 100, 10), 10)
+        for n in range(100):
+            size = benchmark.file_size(rng, 'uniform', 100, 1000)
+            self.assertTrue(0 <= size <= 200)
+            size = benchmark.file_size(rng, 'lognormal', 100, 1000)
+            self.assertTrue(0 <= size <= 1000)
+        self.assertRaises(ValueError, benchmark.file_size, rng, 'x', 1, 1)
+
+    def test_make_tree(self):
+        top1 = tempfile.mkdtemp()
+        top2 = tempfile.mkdtemp()
+        try:
+            info = benchmark.make_tree(top1, 50, size=100, fanout=2,
+                                       depth=2, link_ratio=0.5, seed=1)
+            self.assertEqual(info['files'], 50)
+            self.assertEqual(info['directories'], 7)
+            self.assertTrue(info['hard_links'] > 0)
+            listing = self._list_tree(top1)
+            self.assertEqual(len(listing), 50)
+            # the same seed gives the same tree
+            benchmark.make_tree(top2, 50, size=100, fanout=2,
+                                depth=2, link_ratio=0.5, seed=1)
+            self.assertEqual(listing, self._list_tree(top2))
+        finally:
+            shutil.rmtree(top1)
+            shutil.rmtree(top2)
+
+# test running the benchmark
+class BenchmarkTests(unittest.TestCase):
+    def _benchmark(self, runs):
+        save_run_fileinfo = benchmark.run_fileinfo
+        save_stderr = sys.stderr
+        results = list(runs)
+        def run_fileinfo(fileinfo_path, tree, ncpus, extra_args):
+            return results.pop(0)
+        try:
+            benchmark.run_fileinfo = run_fileinfo
+            sys.stderr = StringIO()
+            return benchmark.benchmark('fileinfo.py', 'tree',
+                                       { 'files': 10, 'bytes': 1000 },
+                                       [ 1 ], [ 'default' ], len(runs))
+        finally:
+            benchmark.run_fileinfo = save_run_fileinfo
+            sys.stderr = save_stderr
+
+    def test_benchmark(self):
+        # the fastest run is reported, with the largest peak RSS
+        results = self._benchmark([ (2.0, 100, 500), (1.0, 100, 300) ])
+        self.assertEqual(results[0]['run_time'], 1.0)
+        self.assertEqual(results[0]['peak_rss_kib'], 500)
+        self.assertEqual(results[0]['files_per_second'], 10.0)
+
+    def test_no_peak_rss(self):
+        # where the peak RSS cannot be measured, it is not reported
+        results = self._benchmark([ (1.0, 100, None), (1.0, 100, None) ])
+        self.assertEqual(results[0]['run_time'], 1.0)
+        self.assertEqual(results[0]['peak_rss_kib'], None)
+
+if __name__ == '__main__':
+    unittest.main()
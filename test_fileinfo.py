@@ -17,6 +17,13 @@ try:
 except ImportError:
     import queue as Queue
 import base64
+import hashlib
+import stat
+import threading
+import time
+import json
+import re
+import socket
 
 mock_ioctl_exception = None
 def mock_ioctl(fd, opt, arg, mutate_flag=False):
@@ -186,6 +193,75 @@ class UtilityTests(unittest.TestCase):
             # restore our real ioctl() function
             fileinfo.fcntl.ioctl = save_ioctl
 
+    def test_read_mount_types(self):
+        mountinfo = StringIO(
+          "23 28 0:22 / /proc rw,relatime - proc proc rw\n"
+          "36 28 8:1 / /boot rw shared:3 - ext4 /dev/sda1 rw\n"
+          "37 28 8:17 / /mnt/usb rw master:1 shared:4 - vfat /dev/sdb1 rw\n"
+          "garbage\n")
+        self.assertEqual(fileinfo.read_mount_types(mountinfo),
+                         { (0, 22): 'proc', (8, 1): 'ext4', (8, 17): 'vfat' })
+
+    def test_is_fatfs_dir(self):
+        save_mount_types = fileinfo.mount_types
+        save_fatfs_devices = fileinfo.fatfs_devices
+        save_is_fatfs_file = fileinfo.is_fatfs_file
+        calls = [ ]
+        def mock_is_fatfs_file(name):
+            calls.append(name)
+            return True
+        try:
+            fileinfo.mount_types = { (8, 1): 'ext4', (8, 17): 'vfat' }
+            fileinfo.fatfs_devices = { }
+            fileinfo.is_fatfs_file = mock_is_fatfs_file
+            # devices in the mount table are looked up by type
+            self.assertFalse(fileinfo.is_fatfs_dir("a", os.makedev(8, 1)))
+            self.assertTrue(fileinfo.is_fatfs_dir("b", os.makedev(8, 17)))
+            self.assertEqual(calls, [ ])
+            # unknown devices fall back to the ioctl() check, only once
+            self.assertTrue(fileinfo.is_fatfs_dir("c", os.makedev(9, 9)))
+            self.assertTrue(fileinfo.is_fatfs_dir("d", os.makedev(9, 9)))
+            self.assertEqual(calls, [ "c" ])
+        finally:
+            fileinfo.mount_types = save_mount_types
+            fileinfo.fatfs_devices = save_fatfs_devices
+            fileinfo.is_fatfs_file = save_is_fatfs_file
+
+    def test_human_bytes(self):
+        self.assertEqual(fileinfo.human_bytes(0), "0 B / 0 B")
+        self.assertEqual(fileinfo.human_bytes(999), "999 B / 999 B")
+        self.assertEqual(fileinfo.human_bytes(1000), "1000 B / 1.0 KB")
+        self.assertEqual(fileinfo.human_bytes(1024*1024),
+                         "1.0 MiB / 1.0 MB")
+
+    def test_cpu_limits(self):
+        self.assertEqual(fileinfo.cpu_max_limit("max 100000\n"), None)
+        self.assertEqual(fileinfo.cpu_max_limit("200000 100000\n"), 2)
+        self.assertEqual(fileinfo.cpu_max_limit("150000 100000\n"), 2)
+        self.assertEqual(fileinfo.cpu_max_limit("10000 100000\n"), 1)
+        self.assertEqual(fileinfo.quota_limit(-1, 100000), None)
+        self.assertEqual(fileinfo.quota_limit(400000, 100000), 4)
+        self.assertTrue(fileinfo.available_cpus() >= 1)
+
+    def test_ncpus_arg(self):
+        self.assertEqual(fileinfo.ncpus_arg("auto"), "auto")
+        self.assertEqual(fileinfo.ncpus_arg("3"), 3)
+        self.assertRaises(ValueError, fileinfo.ncpus_arg, "many")
+
+    def test_choose_engine(self):
+        self.assertEqual(fileinfo.choose_engine("threads", 64), "threads")
+        if fileinfo.use_threads:
+            self.assertEqual(fileinfo.choose_engine("processes", 2),
+                             "threads")
+            self.assertEqual(fileinfo.choose_engine("auto", 2), "threads")
+            return
+        self.assertEqual(fileinfo.choose_engine("processes", 2), "processes")
+        self.assertEqual(fileinfo.choose_engine("auto",
+                                                fileinfo.ENGINE_MAX_THREADS + 1),
+                         "processes")
+        if platform.python_implementation() == 'CPython':
+            self.assertEqual(fileinfo.choose_engine("auto", 2), "threads")
+
     def test_make_type_unicode(self):
         # This one is tricky to test, since the function is a single line 
         # based on implementation details. However the isdecimal() function
@@ -221,10 +297,10 @@ class InfoTests(unittest.TestCase):
         # we just put a check here)
         if not (platform.system() == 'Linux'): return
         dir_name = tempfile.mkdtemp()
-        # put a mock version of is_fatfs_file() in place
-        save_is_fatfs_file = fileinfo.is_fatfs_file
+        # put a mock version of is_fatfs_dir() in place
+        save_is_fatfs_dir = fileinfo.is_fatfs_dir
         try:
-            fileinfo.is_fatfs_file = lambda x: True
+            fileinfo.is_fatfs_dir = lambda x, y: True
             # make a chdir_info object
             info = fileinfo.chdir_info(dir_name)
             # output into a string buffer
@@ -237,7 +313,7 @@ class InfoTests(unittest.TestCase):
             self.assertEqual(out.getvalue(), ":" + dir_name + "\n")
             self.assertEqual(err.getvalue(), "")
         finally:
-            fileinfo.is_fatfs_file = save_is_fatfs_file
+            fileinfo.is_fatfs_dir = save_is_fatfs_dir
             os.rmdir(dir_name)
 
     def test_cached_info(self):
@@ -498,6 +574,70 @@ class TaskTests(unittest.TestCase):
         self.assertEqual(info.hashing_error, None)
         # TODO: verify actual value...
 
+    def test_get_checksum_bytes_read(self):
+        # confirm that we count the bytes that we hash
+        temp_file = tempfile.NamedTemporaryFile()
+        temp_file.write(b"x" * 10000)
+        temp_file.flush()
+        stat = os.lstat(temp_file.name)
+        info = fileinfo.file_info(os.path.basename(temp_file.name),
+                                  temp_file.name, stat)
+        bytes_read = fileinfo.LocalCounter()
+        fileinfo.get_checksum(info, bytes_read)
+        self.assertEqual(bytes_read.value, 10000)
+        fileinfo.get_checksum(info, bytes_read)
+        self.assertEqual(bytes_read.value, 20000)
+        # the count is shared, so it is only added to once in a while
+        # (here, once for each file)
+        locks = [ ]
+        class counter(fileinfo.LocalCounter):
+            def get_lock(self):
+                locks.append(self.value)
+                return self.lock
+        bytes_read = counter()
+        fileinfo.get_checksum(info, bytes_read)
+        self.assertEqual(bytes_read.value, 10000)
+        self.assertEqual(locks, [ 0 ])
+
+    def test_next_pool_size(self):
+        # keep going the same way while things improve
+        self.assertEqual(fileinfo.next_pool_size(2, 8, 1, 100.0, None), (3, 1))
+        self.assertEqual(fileinfo.next_pool_size(3, 8, 1, 120.0, 100.0),
+                         (4, 1))
+        # small changes are not enough to turn around
+        self.assertEqual(fileinfo.next_pool_size(4, 8, 1, 118.0, 120.0),
+                         (5, 1))
+        # reverse when things get worse
+        self.assertEqual(fileinfo.next_pool_size(5, 8, 1, 90.0, 118.0),
+                         (4, -1))
+        self.assertEqual(fileinfo.next_pool_size(4, 8, -1, 50.0, 90.0),
+                         (5, 1))
+        # and bounce off the limits
+        self.assertEqual(fileinfo.next_pool_size(8, 8, 1, 100.0, 90.0),
+                         (7, -1))
+        self.assertEqual(fileinfo.next_pool_size(1, 8, -1, 100.0, 90.0),
+                         (2, 1))
+        self.assertEqual(fileinfo.next_pool_size(1, 1, 1, 100.0, 90.0),
+                         (1, -1))
+
+    def test_checksum_generator_active(self):
+        # a task that is not active does not take work until it is
+        q_in = Queue.Queue()
+        q_in.put(None)
+        q_out = Queue.Queue()
+        active = fileinfo.LocalCounter()
+        active.value = 1
+        worker = threading.Thread(target=fileinfo.checksum_generator,
+                                  args=(q_in, q_out, None, None, 'checksum',
+                                        active, 1))
+        worker.start()
+        time.sleep(fileinfo.AUTO_IDLE_SLEEP * 2)
+        self.assertFalse(q_in.empty())
+        active.value = 2
+        worker.join()
+        self.assertTrue(q_in.empty())
+        self.assertEqual(q_out.get_nowait(), None)
+
     def test_checksum_generator(self):
         # test a checksum generator that gets no input
         q_in = Queue.Queue()
@@ -635,6 +775,66 @@ class OutputStreamTests(unittest.TestCase):
             os.remove(normal_full_path)
             os.remove(special_full_path)
             os.rmdir(tempdir)
+    def test_prune_mounts(self):
+        tempdir = tempfile.mkdtemp()
+        for name in ("a", "mnt", "z"):
+            os.mkdir(os.path.join(tempdir, name))
+        try:
+            stream = fileinfo.file_info_output_stream_immediate(StringIO())
+            st_dev = os.lstat(tempdir).st_dev
+            for name in ("a", "mnt"):
+                stream.output_file(tempdir, name)
+            # pretend "mnt" is on another device, and "z" is not output
+            # yet, so has to be stat'ed
+            mnt = os.path.join(tempdir, "mnt")
+            stream.dir_devices[mnt] = st_dev + 1
+            output_size = stream.outfile.size
+            dirs = [ "a", "mnt", "z" ]
+            stream.prune_mounts(tempdir, dirs, st_dev)
+            self.assertEqual(dirs, [ "a", "z" ])
+            self.assertEqual(stream.outfile.size, output_size)
+            self.assertNotIn(mnt, stream.dir_devices)
+            # and now with a marker
+            stream.dir_devices[mnt] = st_dev + 1
+            dirs = [ "a", "mnt", "z" ]
+            stream.prune_mounts(tempdir, dirs, st_dev, True)
+            self.assertEqual(dirs, [ "a", "z" ])
+            self.assertTrue(stream.outfile.f.getvalue().endswith(
+                             "\n-%s\n" % mnt))
+        finally:
+            for name in ("a", "mnt", "z"):
+                os.rmdir(os.path.join(tempdir, name))
+            os.rmdir(tempdir)
+    def test_schedule_window(self):
+        class sized_file:
+            def __init__(self, size):
+                self.stat = os.stat_result((0, 0, 0, 0, 0, 0, size,
+                                            0, 0, 0))
+        q_checksum = fileinfo.Queue.Queue()
+        q_serializer = fileinfo.Queue.Queue()
+        stream = fileinfo.file_info_output_stream_background(
+                     StringIO(), q_checksum, q_serializer, window=3)
+        def sent():
+            numbers = [ ]
+            while not q_checksum.empty():
+                numbers.append(q_checksum.get()[0])
+            return numbers
+        for size in (10, 50, 20, 5):
+            stream._process_checksum_file(sized_file(size))
+        # the largest of the first 4 goes first
+        self.assertEqual(sent(), [ 1 ])
+        for size in (1, 1):
+            stream._process_checksum_file(sized_file(size))
+        self.assertEqual(sent(), [ 2, 0 ])
+        stream.flush()
+        self.assertEqual(sent(), [ 3, 4, 5 ])
+        # a small file is not held back forever by larger ones
+        for size in (1, 100, 100, 100, 100, 100, 100, 100, 100):
+            stream._process_checksum_file(sized_file(size))
+        self.assertEqual(sent(), [ 7, 8, 9, 10, 6, 11 ])
+        stream.flush()
+        self.assertEqual(sent(), [ 12, 13, 14 ])
+        self.assertTrue(q_serializer.empty())
 
 # test the output stream objects
 class InputStreamTests(unittest.TestCase):
@@ -664,6 +864,1376 @@ class InputStreamTests(unittest.TestCase):
         input_stream = fileinfo.file_info_input_stream(nodir_file)
         self.assertRaises(fileinfo.file_info_input_stream_NO_START_DIR, input_stream.read_next)
         # how can we check the contentsof the assertion (get line number, description)
+    def test_fields(self):
+        # reading our own output back and encoding it again gives the same
+        # output, since the delta encoding is undone and redone
+        tempdir = tempfile.mkdtemp()
+        for name in ("a", "b"):
+            f = open(os.path.join(tempdir, name), "w")
+            f.write(name)
+            f.close()
+        os.link(os.path.join(tempdir, "a"), os.path.join(tempdir, "c"))
+        os.mkfifo(os.path.join(tempdir, "d"))
+        try:
+            out = StringIO()
+            stream = fileinfo.file_info_output_stream_immediate(out)
+            stream.output_dir(tempdir)
+            for name in ("a", "b", "c", "d"):
+                stream.output_file(tempdir, name)
+            input_stream = fileinfo.file_info_input_stream(
+                               StringIO(out.getvalue()))
+            reencoded = StringIO()
+            prev_fields = None
+            items = [ ]
+            while True:
+                item = input_stream.read_next()
+                if item is None:
+                    break
+                items.append(item)
+                if item[0] == 'file':
+                    fileinfo.encode_fields(reencoded, input_stream.fields,
+                                           prev_fields)
+                    reencoded.write(">" + item[1] + "\n")
+                elif item[0] == 'inode':
+                    reencoded.write("i%s\n@%s\n" %
+                                    (input_stream.fields['i'], item[1]))
+                else:
+                    reencoded.write("!" + item[1] + "\n")
+                prev_fields = input_stream.fields
+            self.assertEqual(items, [ ('dir', tempdir), ('file', 'a'),
+                                      ('file', 'b'), ('inode', 'c'),
+                                      ('file', 'd') ])
+            self.assertEqual(out.getvalue().split("\n", 1)[1],
+                             reencoded.getvalue())
+            # the cached inode has the fields of the original
+            st = os.lstat(os.path.join(tempdir, "c"))
+            self.assertEqual(input_stream.inodes[str(st.st_ino)]['s'], '1')
+        finally:
+            for name in ("a", "b", "c", "d"):
+                os.remove(os.path.join(tempdir, name))
+            os.rmdir(tempdir)
+    def test_decode_fields(self):
+        prev = { 'm': '100644', 'i': '1', 'C': '2014', 'M': '2013',
+                 'r': '5', '#': 'hash' }
+        self.assertEqual(fileinfo.decode_fields({ 'i': '2' }, prev),
+                         { 'm': '100644', 'i': '2', 'C': '2014',
+                           'M': '2014' })
+        self.assertEqual(fileinfo.decode_fields({ 'i': '2' }, None),
+                         { 'i': '2' })
+    def test_shard(self):
+        instream = StringIO("%%fileinfo %s\n%%shard 1/3\n&4\n!.\n" %
+                            fileinfo.FILEINFO_VERSION)
+        input_stream = fileinfo.file_info_input_stream(instream)
+        self.assertEqual(input_stream.read_next(), ('unit', 4))
+        self.assertEqual(input_stream.read_next(), ('dir', '.'))
+        self.assertEqual(input_stream.shard, (1, 3))
+        self.assertEqual(input_stream.header_lines, [ ])
+        # fields have to be followed by a file name
+        instream = StringIO("%%fileinfo %s\n!.\ni5\n!..\n" %
+                            fileinfo.FILEINFO_VERSION)
+        input_stream = fileinfo.file_info_input_stream(instream)
+        input_stream.read_next()
+        self.assertRaises(fileinfo.file_info_input_stream_SYNTAX_ERROR,
+                          input_stream.read_next)
+    def test_skipped_mount(self):
+        instream = StringIO("%%fileinfo %s\n!.\n-./mnt\n" %
+                            fileinfo.FILEINFO_VERSION)
+        input_stream = fileinfo.file_info_input_stream(instream)
+        self.assertEqual(input_stream.read_next(), ('dir', '.'))
+        self.assertEqual(input_stream.read_next(), ('skipped_mount', './mnt'))
+    def test_digests(self):
+        instream = StringIO("%%fileinfo %s\n%%digests\n!.\n*abc= ./sub dir\n"
+                            % fileinfo.FILEINFO_VERSION)
+        input_stream = fileinfo.file_info_input_stream(instream)
+        self.assertEqual(input_stream.read_next(), ('dir', '.'))
+        self.assertEqual(input_stream.read_next(),
+                         ('digest', ('./sub dir', 'abc=')))
+        self.assertTrue(input_stream.digests)
+        self.assertEqual(input_stream.header_lines, [ "%digests\n" ])
+        # the digest has to be followed by the directory
+        instream = StringIO("%%fileinfo %s\n!.\n*abc=\n" %
+                            fileinfo.FILEINFO_VERSION)
+        input_stream = fileinfo.file_info_input_stream(instream)
+        input_stream.read_next()
+        self.assertRaises(fileinfo.file_info_input_stream_SYNTAX_ERROR,
+                          input_stream.read_next)
+
+# test the profiling statistics
+class ProfileTests(unittest.TestCase):
+    def test_latency_bucket(self):
+        self.assertEqual(fileinfo.latency_bucket(0), 1)
+        self.assertEqual(fileinfo.latency_bucket(0.000001), 1)
+        self.assertEqual(fileinfo.latency_bucket(0.000003), 4)
+        self.assertEqual(fileinfo.latency_bucket(0.001), 1024)
+    def test_profile_stats(self):
+        profile = fileinfo.profile_stats('test')
+        profile.record('lstat', 0.000003)
+        profile.record('lstat', 0.000001)
+        profile.sample_queue('checksum', 4)
+        profile.sample_queue('checksum', None)
+        profile.sample_queue('checksum', 2)
+        data = profile.data()
+        self.assertEqual(data['name'], 'test')
+        self.assertEqual(data['stages']['lstat']['count'], 2)
+        self.assertEqual(data['stages']['lstat']['max'], 0.000003)
+        self.assertEqual(data['stages']['lstat']['histogram'], { 1: 1, 4: 1 })
+        self.assertEqual(data['queues']['checksum'],
+                         { 'samples': 2, 'total': 6, 'max': 4 })
+    def test_profile_report(self):
+        main = { 'name': 'main', 'run_time': 4.0, 'queues': { },
+                 'stages': { 'checksum_put': { 'count': 1, 'time': 1.0,
+                                               'max': 1.0,
+                                               'histogram': { 1: 1 } } } }
+        worker = { 'name': 'checksum-0', 'run_time': 4.0,
+                   'queues': { 'checksum': { 'samples': 2, 'total': 6,
+                                             'max': 4 } },
+                   'stages': { 'checksum': { 'count': 2, 'time': 3.0,
+                                             'max': 2.0,
+                                             'histogram': { 1: 2 } },
+                               'checksum_get': { 'count': 3, 'time': 1.0,
+                                                 'max': 0.5,
+                                                 'histogram': { 1: 3 } } } }
+        report = fileinfo.profile_report([ main, worker ])
+        self.assertEqual(report['stages']['checksum']['mean'], 1.5)
+        self.assertEqual(report['queues']['checksum']['mean'], 3)
+        self.assertEqual(report['tasks'][0]['busy_ratio'], 0.75)
+        self.assertEqual(report['tasks'][1]['idle'], 1.0)
+        self.assertEqual(report['tasks'][1]['busy'], 3.0)
+    def test_serializer_profile(self):
+        q = Queue.Queue()
+        q.put((0, TaskTests.mock_info("a")))
+        q.put(None)
+        q_profile = Queue.Queue()
+        out = StringIO()
+        fileinfo.serializer(q, 1, fileinfo.WriterWithSize(out), q_profile)
+        self.assertEqual(out.getvalue(), 'a\n')
+        data = q_profile.get_nowait()
+        self.assertEqual(data['name'], 'serializer')
+        self.assertEqual(data['stages']['output']['count'], 1)
+        self.assertEqual(data['stages']['serializer_get']['count'], 2)
+    def test_checksum_generator_profile(self):
+        temp_file = tempfile.NamedTemporaryFile()
+        stat = os.lstat(temp_file.name)
+        info = fileinfo.file_info(os.path.basename(temp_file.name),
+                                  temp_file.name, stat)
+        q_in = Queue.Queue()
+        q_in.put((0, info))
+        q_in.put(None)
+        q_out = Queue.Queue()
+        q_profile = Queue.Queue()
+        fileinfo.checksum_generator(q_in, q_out, None, q_profile, 'worker')
+        self.assertEqual((0, info), q_out.get_nowait())
+        self.assertEqual(q_out.get_nowait(), None)
+        data = q_profile.get_nowait()
+        self.assertEqual(data['name'], 'worker')
+        self.assertEqual(data['stages']['checksum']['count'], 1)
+        self.assertEqual(data['stages']['checksum_get']['count'], 2)
+
+# test checkpoints
+class CheckpointTests(unittest.TestCase):
+    def test_relative_components(self):
+        self.assertEqual(fileinfo.relative_components("top", "top"), [ ])
+        self.assertEqual(fileinfo.relative_components("top",
+                                                      os.path.join("top", "a",
+                                                                   "b")),
+                         [ "a", "b" ])
+        self.assertEqual(fileinfo.relative_components(".", "./a"), [ "a" ])
+    def test_already_output(self):
+        # the checkpoint directory itself is skipped, but not its children
+        dirs = [ "a", "b" ]
+        self.assertTrue(fileinfo.already_output([ "x", "y" ], dirs,
+                                                [ "x", "y" ]))
+        self.assertEqual(dirs, [ "a", "b" ])
+        # containing directories are skipped, and earlier children pruned
+        dirs = [ "a", "x", "z" ]
+        self.assertTrue(fileinfo.already_output([ ], dirs, [ "x", "y" ]))
+        self.assertEqual(dirs, [ "x", "z" ])
+        # anything else is output
+        dirs = [ "a" ]
+        self.assertFalse(fileinfo.already_output([ "z" ], dirs, [ "x", "y" ]))
+        self.assertFalse(fileinfo.already_output([ "x", "z" ], dirs,
+                                                 [ "x", "y" ]))
+        self.assertEqual(dirs, [ "a" ])
+    def test_saved_stat(self):
+        # output relative to a restored stat is the same as the original
+        st = os.lstat(".")
+        restored = fileinfo.saved_stat(fileinfo.stat_to_dict(st))
+        info = fileinfo.file_info(".", ".", st)
+        out1 = StringIO()
+        info.output(out1, StringIO(), st)
+        out2 = StringIO()
+        info.output(out2, StringIO(), restored)
+        self.assertEqual(out1.getvalue(), out2.getvalue())
+        self.assertEqual(fileinfo.stat_to_dict(None), None)
+    def test_checkpoint_info(self):
+        tempdir = tempfile.mkdtemp()
+        out_name = os.path.join(tempdir, "out")
+        checkpoint_name = os.path.join(tempdir, "checkpoint")
+        single_name = os.path.join(tempdir, "single")
+        link_name = os.path.join(tempdir, "link")
+        try:
+            outfile = open(out_name, "w")
+            open(single_name, "w").close()
+            os.link(out_name, link_name)
+            stream = fileinfo.file_info_output_stream_immediate(outfile)
+            stream.output_dir(tempdir)
+            stream.output_file(tempdir, "single")
+            stream.output_file(tempdir, "out")
+            stream.output_checkpoint(checkpoint_name, [ tempdir ], 0, [ ])
+            outfile.close()
+            state = fileinfo.read_checkpoint(checkpoint_name)
+            self.assertEqual(state['directories'], [ tempdir ])
+            self.assertEqual(state['root'], 0)
+            self.assertEqual(state['path'], [ ])
+            self.assertEqual(state['offset'], os.path.getsize(out_name))
+            self.assertEqual(state['last_stat']['st_ino'],
+                             os.lstat(out_name).st_ino)
+            # only the inodes with hard links can be seen again
+            self.assertEqual(list(state['inodes']),
+                             [ os.lstat(out_name).st_ino ])
+            # and restore it
+            stream = fileinfo.file_info_output_stream_immediate(StringIO(),
+                                                                header=False)
+            stream.restore_checkpoint(state)
+            self.assertEqual(stream.outfile.f.getvalue(), "")
+            self.assertTrue(os.lstat(out_name).st_ino in stream.inode_cache)
+            self.assertEqual(stream.prev_stat.st_ino,
+                             os.lstat(out_name).st_ino)
+        finally:
+            os.remove(out_name)
+            os.remove(single_name)
+            os.remove(link_name)
+            os.remove(checkpoint_name)
+            os.rmdir(tempdir)
+
+# test splitting the walk into shards
+class ShardTests(unittest.TestCase):
+    def test_shard_arg(self):
+        self.assertEqual(fileinfo.shard_arg("0/1"), (0, 1))
+        self.assertEqual(fileinfo.shard_arg("2/3"), (2, 3))
+        self.assertRaises(ValueError, fileinfo.shard_arg, "3/3")
+        self.assertRaises(ValueError, fileinfo.shard_arg, "0/0")
+        self.assertRaises(ValueError, fileinfo.shard_arg, "1")
+    def test_shard_subtrees(self):
+        # unit 5 is the top directory, and 6 to 9 its subtrees
+        dirs = [ "a", "b", "c", "d" ]
+        self.assertEqual(fileinfo.shard_subtrees(dirs, 5, (0, 2)),
+                         ({ "a": 6, "c": 8 }, 10))
+        self.assertEqual(dirs, [ "a", "c" ])
+        self.assertTrue(fileinfo.shard_owns(5, (1, 2)))
+        self.assertFalse(fileinfo.shard_owns(5, (0, 2)))
+
+# test progress reporting
+class ProgressTests(unittest.TestCase):
+    def test_bytes_left(self):
+        class mock_stream:
+            def __init__(self):
+                self.bytes_read = fileinfo.LocalCounter()
+                self.bytes_queued = 0
+        stream = mock_stream()
+        progress = fileinfo.progress_output(0, 4, 0.1, 0, stream=stream)
+        self.assertEqual(progress.bytes_left(), 0)
+        # two files seen with 1000 bytes, so we expect two more like that
+        # (at the start time, so no status is written to stderr)
+        progress.update(0, 2, 0)
+        stream.bytes_queued = 1000
+        self.assertEqual(progress.bytes_left(), 2000)
+        stream.bytes_read.value = 600
+        self.assertEqual(progress.bytes_left(), 1400)
+
+    def test_count_files(self):
+        tempdir = tempfile.mkdtemp()
+        sub_dir = os.path.join(tempdir, "sub")
+        os.mkdir(sub_dir)
+        open(os.path.join(tempdir, "a"), "w").close()
+        open(os.path.join(sub_dir, "b"), "w").close()
+        try:
+            progress = fileinfo.progress_output(0, 0, 0.1, 0,
+                                                totals_complete=False)
+            fileinfo.count_files([ tempdir ], progress)
+            self.assertEqual(progress.total_dir_count, 1)
+            self.assertEqual(progress.total_file_count, 2)
+            self.assertEqual(progress.total_count, 3)
+            self.assertTrue(progress.totals_complete)
+        finally:
+            os.remove(os.path.join(sub_dir, "b"))
+            os.remove(os.path.join(tempdir, "a"))
+            os.rmdir(sub_dir)
+            os.rmdir(tempdir)
+
+
+# test keeping a snapshot up to date
+class WatchTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.sub_dir = os.path.join(self.tempdir, "sub")
+        os.mkdir(self.sub_dir)
+        for (name, data) in (("a", "apple"), ("b", "banana"),
+                             ("sub/c", "cherry")):
+            f = open(os.path.join(self.tempdir, name), "w")
+            f.write(data)
+            f.close()
+        os.link(os.path.join(self.tempdir, "a"),
+                os.path.join(self.sub_dir, "a"))
+        os.symlink("sub", os.path.join(self.tempdir, "link"))
+    def tearDown(self):
+        for root, dirs, files in os.walk(self.tempdir, topdown=False):
+            for name in files:
+                os.remove(os.path.join(root, name))
+            for name in dirs:
+                path = os.path.join(root, name)
+                if os.path.islink(path):
+                    os.remove(path)
+                else:
+                    os.rmdir(path)
+        os.rmdir(self.tempdir)
+    def walk_output(self):
+        # what a run of fileinfo.py outputs, without the access times
+        out = StringIO()
+        stream = fileinfo.file_info_output_stream_immediate(out)
+        for root, dirs, files in os.walk(self.tempdir):
+            dirs.sort()
+            files.sort()
+            stream.output_dir(root)
+            for name in dirs + files:
+                stream.output_file(root, name)
+        return [ line for line in out.getvalue().split("\n")
+                      if not line.startswith("A") ]
+    def watcher_output(self, watcher):
+        out = StringIO()
+        watcher.output(out)
+        return [ line for line in out.getvalue().split("\n")
+                      if not line.startswith("A") ]
+    def write(self, name, data):
+        f = open(os.path.join(self.tempdir, name), "a")
+        f.write(data)
+        f.close()
+    def test_inotify_events(self):
+        data = fileinfo.INOTIFY_EVENT.pack(1, fileinfo.IN_CREATE, 0, 8) + \
+               b"new\0\0\0\0\0" + \
+               fileinfo.INOTIFY_EVENT.pack(-1, fileinfo.IN_Q_OVERFLOW, 0, 0)
+        self.assertEqual(fileinfo.inotify_events(data),
+                         [ (1, fileinfo.IN_CREATE, b"new"),
+                           (-1, fileinfo.IN_Q_OVERFLOW, b"") ])
+    def test_update(self):
+        watcher = fileinfo.snapshot_watcher([ self.tempdir ])
+        watcher.start(False)
+        self.assertEqual(self.watcher_output(watcher), self.walk_output())
+        self.assertEqual(watcher.bytes_read.value, len("applebananacherry"))
+        tree = watcher.trees[0]
+
+        # only the files that changed are read again (a change of mode
+        # changes the ctime, so "c" is read too)
+        self.write("b", "split")
+        os.chmod(os.path.join(self.sub_dir, "c"), 0o600)
+        self.write("sub/d", "date")
+        tree.add_events([ (self.tempdir, fileinfo.IN_MODIFY, "b"),
+                          (self.sub_dir, fileinfo.IN_ATTRIB, "c"),
+                          (self.sub_dir, fileinfo.IN_CREATE, "d") ])
+        watcher.update()
+        self.assertEqual(self.watcher_output(watcher), self.walk_output())
+        self.assertEqual(watcher.bytes_read.value,
+                         len("applebananacherry" + "cherry" + "bananasplit" +
+                             "date"))
+
+        # a directory that moves is walked under its new name, without
+        # reading its files again, and the link to it is now a file
+        new_dir = os.path.join(self.tempdir, "new")
+        os.rename(self.sub_dir, new_dir)
+        os.mkdir(os.path.join(new_dir, "deeper"))
+        self.write("new/deeper/e", "elderberry")
+        tree.add_events([ (self.tempdir, fileinfo.IN_MOVED_FROM, "sub"),
+                          (self.tempdir, fileinfo.IN_MOVED_TO, "new") ])
+        watcher.update()
+        self.assertEqual(self.watcher_output(watcher), self.walk_output())
+        self.assertEqual(sorted(tree.sections),
+                         [ self.tempdir, new_dir,
+                           os.path.join(new_dir, "deeper") ])
+        self.assertEqual(watcher.bytes_read.value,
+                         len("applebananacherry" + "cherry" + "bananasplit" +
+                             "date" + "elderberry"))
+    def test_hard_links(self):
+        watcher = fileinfo.snapshot_watcher([ self.tempdir ])
+        watcher.start(False)
+        tree = watcher.trees[0]
+        # a change through one link is only reported in its directory,
+        # but the other link changes too
+        self.write("sub/a", "pie")
+        tree.add_events([ (self.sub_dir, fileinfo.IN_MODIFY, "a") ])
+        watcher.update()
+        self.assertEqual(self.watcher_output(watcher), self.walk_output())
+        self.assertEqual(watcher.bytes_read.value,
+                         len("applebananacherry" + "applepie"))
+        # and so does the link count when one of them goes
+        os.remove(os.path.join(self.sub_dir, "a"))
+        tree.add_events([ (self.sub_dir, fileinfo.IN_DELETE, "a") ])
+        watcher.update()
+        self.assertEqual(self.watcher_output(watcher), self.walk_output())
+        # or a link is added in a new directory
+        os.mkdir(os.path.join(self.tempdir, "new"))
+        os.link(os.path.join(self.tempdir, "b"),
+                os.path.join(self.tempdir, "new", "b"))
+        tree.add_events([ (self.tempdir, fileinfo.IN_CREATE, "new") ])
+        watcher.update()
+        self.assertEqual(self.watcher_output(watcher), self.walk_output())
+    def test_overflow(self):
+        watcher = fileinfo.snapshot_watcher([ self.tempdir ])
+        watcher.start(False)
+        tree = watcher.trees[0]
+        self.write("sub/c", "pie")
+        os.remove(os.path.join(self.tempdir, "b"))
+        # the events were lost, so the whole tree is walked again
+        tree.add_events([ (None, fileinfo.IN_Q_OVERFLOW, "") ])
+        watcher.update()
+        self.assertEqual(self.watcher_output(watcher), self.walk_output())
+    def test_hashing_pool(self):
+        watcher = fileinfo.snapshot_watcher([ self.tempdir ], ncpus=2)
+        watcher.start(False)
+        try:
+            tasks = list(watcher.pool.tasks)
+            self.assertEqual(len(tasks), 2)
+            # the same tasks hash the files that change
+            self.write("b", "split")
+            watcher.trees[0].add_events([ (self.tempdir, fileinfo.IN_MODIFY,
+                                           "b") ])
+            watcher.update()
+            self.assertEqual(self.watcher_output(watcher), self.walk_output())
+            self.assertEqual(watcher.pool.tasks, tasks)
+            self.assertTrue(all([ task.is_alive() for task in tasks ]))
+        finally:
+            watcher.close()
+        # and they are gone once the watcher is closed
+        self.assertFalse(any([ task.is_alive() for task in tasks ]))
+    def test_watch(self):
+        watcher = fileinfo.snapshot_watcher([ self.tempdir ])
+        try:
+            watcher.start()
+        except OSError:
+            self.skipTest("inotify is not available")
+        try:
+            self.write("sub/c", "pie")
+            self.write("f", "fig")
+            self.assertTrue(watcher.read_events(5))
+            # collect any events that are not read yet
+            while watcher.read_events(0.1):
+                pass
+            watcher.update()
+            self.assertEqual(self.watcher_output(watcher),
+                             self.walk_output())
+        finally:
+            for tree in watcher.trees:
+                tree.watches.close()
+
+# test prefetching the stats of files
+class PrefetchTests(unittest.TestCase):
+    def test_stat_prefetcher(self):
+        tempdir = tempfile.mkdtemp()
+        names = [ "f%d" % n for n in range(20) ]
+        for name in names:
+            open(os.path.join(tempdir, name), "w").close()
+        try:
+            paths = [ os.path.join(tempdir, name) for name in names ]
+            prefetcher = fileinfo.stat_prefetcher(3)
+            prefetcher.prefetch(paths + [ os.path.join(tempdir, "missing") ])
+            for path in paths:
+                self.assertEqual(prefetcher.lstat(path).st_ino,
+                                 os.lstat(path).st_ino)
+            self.assertRaises(OSError, prefetcher.lstat,
+                              os.path.join(tempdir, "missing"))
+            # paths not prefetched are still found
+            self.assertEqual(prefetcher.lstat(tempdir).st_ino,
+                             os.lstat(tempdir).st_ino)
+            # and the output is the same as without prefetching
+            outputs = [ ]
+            for prefetch in (False, True):
+                out = StringIO()
+                stream = fileinfo.file_info_output_stream_immediate(out)
+                if prefetch:
+                    stream.prefetcher = prefetcher
+                stream.output_dir(tempdir)
+                stream.prefetch_stats(tempdir, names)
+                for name in names:
+                    stream.output_file(tempdir, name)
+                outputs.append(out.getvalue())
+            self.assertEqual(outputs[0], outputs[1])
+        finally:
+            for name in names:
+                os.remove(os.path.join(tempdir, name))
+            os.rmdir(tempdir)
+    def test_not_prefetched(self):
+        # paths not prefetched are stat'ed under the limit, without
+        # holding the lock the threads need
+        held = [ ]
+        class file_limit:
+            def take(self, n):
+                def check():
+                    acquired = prefetcher.cond.acquire(False)
+                    if acquired:
+                        prefetcher.cond.release()
+                    held.append(not acquired)
+                task = threading.Thread(target=check)
+                task.start()
+                task.join()
+        prefetcher = fileinfo.stat_prefetcher(1, file_limit())
+        self.assertEqual(prefetcher.lstat(".").st_ino, os.lstat(".").st_ino)
+        self.assertEqual(held, [ False ])
+
+# test limiting the rate of reading files
+class RateLimitTests(unittest.TestCase):
+    def test_rate_arg(self):
+        self.assertEqual(fileinfo.rate_arg("500"), 500)
+        self.assertEqual(fileinfo.rate_arg("1.5k"), 1536)
+        self.assertEqual(fileinfo.rate_arg("20M"), 20 * 1024 * 1024)
+        self.assertRaises(ValueError, fileinfo.rate_arg, "-1")
+        self.assertRaises(ValueError, fileinfo.rate_arg, "fast")
+    def test_token_bucket(self):
+        for processes in (False, True):
+            bucket = fileinfo.token_bucket(0, processes)
+            start = time.time()
+            bucket.take(1000000)
+            # the bucket starts full, so only going over it waits
+            bucket.set_rate(1000)
+            bucket.take(100)
+            self.assertTrue(time.time() - start < 0.05)
+            bucket.take(1000)
+            self.assertTrue(time.time() - start >= 0.09)
+            self.assertEqual(bucket.rate(), 1000)
+    def test_read_rate_control(self):
+        rates = fileinfo.read_rate_control(StringIO(
+                    "# daytime\nread-rate 10M\n\nfile-rate 0\n"))
+        self.assertEqual(rates, { 'read-rate': 10 * 1024 * 1024,
+                                  'file-rate': 0 })
+        self.assertRaises(ValueError, fileinfo.read_rate_control,
+                          StringIO("write-rate 5\n"))
+    def test_rate_controller(self):
+        (fd, name) = tempfile.mkstemp()
+        os.write(fd, b"read-rate 2K\n")
+        os.close(fd)
+        byte_limit = fileinfo.token_bucket(1)
+        file_limit = fileinfo.token_bucket(7)
+        reload = threading.Event()
+        finished = threading.Event()
+        task = threading.Thread(target=fileinfo.rate_controller,
+                                args=(name, byte_limit, file_limit,
+                                      reload, finished))
+        task.start()
+        try:
+            for n in range(100):
+                if byte_limit.rate() == 2048:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(byte_limit.rate(), 2048)
+            self.assertEqual(file_limit.rate(), 7)
+        finally:
+            finished.set()
+            reload.set()
+            task.join()
+            os.remove(name)
+
+# test serving snapshots over a socket
+class ServerTests(unittest.TestCase):
+    def request(self, server, request):
+        (client, conn) = socket.socketpair()
+        task = threading.Thread(target=server.handle, args=(conn,))
+        task.start()
+        try:
+            writer = fileinfo.socket_file(client, 'w')
+            writer.write(json.dumps(request) + "\n")
+            writer.close()
+            reader = fileinfo.socket_file(client, 'r')
+            reply = reader.read()
+            reader.close()
+        finally:
+            task.join()
+            conn.close()
+            client.close()
+        return reply
+    def test_handle(self):
+        tempdir = tempfile.mkdtemp()
+        for name in ("a", "b"):
+            f = open(os.path.join(tempdir, name), "w")
+            f.write(name)
+            f.close()
+        q_checksum = Queue.Queue()
+        q_results = Queue.Queue()
+        task = threading.Thread(target=fileinfo.checksum_generator,
+                                args=(q_checksum, q_results))
+        task.daemon = True
+        task.start()
+        try:
+            out = StringIO()
+            stream = fileinfo.file_info_output_stream_immediate(out)
+            stream.output_dir(tempdir)
+            for name in ("a", "b"):
+                stream.output_file(tempdir, name)
+            expected = [ line for line in out.getvalue().split("\n")
+                              if not line.startswith("A") ]
+            # the same server, and hashing task, answers each request
+            server = fileinfo.snapshot_server(q_checksum, q_results)
+            for n in range(2):
+                reply = self.request(server, { 'command': 'snapshot',
+                                               'directories': [ tempdir ] })
+                self.assertTrue(reply.startswith("ok\n"))
+                self.assertEqual([ line for line in reply[3:].split("\n")
+                                        if not line.startswith("A") ],
+                                 expected)
+            # relative directories are output as they were given
+            (parent, base) = os.path.split(tempdir)
+            reply = self.request(server, { 'command': 'snapshot',
+                                           'directories': [ base ],
+                                           'cwd': parent })
+            self.assertEqual([ line for line in reply[3:].split("\n")
+                                    if not line.startswith("A") ],
+                             [ expected[0], "!" + base ] + expected[2:])
+            snapshot = os.path.join(tempdir, "b")
+            f = open(snapshot, "w")
+            f.write(out.getvalue())
+            f.close()
+            reply = self.request(server, { 'command': 'check',
+                                           'snapshot': snapshot })
+            self.assertEqual(reply, "ok\nhash mismatch: %s\n" % snapshot)
+            reply = self.request(server, { 'command': 'snapshot',
+                                           'directories': [ snapshot ] })
+            self.assertEqual(reply, "error not a directory: %s\n" % snapshot)
+            reply = self.request(server, { 'command': 'remove' })
+            self.assertTrue(reply.startswith("error unknown command"))
+        finally:
+            q_checksum.put(None)
+            for name in ("a", "b"):
+                os.remove(os.path.join(tempdir, name))
+            os.rmdir(tempdir)
+    def test_options(self):
+        tempdir = tempfile.mkdtemp()
+        for name in ("a", "b"):
+            f = open(os.path.join(tempdir, name), "w")
+            f.write(name * 10)
+            f.close()
+        try:
+            out = StringIO()
+            stream = fileinfo.file_info_output_stream_immediate(out)
+            stream.output_dir(tempdir)
+            for name in ("a", "b"):
+                stream.output_file(tempdir, name)
+            expected = [ line for line in out.getvalue().split("\n")
+                              if not line.startswith("A") ]
+            # the limits and the prefetcher apply to every request
+            taken = [ ]
+            class byte_limit:
+                def rate(self):
+                    return 0
+                def take(self, n):
+                    taken.append(n)
+            server = fileinfo.snapshot_server()
+            server.byte_limit = byte_limit()
+            server.prefetcher = fileinfo.stat_prefetcher(1)
+            reply = self.request(server, { 'command': 'snapshot',
+                                           'directories': [ tempdir ] })
+            self.assertEqual([ line for line in reply[3:].split("\n")
+                                    if not line.startswith("A") ],
+                             expected)
+            self.assertEqual(sum(taken), 20)
+            snapshot = os.path.join(tempdir, "b")
+            f = open(snapshot, "w")
+            f.write(out.getvalue())
+            f.close()
+            reply = self.request(server, { 'command': 'check',
+                                           'snapshot': snapshot })
+            self.assertEqual(sum(taken), 20 + 10 + len(out.getvalue()))
+            # mount points not descended into are kept as markers
+            records = fileinfo.file_info_output_stream_records()
+            dirs = [ "a" ]
+            records.prune_mounts(tempdir, dirs, -1, True)
+            self.assertEqual(dirs, [ ])
+            self.assertEqual([ info.dir_name
+                               for info in records.ready_info() ],
+                             [ os.path.join(tempdir, "a") ])
+        finally:
+            for name in ("a", "b"):
+                os.remove(os.path.join(tempdir, name))
+            os.rmdir(tempdir)
+    def test_connect_server(self):
+        tempdir = tempfile.mkdtemp()
+        socket_name = os.path.join(tempdir, "socket")
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(socket_name)
+        listener.listen(1)
+        def answer(reply):
+            conn = listener.accept()[0]
+            fileinfo.socket_file(conn, 'r').readline()
+            conn.sendall(reply.encode())
+            conn.close()
+        try:
+            for (reply, lines) in (("ok\nline 1\nline 2\n", 2),
+                                   ("error no such luck\n", None),
+                                   ("ok\nline 1\n%error broken\n", None)):
+                task = threading.Thread(target=answer, args=(reply,))
+                task.start()
+                out = StringIO()
+                try:
+                    if lines is None:
+                        self.assertRaises(fileinfo.server_error,
+                                          fileinfo.connect_server,
+                                          socket_name, { }, out)
+                    else:
+                        self.assertEqual(fileinfo.connect_server(socket_name,
+                                                                 { }, out),
+                                         lines)
+                        self.assertEqual(out.getvalue(), reply[3:])
+                finally:
+                    task.join()
+        finally:
+            listener.close()
+            os.remove(socket_name)
+            os.rmdir(tempdir)
+
+# test the sampled fingerprints and checking them
+class SampleTests(unittest.TestCase):
+    def test_sample_ranges(self):
+        self.assertEqual(fileinfo.sample_ranges(0, (10, 3)), [ (0, 0) ])
+        self.assertEqual(fileinfo.sample_ranges(30, (10, 3)), [ (0, 30) ])
+        self.assertEqual(fileinfo.sample_ranges(31, (10, 3)),
+                         [ (0, 10), (10, 10), (21, 10) ])
+        self.assertEqual(fileinfo.sample_ranges(1000, (10, 2)),
+                         [ (0, 10), (990, 10) ])
+        self.assertEqual(fileinfo.sample_arg("2"), 2)
+        self.assertRaises(ValueError, fileinfo.sample_arg, "1")
+    def test_unescape_filename(self):
+        for name in (u"plain", u"back\\slash", u"\u0001\u0085\u4e2d",
+                     u"\U0001f600"):
+            self.assertEqual(
+                fileinfo.unescape_filename(fileinfo.escape_filename(name)),
+                name)
+    def test_sample_checksum(self):
+        tempdir = tempfile.mkdtemp()
+        name = os.path.join(tempdir, "f")
+        data = "".join([ chr(ord('a') + (n % 26)) for n in range(100) ])
+        f = open(name, "w")
+        f.write(data)
+        f.close()
+        try:
+            info = fileinfo.file_info("f", name, os.lstat(name), (10, 3))
+            bytes_read = fileinfo.LocalCounter()
+            fileinfo.get_checksum(info, bytes_read)
+            h = hashlib.sha224(("100\n" + data[0:10] + data[45:55] +
+                                data[90:100]).encode())
+            self.assertEqual(info.encoded_hash,
+                             base64.b64encode(h.digest()).decode())
+            self.assertEqual(bytes_read.value, 30)
+            out = StringIO()
+            info.output(out, StringIO(), None)
+            self.assertTrue(("\n~%s\n" % info.encoded_hash) in out.getvalue())
+            self.assertFalse("\n#" in out.getvalue())
+        finally:
+            os.remove(name)
+            os.rmdir(tempdir)
+    def test_check_hashes(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            for name in ("full", "sampled", "missing"):
+                f = open(os.path.join(tempdir, name), "w")
+                f.write("x" * 100)
+                f.close()
+            out = StringIO()
+            stream = fileinfo.file_info_output_stream_immediate(out,
+                         header_lines=[ "%sample 10 2\n" ])
+            stream.output_dir(tempdir)
+            stream.output_file(tempdir, "full")
+            stream.output_file(tempdir, "missing")
+            stream.sample = (10, 2)
+            stream.output_file(tempdir, "sampled")
+            # nothing has changed
+            report = StringIO()
+            self.assertEqual(fileinfo.check_hashes(
+                fileinfo.file_info_input_stream(StringIO(out.getvalue())),
+                report), 0)
+            self.assertEqual(report.getvalue(), "")
+            # change a byte in the middle of each, which the sampled
+            # fingerprint does not read
+            for name in ("full", "sampled"):
+                f = open(os.path.join(tempdir, name), "r+")
+                f.seek(50)
+                f.write("y")
+                f.close()
+            os.remove(os.path.join(tempdir, "missing"))
+            self.assertEqual(fileinfo.check_hashes(
+                fileinfo.file_info_input_stream(StringIO(out.getvalue())),
+                report), 2)
+            self.assertEqual(report.getvalue().splitlines(),
+                [ "hash mismatch: %s" % os.path.join(tempdir, "full"),
+                  "cannot read (No such file or directory): %s" %
+                      os.path.join(tempdir, "missing") ])
+            # and now change the end of the sampled file
+            f = open(os.path.join(tempdir, "sampled"), "r+")
+            f.seek(99)
+            f.write("y")
+            f.close()
+            report = StringIO()
+            fileinfo.check_hashes(
+                fileinfo.file_info_input_stream(StringIO(out.getvalue())),
+                report)
+            self.assertTrue("sample mismatch: %s\n" %
+                            os.path.join(tempdir, "sampled")
+                            in report.getvalue())
+        finally:
+            for name in ("full", "sampled"):
+                os.remove(os.path.join(tempdir, name))
+            os.rmdir(tempdir)
+
+# test hashing sparse files
+class SparseTests(unittest.TestCase):
+    def test_sparse_checksum(self):
+        # this needs SEEK_DATA and SEEK_HOLE (Python 3.3+)
+        if not hasattr(os, 'SEEK_DATA'): return
+        tempdir = tempfile.mkdtemp()
+        name = os.path.join(tempdir, "f")
+        size = 4 * 1024 * 1024
+        f = open(name, "wb")
+        f.truncate(size)
+        f.seek(1024 * 1024 + 5)
+        f.write(b"data")
+        f.close()
+        try:
+            st = os.lstat(name)
+            fd = os.open(name, os.O_RDONLY)
+            try:
+                extents = fileinfo.data_extents(fd, size)
+            finally:
+                os.close(fd)
+            if extents is not None:
+                self.assertEqual(sum([ n for (offset, n) in extents ]) < size,
+                                 fileinfo.is_sparse(st))
+            info = fileinfo.file_info("f", name, st)
+            bytes_read = fileinfo.LocalCounter()
+            fileinfo.get_checksum(info, bytes_read)
+            f = open(name, "rb")
+            h = hashlib.sha224(f.read())
+            f.close()
+            self.assertEqual(info.encoded_hash,
+                             base64.b64encode(h.digest()).decode())
+            self.assertEqual(bytes_read.value, size)
+        finally:
+            os.remove(name)
+            os.rmdir(tempdir)
+    def test_no_seek_data(self):
+        # without SEEK_DATA, we cannot tell where the holes are
+        saved = getattr(os, 'SEEK_DATA', None)
+        if saved is not None:
+            del os.SEEK_DATA
+        try:
+            self.assertEqual(fileinfo.data_extents(0, 4096), None)
+        finally:
+            if saved is not None:
+                os.SEEK_DATA = saved
+    def test_hash_zeros(self):
+        h = hashlib.sha224()
+        bytes_read = fileinfo.LocalCounter()
+        n = len(fileinfo.ZERO_BLOCK) * 2 + 3
+        fileinfo.hash_zeros(h, n, bytes_read)
+        self.assertEqual(h.digest(), hashlib.sha224(b"\0" * n).digest())
+        self.assertEqual(bytes_read.value, n)
+
+# test hashing in the kernel
+class KernelHashTests(unittest.TestCase):
+    def test_kernel_hash(self):
+        tempdir = tempfile.mkdtemp()
+        name = os.path.join(tempdir, "f")
+        data = os.urandom(fileinfo.KERNEL_HASH_MIN * 3 + 5)
+        f = open(name, "wb")
+        f.write(data)
+        f.close()
+        try:
+            # the same hash whether or not the kernel can calculate it
+            fileinfo.set_kernel_hash(True)
+            info = fileinfo.file_info("f", name, os.lstat(name))
+            bytes_read = fileinfo.LocalCounter()
+            # the bytes are only charged to the limit once, whichever
+            # way the file is hashed
+            taken = [ ]
+            class byte_limit:
+                def rate(self):
+                    return 0
+                def take(self, n):
+                    taken.append(n)
+            fileinfo.get_checksum(info, bytes_read, byte_limit())
+            h = hashlib.sha224(data)
+            self.assertEqual(info.encoded_hash,
+                             base64.b64encode(h.digest()).decode())
+            self.assertEqual(bytes_read.value, len(data))
+            self.assertEqual(sum(taken), len(data))
+            # while the rate is limited, the kernel is not used
+            save_kernel_digest = fileinfo.kernel_digest
+            kernel_files = [ ]
+            def kernel_digest(fd, size):
+                kernel_files.append(size)
+                return save_kernel_digest(fd, size)
+            try:
+                fileinfo.kernel_digest = kernel_digest
+                fileinfo.get_checksum(info, None, byte_limit())
+                self.assertEqual(kernel_files, [ len(data) ])
+                limited = fileinfo.token_bucket(len(data) * 10)
+                fileinfo.get_checksum(info, None, limited)
+                self.assertEqual(kernel_files, [ len(data) ])
+                self.assertEqual(info.encoded_hash,
+                                 base64.b64encode(h.digest()).decode())
+            finally:
+                fileinfo.kernel_digest = save_kernel_digest
+            if fileinfo.kernel_hasher() is not None:
+                fd = os.open(name, os.O_RDONLY)
+                try:
+                    self.assertEqual(fileinfo.kernel_digest(fd, len(data)),
+                                     h.digest())
+                finally:
+                    os.close(fd)
+        finally:
+            fileinfo.set_kernel_hash(False)
+            os.remove(name)
+            os.rmdir(tempdir)
+
+# test reusing the hashes of files with shared extents
+def mock_fiemap_ioctl(fd, opt, arg, mutate_flag=False):
+    # every file is a single shared extent at the same place
+    size = os.fstat(fd).st_size
+    fileinfo.FIEMAP_HEADER.pack_into(arg, 0, 0, 0, 0, 1, 0, 0)
+    fileinfo.FIEMAP_EXTENT.pack_into(arg, fileinfo.FIEMAP_HEADER.size,
+                                     0, 1 << 20, size, 0, 0,
+                                     fileinfo.FIEMAP_EXTENT_SHARED |
+                                     fileinfo.FIEMAP_EXTENT_LAST, 0, 0, 0)
+
+class SharedExtentTests(unittest.TestCase):
+    def test_shared_extents(self):
+        if not (platform.system() == 'Linux'): return
+        tempdir = tempfile.mkdtemp()
+        size = fileinfo.SHARED_EXTENT_MIN
+        for (name, c) in (("a", b"a"), ("b", b"b"), ("c", b"c")):
+            f = open(os.path.join(tempdir, name), "wb")
+            f.write(c * size)
+            if name == "c":
+                f.write(b"c")
+            f.close()
+        save_ioctl = fileinfo.fcntl.ioctl
+        # the flags of each FIEMAP request
+        flags = [ ]
+        def ioctl(fd, opt, arg, mutate_flag=False):
+            flags.append(fileinfo.FIEMAP_HEADER.unpack_from(arg, 0)[2])
+            mock_fiemap_ioctl(fd, opt, arg, mutate_flag)
+        try:
+            fileinfo.fcntl.ioctl = ioctl
+            fd = os.open(os.path.join(tempdir, "a"), os.O_RDONLY)
+            try:
+                self.assertEqual(fileinfo.file_extents(fd),
+                                 [ (0, 1 << 20, size,
+                                    fileinfo.FIEMAP_EXTENT_SHARED |
+                                    fileinfo.FIEMAP_EXTENT_LAST) ])
+            finally:
+                os.close(fd)
+            out = StringIO()
+            stream = fileinfo.file_info_output_stream_immediate(out)
+            stream.shared_extents = True
+            stream.output_dir(tempdir)
+            for name in ("a", "b", "c"):
+                stream.output_file(tempdir, name)
+            hashes = [ line for line in out.getvalue().split("\n")
+                            if line.startswith("#") ]
+            # "b" has the same extents as "a", so it is not read, while
+            # "c" is a different size
+            self.assertEqual(len(hashes), 3)
+            self.assertEqual(hashes[0], hashes[1])
+            self.assertNotEqual(hashes[0], hashes[2])
+            self.assertEqual(stream.bytes_read.value, size * 2 + 1)
+            # dirty data is always written out before the extents are read
+            self.assertEqual(set(flags), set([ fileinfo.FIEMAP_FLAG_SYNC ]))
+        finally:
+            fileinfo.fcntl.ioctl = save_ioctl
+            for name in ("a", "b", "c"):
+                os.remove(os.path.join(tempdir, name))
+            os.rmdir(tempdir)
+
+    def test_unhashed_extents(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, "b")
+            f = open(path, "wb")
+            f.write(b"b" * 100)
+            f.close()
+            # "a" could not be hashed, so its clone "b" is hashed itself
+            first = fileinfo.file_info("a", os.path.join(tempdir, "a"),
+                                       os.lstat(path))
+            first.extent_key = (100, ( ))
+            clone = fileinfo.file_info("b", path, os.lstat(path))
+            clone.extent_key = first.extent_key
+            clone.reuse_hash = True
+            shared_hashes = { }
+            bytes_read = fileinfo.LocalCounter()
+            first.share_hash(shared_hashes, bytes_read)
+            clone.share_hash(shared_hashes, bytes_read)
+            self.assertEqual(clone.encoded_hash,
+                             base64.b64encode(
+                                 hashlib.sha224(b"b" * 100).digest()).decode())
+            self.assertEqual(bytes_read.value, 100)
+            # and a later clone reuses the hash of "b"
+            other = fileinfo.file_info("c", os.path.join(tempdir, "c"),
+                                       os.lstat(path))
+            other.extent_key = first.extent_key
+            other.reuse_hash = True
+            other.share_hash(shared_hashes, bytes_read)
+            self.assertEqual(other.encoded_hash, clone.encoded_hash)
+            self.assertEqual(bytes_read.value, 100)
+            # the serializer counts the bytes, under the limit
+            clone = fileinfo.file_info("b", path, os.lstat(path))
+            clone.extent_key = first.extent_key
+            clone.reuse_hash = True
+            q = Queue.Queue()
+            q.put((0, first))
+            q.put((1, clone))
+            q.put(None)
+            taken = [ ]
+            class byte_limit:
+                def take(self, n):
+                    taken.append(n)
+            fileinfo.serializer(q, 1, fileinfo.WriterWithSize(StringIO()),
+                                bytes_read=bytes_read,
+                                byte_limit=byte_limit())
+            self.assertEqual(clone.encoded_hash, other.encoded_hash)
+            self.assertEqual(bytes_read.value, 200)
+            self.assertEqual(sum(taken), 100)
+        finally:
+            os.remove(os.path.join(tempdir, "b"))
+            os.rmdir(tempdir)
+
+# test finding duplicate files
+class DuplicateTests(unittest.TestCase):
+    def test_find_duplicates(self):
+        top = tempfile.mkdtemp()
+        contents = { "a": "x" * 20000, "b": "x" * 20000, "c": "x" * 20000,
+                     "d": "x" * 5000 + "y" + "x" * 14999, "e": "y" * 20000,
+                     "f": "small", "g": "small", "h": "", "i": "" }
+        for (name, data) in contents.items():
+            f = open(os.path.join(top, name), "w")
+            f.write(data)
+            f.close()
+        os.link(os.path.join(top, "a"), os.path.join(top, "link"))
+        try:
+            for ncpus in (1, 2):
+                bytes_read = fileinfo.LocalCounter()
+                (duplicates, num_dirs, num_files) = \
+                    fileinfo.find_duplicates([ top ], ncpus,
+                                             bytes_read=bytes_read)
+                self.assertEqual(num_dirs, 0)
+                self.assertEqual(num_files, 10)
+                # the largest waste comes first, and the hard link and
+                # empty files are not included
+                self.assertEqual([ (size, paths)
+                                   for (size, h, paths) in duplicates ],
+                                 [ (20000, [ os.path.join(top, name)
+                                             for name in "abc" ]),
+                                   (5, [ os.path.join(top, name)
+                                         for name in "fg" ]) ])
+                # "d" is only different between the blocks compared
+                # first, so has to be read completely, but "e" is not
+                self.assertEqual(bytes_read.value,
+                                 5 * 3 * 4096 + 2 * 5 + 4 * 20000 + 2 * 5)
+            out = StringIO()
+            fileinfo.output_duplicates(out, duplicates[1:])
+            self.assertEqual(out.getvalue(),
+                             "s5\n#%s\n>%s\n>%s\n" %
+                             (duplicates[1][1], os.path.join(top, "f"),
+                              os.path.join(top, "g")))
+        finally:
+            for name in list(contents.keys()) + [ "link" ]:
+                os.remove(os.path.join(top, name))
+            os.rmdir(top)
+
+# test the library interface
+class RecordTests(unittest.TestCase):
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.top, "sub"))
+        for name in ("a", "b", os.path.join("sub", "c")):
+            f = open(os.path.join(self.top, name), "w")
+            f.write(name)
+            f.close()
+        os.link(os.path.join(self.top, "a"),
+                os.path.join(self.top, "sub", "link"))
+    def tearDown(self):
+        for name in ("a", "b", os.path.join("sub", "c"),
+                     os.path.join("sub", "link")):
+            os.remove(os.path.join(self.top, name))
+        os.rmdir(os.path.join(self.top, "sub"))
+        os.rmdir(self.top)
+    def _hash(self, data):
+        h = hashlib.sha224(data.encode())
+        return base64.b64encode(h.digest()).decode()
+    def test_walk_records(self):
+        for ncpus in (1, 3):
+            for batch_size in (1, 1000):
+                records = list(fileinfo.walk_records(self.top, ncpus,
+                                                     batch_size))
+                self.assertEqual([ r.path for r in records ],
+                                 [ os.path.join(self.top, name)
+                                   for name in ("sub", "a", "b",
+                                                "sub/c", "sub/link") ])
+                self.assertEqual(records[0].hash, None)
+                self.assertTrue(stat.S_ISDIR(records[0].stat.st_mode))
+                self.assertEqual(records[1].hash, self._hash("a"))
+                self.assertEqual(records[3].hash, self._hash("sub/c"))
+                # the hard link has the same information as the original
+                self.assertEqual(records[4].hash, self._hash("a"))
+                self.assertEqual(records[4].hard_link, records[1].path)
+                self.assertEqual(records[4].stat.st_ino,
+                                 records[1].stat.st_ino)
+                self.assertEqual(records[1].hard_link, None)
+    def test_walk_records_rules(self):
+        records = fileinfo.walk_records([ self.top ],
+                                        rules=[ ("exclude", "a"),
+                                                ("exclude", "sub/") ])
+        self.assertEqual([ r.path for r in records ],
+                         [ os.path.join(self.top, "b") ])
+    def test_walk_records_stop(self):
+        # stopping early also stops the hashing threads
+        records = fileinfo.walk_records(self.top, 3, 1)
+        self.assertEqual(next(records).path, os.path.join(self.top, "sub"))
+        records.close()
+    def test_walk_records_batch(self):
+        # no more than batch_size files are read ahead, even within one
+        # directory
+        names = [ "f%02d" % n for n in range(20) ]
+        for name in names:
+            f = open(os.path.join(self.top, "sub", name), "w")
+            f.close()
+        save_output_file = \
+            fileinfo.file_info_output_stream_records.output_file
+        read = [ ]
+        def output_file(stream, dir_name, file_name):
+            read.append(file_name)
+            return save_output_file(stream, dir_name, file_name)
+        try:
+            fileinfo.file_info_output_stream_records.output_file = \
+                output_file
+            records = fileinfo.walk_records(os.path.join(self.top, "sub"),
+                                            1, 4)
+            self.assertEqual(next(records).path,
+                             os.path.join(self.top, "sub", "c"))
+            self.assertTrue(len(read) <= 4)
+            records.close()
+        finally:
+            fileinfo.file_info_output_stream_records.output_file = \
+                save_output_file
+            for name in names:
+                os.remove(os.path.join(self.top, "sub", name))
+
+# test the include and exclude rules
+class RulesTests(unittest.TestCase):
+    def test_rule_regex(self):
+        # the text of the regular expressions depends on how re.escape()
+        # escapes characters, so we check what they match
+        def matches(pattern, path):
+            (regex, dirs_only) = fileinfo.rule_regex(pattern)
+            return re.match('(?:%s)\\Z' % regex, path) is not None
+        self.assertTrue(matches("*.o", "x.o"))
+        self.assertTrue(matches("*.o", "sub/dir/x.o"))
+        self.assertFalse(matches("*.o", "xo"))
+        self.assertFalse(matches("*.o", "x.o/y"))
+        self.assertTrue(matches("/build/", "build"))
+        self.assertFalse(matches("/build/", "sub/build"))
+        self.assertEqual(fileinfo.rule_regex("/build/")[1], True)
+        self.assertEqual(fileinfo.rule_regex("*.o")[1], False)
+        self.assertTrue(matches("a/**/b", "a/b"))
+        self.assertTrue(matches("a/**/b", "a/x/y/b"))
+        self.assertFalse(matches("a/**/b", "sub/a/b"))
+        self.assertTrue(matches("a\\*", "a*"))
+        self.assertFalse(matches("a\\*", "ab"))
+    def test_included(self):
+        rules = fileinfo.path_rules([ ("exclude", "*.o"),
+                                      ("include", "keep.o"),
+                                      ("exclude", "/build/"),
+                                      ("exclude", "doc/**/*.html"),
+                                      ("exclude", "[!a-m]?.txt"), ])
+        self.assertFalse(rules.included("x.o", False))
+        self.assertFalse(rules.included("sub/x.o", False))
+        self.assertTrue(rules.included("sub/keep.o", False))
+        self.assertTrue(rules.included("x.c", False))
+        # anchored and directory-only patterns
+        self.assertFalse(rules.included("build", True))
+        self.assertTrue(rules.included("build", False))
+        self.assertTrue(rules.included("sub/build", True))
+        # "**" matches any number of directories, "*" only within one
+        self.assertFalse(rules.included("doc/index.html", False))
+        self.assertFalse(rules.included("doc/a/b/index.html", False))
+        self.assertTrue(rules.included("sub/doc/index.html", False))
+        # character sets
+        self.assertFalse(rules.included("zz.txt", False))
+        self.assertTrue(rules.included("az.txt", False))
+    def test_many_rules(self):
+        # more rules than one regular expression can hold, where the
+        # last rule that matches still decides
+        rules = fileinfo.path_rules([ ("exclude", "*.o") ] +
+                                    [ ("exclude", "f%d" % n)
+                                      for n in range(250) ] +
+                                    [ ("include", "keep.o") ])
+        self.assertFalse(rules.included("x.o", False))
+        self.assertTrue(rules.included("keep.o", False))
+        self.assertFalse(rules.included("f0", False))
+        self.assertFalse(rules.included("f249", True))
+        self.assertTrue(rules.included("f250", False))
+    def test_include_only(self):
+        rules = fileinfo.path_rules([ ("include", "/only/") ])
+        self.assertTrue(rules.included("x.o", False))
+        self.assertTrue(rules.included("only", True))
+    def test_filter(self):
+        rules = fileinfo.path_rules([ ("exclude", "a/b") ])
+        self.assertEqual(rules.filter([ ], [ "a", "b" ], True), [ "a", "b" ])
+        self.assertEqual(rules.filter([ "a" ], [ "a", "b" ], True), [ "a" ])
+    def test_header_lines(self):
+        rules = fileinfo.path_rules([ ("exclude", "*.o"),
+                                      ("include", "a\\b") ])
+        self.assertEqual(rules.header_lines(),
+                         [ "%exclude *.o\n", "%include a\\x5cb\n" ])
+        # the input stream reads them back
+        instream = StringIO("%%fileinfo %s\n%%exclude *.o\n!.\n" %
+                            fileinfo.FILEINFO_VERSION)
+        input_stream = fileinfo.file_info_input_stream(instream)
+        self.assertEqual(input_stream.read_next(), ('dir', '.'))
+        self.assertEqual(input_stream.header_lines, [ "%exclude *.o\n" ])
+    def test_read_rules_file(self):
+        (fd, name) = tempfile.mkstemp()
+        try:
+            os.write(fd, "# comment\n\n*.o\n!keep.o\n\\!bang\n".encode())
+            os.close(fd)
+            self.assertEqual(fileinfo.read_rules_file(name),
+                             [ ("exclude", "*.o"), ("include", "keep.o"),
+                               ("exclude", "!bang") ])
+        finally:
+            os.remove(name)
+    def test_count_files(self):
+        tempdir = tempfile.mkdtemp()
+        sub_dir = os.path.join(tempdir, "sub")
+        os.mkdir(sub_dir)
+        open(os.path.join(tempdir, "a"), "w").close()
+        open(os.path.join(sub_dir, "b"), "w").close()
+        try:
+            rules = fileinfo.path_rules([ ("exclude", "sub/") ])
+            progress = fileinfo.progress_output(0, 0, 0.1, 0,
+                                                totals_complete=False)
+            fileinfo.count_files([ tempdir ], progress, rules)
+            self.assertEqual(progress.total_dir_count, 0)
+            self.assertEqual(progress.total_file_count, 1)
+        finally:
+            os.remove(os.path.join(sub_dir, "b"))
+            os.remove(os.path.join(tempdir, "a"))
+            os.rmdir(sub_dir)
+            os.rmdir(tempdir)
+
+# test the digests of directories
+class DigestTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.sub_dir = os.path.join(self.tempdir, "sub")
+        os.mkdir(self.sub_dir)
+        f = open(os.path.join(self.tempdir, "a"), "w")
+        f.write("apple")
+        f.close()
+        # nothing in sub is read, so its access times stay the same
+        os.mkfifo(os.path.join(self.sub_dir, "fifo"))
+    def tearDown(self):
+        os.remove(os.path.join(self.sub_dir, "fifo"))
+        os.rmdir(self.sub_dir)
+        os.remove(os.path.join(self.tempdir, "a"))
+        os.rmdir(self.tempdir)
+    def snapshot(self):
+        out = StringIO()
+        stream = fileinfo.file_info_output_stream_immediate(out)
+        stream.digests = fileinfo.directory_digests(stream.outfile)
+        for root, dirs, files in os.walk(self.tempdir):
+            dirs.sort()
+            files.sort()
+            stream.output_dir(root)
+            for name in dirs + files:
+                stream.output_file(root, name)
+        stream.flush()
+        return out.getvalue()
+    def digest(self, text):
+        return base64.b64encode(hashlib.sha224(text.encode()).digest()).decode()
+    def test_subdirectory_path(self):
+        self.assertEqual(fileinfo.subdirectory_path("top/a/b", "top"), "a/b")
+        self.assertEqual(fileinfo.subdirectory_path("top/a", "top/"), "a")
+        self.assertEqual(fileinfo.subdirectory_path("top", "top"), None)
+        self.assertEqual(fileinfo.subdirectory_path("topper", "top"), None)
+        self.assertEqual(fileinfo.subdirectory_path("/a", "/"), "a")
+        self.assertEqual(fileinfo.subdirectory_path("a/b", "."), "a/b")
+        self.assertEqual(fileinfo.subdirectory_path("../a", "."), None)
+        self.assertEqual(fileinfo.subdirectory_path("/a", "."), None)
+    def test_directory_digests(self):
+        out = StringIO()
+        digests = fileinfo.directory_digests(out)
+        digests.directory("!", "top")
+        # the access time is left out
+        digests.write("m40755\nA20140101000000\n>a\n")
+        digests.directory("!", "top/a")
+        digests.write("i5\n@x\n")
+        digests.skipped_mount("top/a/mnt")
+        digests.directory(":", "top/b")
+        digests.finish()
+        a = self.digest("!\ni5\n@x\n-mnt\n")
+        b = self.digest(":\n")
+        top = self.digest("!\nm40755\n>a\n*%s a\n*%s b\n" % (a, b))
+        self.assertEqual(out.getvalue(), "*%s top/a\n*%s top/b\n*%s top\n" %
+                                         (a, b, top))
+        # a directory that is not below the last one starts a new tree
+        out = StringIO()
+        digests = fileinfo.directory_digests(out)
+        digests.directory("!", "top")
+        digests.directory("!", "other")
+        digests.finish()
+        self.assertEqual(out.getvalue(), "*%s top\n*%s other\n" %
+                                         (self.digest("!\n"),
+                                          self.digest("!\n")))
+    def test_output(self):
+        snapshot = self.snapshot()
+        lines = snapshot.split("\n")
+        sub_digest = [ line for line in lines
+                            if line.endswith(" " + self.sub_dir) ]
+        top_digest = [ line for line in lines
+                            if line.endswith(" " + self.tempdir) ]
+        # each digest follows everything below its directory
+        self.assertEqual(lines[-3:], sub_digest + top_digest + [ "" ])
+        # the digest of each entry does not depend on the one before
+        sub_text = snapshot[snapshot.index("!" + self.sub_dir + "\n"):]
+        st = os.lstat(os.path.join(self.sub_dir, "fifo"))
+        entry = StringIO()
+        fileinfo.file_info("fifo", None, st).output(entry, None, None)
+        entry_text = "".join([ line for line
+                               in entry.getvalue().splitlines(True)
+                               if not line.startswith("A") ])
+        self.assertEqual(sub_digest,
+                         [ "*%s %s" % (self.digest("!\n" + entry_text),
+                                       self.sub_dir) ])
+        self.assertNotEqual(sub_text.split("\n")[1:-4],
+                            entry.getvalue().split("\n")[:-1])
+        # a change outside of a directory does not change its digest,
+        # but does change the digest of the directories above it
+        f = open(os.path.join(self.tempdir, "a"), "w")
+        f.write("apricot")
+        f.close()
+        lines = self.snapshot().split("\n")
+        self.assertEqual(lines[-3], sub_digest[0])
+        self.assertNotEqual(lines[-2], top_digest[0])
+    def test_serializer(self):
+        # with more than one core, the serializer outputs the digests
+        q = Queue.Queue()
+        fifo = os.path.join(self.sub_dir, "fifo")
+        q.put((0, fileinfo.chdir_info(self.sub_dir)))
+        q.put((1, fileinfo.file_info("fifo", fifo, os.lstat(fifo))))
+        q.put(None)
+        out = StringIO()
+        fileinfo.serializer(q, 1, fileinfo.WriterWithSize(out), digests=True)
+        expected = StringIO()
+        stream = fileinfo.file_info_output_stream_immediate(expected,
+                                                            header=False)
+        stream.digests = fileinfo.directory_digests(stream.outfile)
+        stream.output_dir(self.sub_dir)
+        stream.output_file(self.sub_dir, "fifo")
+        stream.flush()
+        self.assertEqual(out.getvalue(), expected.getvalue())
 
 if __name__ == '__main__':
     unittest.main()
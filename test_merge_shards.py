@@ -0,0 +1,175 @@
+import fileinfo
+import merge_shards
+import base64
+import hashlib
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+HEADER = '%%fileinfo %s\n' % fileinfo.FILEINFO_VERSION
+
+# a snapshot of "top", with the entries of top in unit 0, and the trees
+# below top/a and top/b in units 1 and 2 (b/y is a hard link to a/x)
+SERIAL = HEADER + """!top
+m40755
+i10
+n2
+u0
+g0
+s4096
+C20140101000000
+A20140101000000
+>a
+i11
+>b
+!top/a
+m100644
+i12
+n1
+s5
+C20140102000000
+#hash
+>x
+!top/b
+i12
+@y
+i13
+s6
+C20140103000000
+#hash2
+>z
+"""
+
+SHARD_0 = HEADER + """%shard 0/2
+&0
+!top
+m40755
+i10
+n2
+u0
+g0
+s4096
+C20140101000000
+A20140101000000
+>a
+i11
+>b
+&2
+!top/b
+m100644
+i12
+n1
+s5
+C20140102000000
+#hash
+>y
+i13
+s6
+C20140103000000
+#hash2
+>z
+"""
+
+SHARD_1 = HEADER + """%shard 1/2
+&1
+!top/a
+m100644
+i12
+n1
+u0
+g0
+s5
+C20140102000000
+A20140101000000
+#hash
+>x
+"""
+
+# test merging shards
+class MergeTests(unittest.TestCase):
+    def test_merge(self):
+        out = StringIO()
+        merge_shards.merge_shards([ StringIO(SHARD_1), StringIO(SHARD_0) ],
+                                  out)
+        self.assertEqual(out.getvalue(), SERIAL)
+
+    def test_missing_shard(self):
+        self.assertRaises(merge_shards.merge_error, merge_shards.merge_shards,
+                          [ StringIO(SHARD_0) ], StringIO())
+        self.assertRaises(merge_shards.merge_error, merge_shards.merge_shards,
+                          [ StringIO(SHARD_0), StringIO(SERIAL) ], StringIO())
+        self.assertRaises(merge_shards.merge_error, merge_shards.merge_shards,
+                          [ StringIO(SHARD_0),
+                            StringIO(SHARD_1.replace("1/2", "1/3")) ],
+                          StringIO())
+
+    def test_missing_unit(self):
+        shard_1 = SHARD_1.replace("&1", "&3")
+        self.assertRaises(merge_shards.merge_error, merge_shards.merge_shards,
+                          [ StringIO(SHARD_0), StringIO(shard_1) ], StringIO())
+
+    def test_digests(self):
+        # the shards have no digests, since they share top, so the merge
+        # outputs them all
+        def digest(text):
+            return base64.b64encode(hashlib.sha224(text.encode()).digest()
+                                   ).decode()
+        # (without the access times)
+        a = digest("!\nm100644\ni12\nn1\nu0\ng0\ns5\nC20140102000000\n"
+                   "#hash\n>x\n")
+        b = digest("!\ni12\n@y\nm100644\ni13\nn1\nu0\ng0\ns6\n"
+                   "C20140103000000\n#hash2\n>z\n")
+        top = digest("!\nm40755\ni10\nn2\nu0\ng0\ns4096\nC20140101000000\n"
+                     ">a\nm40755\ni11\nn2\nu0\ng0\n"
+                     "s4096\nC20140101000000\n>b\n"
+                     "*%s a\n*%s b\n" % (a, b))
+        serial = SERIAL.replace(HEADER, HEADER + "%digests\n")
+        serial = serial.replace("!top/b\n", "*%s top/a\n!top/b\n" % a)
+        serial = serial + "*%s top/b\n*%s top\n" % (b, top)
+        shards = [ StringIO(shard.replace("%shard", "%digests\n%shard"))
+                   for shard in (SHARD_1, SHARD_0) ]
+        out = StringIO()
+        merge_shards.merge_shards(shards, out)
+        self.assertEqual(out.getvalue(), serial)
+
+    def test_fileinfo_shards(self):
+        # shards written by fileinfo.py merge into the same output as a
+        # single run (apart from access times, which the runs change)
+        top = tempfile.mkdtemp()
+        try:
+            for name in ("a", "b", "c"):
+                os.mkdir(os.path.join(top, name))
+                f = open(os.path.join(top, name, "file"), "w")
+                f.write(name)
+                f.close()
+            os.link(os.path.join(top, "a", "file"),
+                    os.path.join(top, "c", "link"))
+            fileinfo_path = os.path.join(
+                os.path.dirname(os.path.abspath(__file__)), 'fileinfo.py')
+            def run(*args):
+                output = subprocess.check_output([ sys.executable,
+                                                   fileinfo_path, '-n', '1' ] +
+                                                 list(args) + [ top ])
+                return StringIO(output.decode())
+            serial = run()
+            shards = [ run('--shard', '%d/3' % n) for n in range(3) ]
+            out = StringIO()
+            merge_shards.merge_shards(shards, out)
+            def no_atime(s):
+                return [ line for line in s.splitlines()
+                         if not line.startswith('A') ]
+            self.assertEqual(no_atime(out.getvalue()),
+                             no_atime(serial.getvalue()))
+        finally:
+            shutil.rmtree(top)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,270 @@
+import fileinfo
+import merge_shards
+import snapshot_delta
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+HEADER = '%%fileinfo %s\n' % fileinfo.FILEINFO_VERSION
+
+# the base snapshot, where top/b/y is a hard link to top/a/x
+BASE = HEADER + """!top
+m40755
+i10
+n2
+u0
+g0
+s4096
+C20140101000000
+A20140101000000
+>a
+i11
+>b
+!top/a
+m100644
+i12
+s5
+C20140102000000
+#hash
+>x
+i14
+n1
+#hash3
+>y
+!top/b
+i12
+@y
+i13
+n1
+s6
+C20140103000000
+#hash2
+>z
+"""
+
+# top/a/x is removed, so the hard link in top/b is output in full, and
+# top/a/y changes
+NEW = HEADER + """!top
+m40755
+i10
+n2
+u0
+g0
+s4096
+C20140101000000
+A20140101000000
+>a
+i11
+>b
+!top/a
+m100644
+i14
+n1
+s7
+C20140104000000
+#hash4
+>y
+!top/b
+i12
+s5
+C20140102000000
+#hash
+>y
+i13
+s6
+C20140103000000
+#hash2
+>z
+"""
+
+# the top directory is the same, x is left out and y changes, and the
+# hard link becomes a file of its own
+DELTA = """%fileinfo-delta VERSION
+%base BASE_DIGEST
+%header HEADER%copy 1
+!top/a
+x1
+m100644
+i14
+n1
+u0
+g0
+s7
+C20140104000000
+A20140101000000
+#hash4
+>y
+!top/b
+i12
+s5
+C20140102000000
+#hash
+>y
+=1
+%result RESULT_DIGEST
+""".replace("VERSION", fileinfo.FILEINFO_VERSION).replace("HEADER", HEADER)
+
+# a subdirectory is added to top/b, top/a is removed, and the top
+# directory changes, in a snapshot with rules
+NEWER = HEADER + """%exclude *.o
+!top
+m40755
+i10
+n2
+u0
+g0
+s4096
+C20140105000000
+A20140101000000
+>b
+!top/b
+m100644
+i12
+n1
+s5
+C20140102000000
+#hash
+>y
+i13
+s6
+C20140103000000
+#hash2
+>z
+m40755
+i15
+n2
+s4096
+>zz
+!top/b/zz
+m100644
+i16
+n1
+s0
+#hash5
+>empty
+"""
+
+def digest(s):
+    return snapshot_delta.index_sections(StringIO(s))[0]
+
+def make_delta(base, new):
+    out = StringIO()
+    snapshot_delta.make_delta(StringIO(base), StringIO(new), out)
+    return out.getvalue()
+
+def apply_deltas(base, deltas):
+    out = StringIO()
+    snapshot_delta.apply_deltas(StringIO(base),
+                                [ StringIO(delta) for delta in deltas ], out)
+    return out.getvalue()
+
+# test writing and applying deltas
+class DeltaTests(unittest.TestCase):
+    def test_make_delta(self):
+        self.assertEqual(make_delta(BASE, NEW),
+                         DELTA.replace("BASE_DIGEST", digest(BASE))
+                              .replace("RESULT_DIGEST", digest(NEW)))
+
+    def test_same(self):
+        self.assertTrue(make_delta(BASE, BASE).endswith("%header " + HEADER +
+                                                        "%copy 3\n%result " +
+                                                        digest(BASE) + "\n"))
+        self.assertEqual(apply_deltas(BASE, [ make_delta(BASE, BASE) ]),
+                         BASE)
+
+    def test_apply(self):
+        self.assertEqual(apply_deltas(BASE, [ make_delta(BASE, NEW) ]), NEW)
+        self.assertEqual(apply_deltas(NEW, [ make_delta(NEW, NEWER) ]), NEWER)
+        self.assertEqual(apply_deltas(NEWER, [ make_delta(NEWER, BASE) ]),
+                         BASE)
+        # the deltas are applied one after the other
+        self.assertEqual(apply_deltas(BASE, [ make_delta(BASE, NEW),
+                                              make_delta(NEW, NEWER) ]),
+                         NEWER)
+
+    def test_wrong_base(self):
+        delta = make_delta(BASE, NEW)
+        self.assertRaises(snapshot_delta.delta_error, apply_deltas,
+                          NEWER, [ delta ])
+        self.assertRaises(snapshot_delta.delta_error, apply_deltas,
+                          BASE, [ delta, delta ])
+        self.assertRaises(snapshot_delta.delta_error, apply_deltas,
+                          BASE, [ delta.replace("i14\nn1", "i14\nn3") ])
+
+    def test_bad_delta(self):
+        delta = make_delta(BASE, NEW)
+        self.assertRaises(snapshot_delta.delta_error, apply_deltas,
+                          BASE, [ delta[:delta.index("%result")] ])
+        self.assertRaises(snapshot_delta.delta_error, apply_deltas,
+                          BASE, [ delta.replace("x1\n", "x9\n") ])
+        self.assertRaises(snapshot_delta.delta_error, apply_deltas,
+                          BASE, [ delta.replace("x1\n", "?1\n") ])
+        self.assertRaises(snapshot_delta.delta_error, apply_deltas,
+                          BASE, [ NEW ])
+        self.assertRaises(snapshot_delta.delta_error, make_delta,
+                          BASE, HEADER + "%shard 0/2\n&0\n!top\n")
+
+    def test_digests(self):
+        # the digests of directories are left out of the delta, and
+        # output again in the result
+        def with_digests(s):
+            stream = fileinfo.file_info_input_stream(StringIO(s))
+            out = StringIO()
+            out.write(HEADER + fileinfo.DIGESTS_HEADER)
+            output = merge_shards.merged_output(out, True)
+            while True:
+                item = stream.read_next()
+                if item is None:
+                    break
+                output.write(item, stream.fields)
+            output.finish()
+            return out.getvalue()
+        base = with_digests(BASE)
+        new = with_digests(NEW)
+        self.assertEqual(base.count("\n*"), 3)
+        delta = make_delta(base, new)
+        self.assertTrue("%header %digests\n" in delta)
+        self.assertFalse("\n*" in delta)
+        self.assertEqual(apply_deltas(base, [ delta ]), new)
+
+    def test_fileinfo_deltas(self):
+        # deltas between snapshots written by fileinfo.py rebuild them
+        # exactly
+        top = tempfile.mkdtemp()
+        try:
+            for name in ("a", "b", "c"):
+                os.mkdir(os.path.join(top, name))
+                f = open(os.path.join(top, name, "file"), "w")
+                f.write(name)
+                f.close()
+            os.link(os.path.join(top, "a", "file"),
+                    os.path.join(top, "c", "link"))
+            fileinfo_path = os.path.join(
+                os.path.dirname(os.path.abspath(__file__)), 'fileinfo.py')
+            def run():
+                output = subprocess.check_output([ sys.executable,
+                                                   fileinfo_path, top ])
+                return output.decode()
+            snapshots = [ run() ]
+            os.remove(os.path.join(top, "a", "file"))
+            snapshots.append(run())
+            shutil.rmtree(os.path.join(top, "b"))
+            os.mkdir(os.path.join(top, "d"))
+            snapshots.append(run())
+            deltas = [ make_delta(snapshots[n], snapshots[n + 1])
+                       for n in range(len(snapshots) - 1) ]
+            self.assertEqual(apply_deltas(snapshots[0], deltas),
+                             snapshots[-1])
+        finally:
+            shutil.rmtree(top)
+
+if __name__ == '__main__':
+    unittest.main()
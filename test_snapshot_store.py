@@ -0,0 +1,156 @@
+import fileinfo
+import snapshot_store
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+HEADER = '%%fileinfo %s\n' % fileinfo.FILEINFO_VERSION
+
+# a snapshot of "top", where top/b/y is a hard link to top/a/x
+SNAPSHOT = HEADER + """!top
+m40755
+i10
+n2
+u0
+g0
+s4096
+C20140101000000
+A20140101000000
+>a
+i11
+>b
+!top/a
+m100644
+i12
+n1
+s5
+C20140102000000
+#hash
+>x
+!top/b
+i12
+@y
+i13
+s6
+C20140103000000
+#hash2
+>z
+"""
+
+# only top/b/z changes, so only top/b and the trees of top/b and top are
+# new
+CHANGED = SNAPSHOT.replace("s6\nC20140103000000\n#hash2",
+                           "s7\nC20140104000000\n#hash3")
+
+# test keeping snapshots in a store
+class StoreTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.store = snapshot_store.object_store(self.tempdir)
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+    def export(self, name):
+        out = StringIO()
+        snapshot_store.export_snapshot(self.store, name, out)
+        return out.getvalue()
+
+    def test_add_export(self):
+        snapshot_store.add_snapshot(self.store, "one", StringIO(SNAPSHOT))
+        self.assertEqual(self.export("one"), SNAPSHOT)
+        # a directory and a tree for each directory
+        self.assertEqual(len(self.store.keys()), 6)
+        # the cached inode is stored with the information of the file
+        # it is a hard link to
+        texts = [ self.store.get(key) for key in self.store.keys() ]
+        self.assertTrue("!top/b\nm100644\ni12\nn1\nu0\ng0\ns5\n"
+                        "C20140102000000\nA20140101000000\n#hash\n>y\n"
+                        "i13\ns6\nC20140103000000\n#hash2\n>z\n" in texts)
+
+    def test_dedup(self):
+        snapshot_store.add_snapshot(self.store, "one", StringIO(SNAPSHOT))
+        snapshot_store.add_snapshot(self.store, "two", StringIO(CHANGED))
+        self.assertEqual(len(self.store.keys()), 9)
+        # adding the same snapshot again adds nothing
+        snapshot_store.add_snapshot(self.store, "three", StringIO(SNAPSHOT))
+        self.assertEqual(len(self.store.keys()), 9)
+        self.assertEqual(self.store.names(), [ "one", "three", "two" ])
+        self.assertEqual(self.export("two"), CHANGED)
+        self.assertEqual(self.export("three"), SNAPSHOT)
+
+    def test_remove(self):
+        snapshot_store.add_snapshot(self.store, "one", StringIO(SNAPSHOT))
+        snapshot_store.add_snapshot(self.store, "two", StringIO(CHANGED))
+        self.store.remove_manifest("one")
+        self.assertEqual(snapshot_store.remove_unused(self.store), 3)
+        self.assertEqual(self.store.names(), [ "two" ])
+        self.assertEqual(self.export("two"), CHANGED)
+        self.assertRaises(snapshot_store.store_error, self.export, "one")
+        self.assertRaises(snapshot_store.store_error,
+                          self.store.remove_manifest, "one")
+
+    def test_not_exact(self):
+        # a snapshot that would not be exported as it is is not added
+        self.assertRaises(snapshot_store.store_error,
+                          snapshot_store.add_snapshot, self.store, "one",
+                          StringIO(SNAPSHOT.replace("i11\n", "i11\nu0\n")))
+        self.assertEqual(self.store.names(), [ ])
+        self.assertRaises(snapshot_store.store_error,
+                          snapshot_store.add_snapshot, self.store, "../one",
+                          StringIO(SNAPSHOT))
+
+    def test_damaged(self):
+        snapshot_store.add_snapshot(self.store, "one", StringIO(SNAPSHOT))
+        for key in self.store.keys():
+            path = self.store._object_path(key)
+            f = open(path)
+            text = f.read()
+            f.close()
+            if "#hash2" in text:
+                f = open(path, "w")
+                f.write(text.replace("#hash2", "#hash4"))
+                f.close()
+        self.assertRaises(snapshot_store.store_error, self.export, "one")
+        # a missing object
+        for key in self.store.keys():
+            self.store.remove(key)
+        self.assertRaises(snapshot_store.store_error, self.export, "one")
+
+    def test_fileinfo_store(self):
+        # snapshots written by fileinfo.py are exported exactly
+        top = tempfile.mkdtemp()
+        try:
+            for name in ("a", "b", "b/c"):
+                os.mkdir(os.path.join(top, name))
+                f = open(os.path.join(top, name, "file"), "w")
+                f.write(name)
+                f.close()
+            os.link(os.path.join(top, "a", "file"),
+                    os.path.join(top, "b", "c", "link"))
+            fileinfo_path = os.path.join(
+                os.path.dirname(os.path.abspath(__file__)), 'fileinfo.py')
+            def run():
+                output = subprocess.check_output([ sys.executable,
+                                                   fileinfo_path,
+                                                   '--digests', top ])
+                return output.decode()
+            snapshots = [ run() ]
+            os.remove(os.path.join(top, "a", "file"))
+            snapshots.append(run())
+            for (n, snapshot) in enumerate(snapshots):
+                snapshot_store.add_snapshot(self.store, str(n),
+                                            StringIO(snapshot))
+            for (n, snapshot) in enumerate(snapshots):
+                self.assertEqual(self.export(str(n)), snapshot)
+        finally:
+            shutil.rmtree(top)
+
+if __name__ == '__main__':
+    unittest.main()